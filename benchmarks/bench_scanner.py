@@ -0,0 +1,258 @@
+"""
+Offline scanner benchmark. Runs every scanner class against a SimulatedResponder
+through the probe engine, through worker processes and through the sr1() path,
+and the connect scanner through a local SimulatedSocksProxy, for several
+concurrency settings, and reports probes and results per second, result latency
+percentiles and peak memory. Probes and latencies of worker processes are not
+visible to the parent and are left out.
+
+Usage: python -m benchmarks.bench_scanner [--hosts 4] [--ports 1-1000] [--processes 2,4]
+       [--connect 100,500] [--scapy-packets] [--no-metrics] [--json out.json]
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+
+import scapy.layers.inet
+
+import src.scanner
+from benchmarks.simulator import SimulatedNetwork, SimulatedResponder, SimulatedSocksProxy
+from src.connect import ConnectEngine, ProxyPool, SocksProxy
+from src.engine import ProbeEngine
+from src.metrics import METRICS
+from src.ports import PortSet
+from src.ratelimit import RateLimiter
+from src.scanner import ACKScanner, CombinedScanner, ConnectScanner, FINScanner, NULLScanner, \
+    SYNScanner
+from src.scheduler import ScanScheduler
+from src.sharding import ShardedScan
+from src.targets import TargetSet, ip_to_int
+
+SCANNER_CLASSES = (ACKScanner, CombinedScanner, FINScanner, NULLScanner, SYNScanner)
+
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of values.
+
+    :param values: sorted list of numbers.
+    :param fraction: percentile between 0 and 1.
+    :return: value at the percentile, 0 for no values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_engine(responder, scanner_class, targets, ports, args, in_flight):
+    """
+    Scan all targets through the probe engine and the scheduler.
+
+    :return: list of (host, port, completion time) tuples.
+    """
+    completed = []
+    done = threading.Event()
+    remaining = [len(targets)]
+    lock = threading.Lock()
+
+    def on_port(host, port, state):
+        completed.append((host, port, time.monotonic()))
+
+    def on_host(future, host):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    engine = ProbeEngine(
+        timeout=args.timeout, rate_limiter=RateLimiter(args.rate, args.rate),
+        socket_factory=responder.socket,
+        raw_socket_factory=None if args.scapy_packets else responder.raw_socket)
+    with engine, ScanScheduler(engine, max_in_flight=in_flight) as scheduler:
+        scheduler.submit_targets(
+            targets, lambda host: scanner_class(host, ports, engine), on_port, on_host)
+        done.wait()
+    return completed
+
+
+def run_sharded(responder, scanner_class, targets, ports, args, processes):
+    """
+    Scan all targets with worker processes, each with its own simulated network.
+
+    :return: list of (host, port, completion time) tuples.
+    """
+    completed = []
+    network = SimulatedNetwork(args.open, args.closed, args.rtt, args.jitter, args.loss,
+                               args.unreachable, args.seed)
+    ShardedScan(targets, ports, scanner_class, processes, args.rate, args.timeout,
+                socket_factory=network,
+                raw_socket_factory=None if args.scapy_packets else network.raw_socket).run(
+        lambda host, port, state: completed.append((host, port, time.monotonic())))
+    return completed
+
+
+def run_sr1(responder, scanner_class, targets, ports, args, workers):
+    """
+    Scan all targets one after another with one sr1() per port.
+
+    :return: list of (host, port, completion time) tuples.
+    """
+    completed = []
+    original_sr1, original_workers = scapy.layers.inet.sr1, src.scanner.MAX_WORKERS
+    scapy.layers.inet.sr1 = responder.sr1
+    src.scanner.MAX_WORKERS = workers
+    try:
+        for host in targets:
+            scanner_class(host, ports).port_scan(
+                lambda port, state, host=host: completed.append((host, port, time.monotonic())))
+    finally:
+        scapy.layers.inet.sr1 = original_sr1
+        src.scanner.MAX_WORKERS = original_workers
+    return completed
+
+
+def run_connect(responder, scanner_class, targets, ports, args, concurrency):
+    """
+    Scan all targets with a connect engine through a local SOCKS5 proxy
+    carrying at most concurrency connects at a time.
+
+    :return: list of (host, port, completion time) tuples.
+    """
+    completed = []
+    proxy = SimulatedSocksProxy(responder)
+    proxy.start()
+    engine = ConnectEngine(timeout=args.timeout, concurrency=concurrency,
+                           proxies=ProxyPool([SocksProxy(proxy.host, proxy.port,
+                                                         limit=concurrency)]))
+    try:
+        engine.run(targets, ports,
+                   lambda host, port, state: completed.append((host, port, time.monotonic())))
+    finally:
+        proxy.stop()
+    return completed
+
+
+def run_case(mode, scanner_class, concurrency, targets, ports, args, measure_memory):
+    """
+    Run one benchmark case against a fresh simulated network.
+
+    :return: dict with the measurements.
+    """
+    responder = SimulatedResponder(args.open, args.closed, args.rtt, args.jitter, args.loss,
+                                   args.unreachable, args.seed, args.syn_only)
+    responder.start()
+    run = {"engine": run_engine, "sharded": run_sharded, "sr1": run_sr1,
+           "connect": run_connect}[mode]
+    try:
+        if measure_memory:
+            tracemalloc.start()
+        start_time = time.monotonic()
+        completed = run(responder, scanner_class, targets, ports, args, concurrency)
+        elapsed = time.monotonic() - start_time
+        peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+        responder.stop()
+
+    latencies = sorted(finished - responder.first_sent[(host, port)]
+                       for host, port, finished in completed
+                       if (host, port) in responder.first_sent)
+    return {
+        "mode": mode,
+        "scanner": scanner_class.__name__,
+        "concurrency": concurrency,
+        "results": len(completed),
+        "probes": responder.probes,
+        "seconds": elapsed,
+        "probes_per_second": responder.probes / elapsed if elapsed else 0.0,
+        "results_per_second": len(completed) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_mean": statistics.fmean(latencies) if latencies else 0.0,
+        "peak_memory": peak,
+    }
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hosts", type=int, default=4, help="number of simulated hosts")
+    parser.add_argument("--ports", default="1-1000", help="port specification")
+    parser.add_argument("--open", type=float, default=0.05, help="fraction of open ports")
+    parser.add_argument("--closed", type=float, default=0.9, help="fraction of closed ports")
+    parser.add_argument("--rtt", type=float, default=0.005, help="round-trip time, seconds")
+    parser.add_argument("--jitter", type=float, default=0.002, help="RTT jitter, seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss probability")
+    parser.add_argument("--unreachable", type=float, default=0.0,
+                        help="probability that a filtered port answers with ICMP unreachable")
+    parser.add_argument("--syn-only", type=float, default=0.0,
+                        help="fraction of filtered ports whose filter only drops SYN packets")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help="maximum probe timeout of the engine, seconds")
+    parser.add_argument("--rate", type=float, default=100000, help="engine packets per second")
+    parser.add_argument("--in-flight", default="64,512",
+                        help="engine in-flight probe limits to compare")
+    parser.add_argument("--processes", default="",
+                        help="worker process counts to compare, empty to skip")
+    parser.add_argument("--workers", default="15",
+                        help="sr1() worker counts to compare, empty to skip the sr1() path")
+    parser.add_argument("--connect", default="",
+                        help="connect scanner concurrencies to compare, empty to skip")
+    parser.add_argument("--scanners", default="ACK,FIN,NULL,SYN", help="scan types to run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulated network")
+    parser.add_argument("--scapy-packets", action="store_true",
+                        help="build probes with scapy instead of packet templates")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="disable the scan metrics, to measure their overhead")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc pass measuring peak memory")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmark matrix and print a table."""
+    args = parse_args()
+    METRICS.enabled = not args.no_metrics
+    targets = TargetSet()
+    first = ip_to_int("10.0.0.1")
+    targets.add_range(first, first + args.hosts - 1)
+    ports = PortSet.parse(args.ports)
+    scanners = [cls for cls in SCANNER_CLASSES
+                if cls.__name__[:-len("Scanner")].upper() in args.scanners.upper().split(",")]
+
+    cases = [("engine", int(value)) for value in args.in_flight.split(",") if value]
+    cases += [("sharded", int(value)) for value in args.processes.split(",") if value]
+    cases += [("sr1", int(value)) for value in args.workers.split(",") if value]
+    cases += [("connect", int(value)) for value in args.connect.split(",") if value]
+
+    results = []
+    print(f"{'mode':<8}{'scanner':<13}{'conc':>6}{'probes/s':>11}{'results/s':>11}{'p50 ms':>9}"
+          f"{'p90 ms':>9}{'p99 ms':>9}{'peak KB':>10}")
+    for mode, concurrency in cases:
+        for scanner_class in [ConnectScanner] if mode == "connect" else scanners:
+            result = run_case(mode, scanner_class, concurrency, targets, ports, args, False)
+            if not args.no_memory:
+                result["peak_memory"] = run_case(
+                    mode, scanner_class, concurrency, targets, ports, args, True)["peak_memory"]
+            results.append(result)
+            peak = "-" if result["peak_memory"] is None else f"{result['peak_memory'] / 1024:.0f}"
+            print(f"{mode:<8}{result['scanner']:<13}{concurrency:>6}"
+                  f"{result['probes_per_second']:>11.0f}{result['results_per_second']:>11.0f}"
+                  f"{result['latency_p50'] * 1000:>9.1f}"
+                  f"{result['latency_p90'] * 1000:>9.1f}{result['latency_p99'] * 1000:>9.1f}"
+                  f"{peak:>10}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"arguments": vars(args), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
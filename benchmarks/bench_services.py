@@ -0,0 +1,88 @@
+"""
+Benchmark of service detection against local listener stand-ins. Identifies the
+services of the listeners one connection at a time, as a follow-up tool would,
+then through ServiceDetector, then again through the same detector to measure
+the scan served by its cache, and reports the wall time and correctness of each.
+
+Usage: python -m benchmarks.bench_services [--services 200] [--delay 0.005]
+"""
+
+import argparse
+import socket
+import time
+
+from benchmarks.simulator import LocalServices
+from src.services import ServiceDetector, ServiceInfo, HTTP_PROBE, BANNER_SIZE, identify
+
+
+def detect_serially(host, ports, timeout):
+    """
+    Identify services one port after the other with blocking sockets.
+
+    :param host: ip address of the listeners.
+    :param ports: ports to identify.
+    :param timeout: read timeout, seconds.
+    :return: dict of port -> ServiceInfo.
+    """
+    found = {}
+    for port in ports:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            try:
+                data = sock.recv(BANNER_SIZE)
+            except socket.timeout:
+                sock.sendall(HTTP_PROBE % host.encode())
+                try:
+                    data = sock.recv(BANNER_SIZE)
+                except socket.timeout:
+                    data = b""
+        found[port] = ServiceInfo(*identify(data)) if data else ServiceInfo("unknown")
+    return found
+
+
+def detect_pipelined(detector, host, ports):
+    """
+    Identify services through a ServiceDetector.
+
+    :return: dict of port -> ServiceInfo.
+    """
+    futures = {port: detector.submit(host, port) for port in ports}
+    return {port: future.result() for port, future in futures.items()}
+
+
+def main():
+    """Run each mode and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--services", type=int, default=200, help="number of listeners")
+    parser.add_argument("--delay", type=float, default=0.005,
+                        help="delay of the listeners before answering, seconds")
+    parser.add_argument("--read-timeout", type=float, default=0.5,
+                        help="read timeout of both modes, seconds")
+    parser.add_argument("--host-limit", type=int, default=64,
+                        help="connections at a time of the detector to the host")
+    args = parser.parse_args()
+
+    services = LocalServices(args.services, args.delay)
+    services.start()
+    detector = ServiceDetector(host_limit=args.host_limit, read_timeout=args.read_timeout)
+    detector.start()
+    try:
+        print(f"{'mode':<12}{'seconds':>9}{'connections':>13}{'wrong':>7}")
+        for mode in ("serial", "pipelined", "cached"):
+            connections = services.connections
+            start_time = time.perf_counter()
+            if mode == "serial":
+                found = detect_serially(services.host, services.ports, args.read_timeout)
+            else:
+                found = detect_pipelined(detector, services.host, services.ports)
+            elapsed = time.perf_counter() - start_time
+            wrong = sum(found[port].name != name for port, name in services.expected.items())
+            print(f"{mode:<12}{elapsed:>9.3f}{services.connections - connections:>13}"
+                  f"{wrong:>7}")
+        print(f"most connections at a time: {services.max_active}")
+    finally:
+        detector.stop(wait=False)
+        services.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Cold start benchmark of the command line interface. Runs each command in a fresh
+interpreter several times and reports the median and minimum wall time, next to
+an empty interpreter as the baseline.
+
+Usage: python -m benchmarks.bench_startup [--runs 10]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = (
+    ("python", [sys.executable, "-c", "pass"]),
+    ("import src.scanner", [sys.executable, "-c", "import src.scanner"]),
+    ("python -m src --help", [sys.executable, "-m", "src", "--help"]),
+    ("parse 10.0.0.0/8", [sys.executable, "-c",
+                          "from src.cli import parse_args; "
+                          "parse_args(['10.0.0.0/8', '-p', 'all'])"]),
+)
+
+
+def measure(command, runs):
+    """
+    Run a command several times.
+
+    :param command: argument list.
+    :param runs: number of runs.
+    :return: list of wall times in seconds.
+    """
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def main():
+    """Measure every command and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="runs of each command")
+    args = parser.parse_args()
+
+    print(f"{'command':<24}{'median ms':>11}{'min ms':>9}")
+    for name, command in COMMANDS:
+        times = measure(command, args.runs)
+        print(f"{name:<24}{statistics.median(times) * 1000:>11.1f}{min(times) * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""Module providing a simulated scan target for offline benchmarks."""
+
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from scapy.compat import raw
+from scapy.layers.inet import IP, TCP, ICMP
+
+PROBE_HEADER = struct.Struct("!12x4s4sHHIIxB")
+
+
+class SimulatedResponder:
+    """
+    Simulated network of targets answering TCP probes like a real stack would.
+    The state of each (host, port) is drawn from the open/closed fractions
+    (the rest is filtered), replies come back after rtt +- jitter seconds,
+    probes and replies are lost with probability loss, and filtered ports
+    answer with ICMP administratively prohibited with probability unreachable.
+    A syn_only fraction of the filtered ports is behind a filter that only drops
+    connection requests (SYN packets), other probes reaching the port as if it
+    were closed.
+    """
+
+    def __init__(self, open_fraction=0.05, closed_fraction=0.9, rtt=0.005, jitter=0.002,
+                 loss=0.0, unreachable=0.0, seed=0, syn_only=0.0):
+        self.open_fraction = open_fraction
+        self.closed_fraction = closed_fraction
+        self.rtt = rtt
+        self.jitter = jitter
+        self.loss = loss
+        self.unreachable = unreachable
+        self.seed = seed
+        self.syn_only = syn_only
+        self.first_sent = {}
+        self.probes = 0
+        self.receiver = None
+        self._random = random.Random(seed)
+        self._events = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Start the thread delivering delayed replies."""
+        self._running = True
+        self._thread = threading.Thread(target=self._deliver_loop, name="responder",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the delivery thread, pending replies are dropped."""
+        with self._condition:
+            self._running = False
+            self._events = []
+            self._condition.notify_all()
+        self._thread.join()
+
+    def port_state(self, host, port):
+        """
+        Returns the simulated state of a port.
+
+        :param host: ip address of the target.
+        :param port: port number.
+        :return: "open", "closed" or "filtered".
+        """
+        digest = hashlib.blake2b(f"{self.seed}:{host}:{port}".encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "big") / 2 ** 64
+        if value < self.open_fraction:
+            return "open"
+        if value < self.open_fraction + self.closed_fraction:
+            return "closed"
+        return "filtered"
+
+    def filters_syn_only(self, host, port):
+        """
+        Returns True if the filter of a filtered port only drops SYN packets.
+
+        :param host: ip address of the target.
+        :param port: port number.
+        """
+        digest = hashlib.blake2b(f"{self.seed}:syn:{host}:{port}".encode(),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64 < self.syn_only
+
+    def reply(self, packet):
+        """
+        Build the reply a target would send to a probe.
+
+        :param packet: IP/TCP probe, as a scapy packet or serialized.
+        :return: serialized IP reply or None if the target stays silent.
+        """
+        data = packet if isinstance(packet, (bytes, bytearray)) else raw(packet)
+        source, destination, sport, dport, seq, ack, flags = PROBE_HEADER.unpack_from(data)
+        source, destination = socket.inet_ntoa(source), socket.inet_ntoa(destination)
+        state = self.port_state(destination, dport)
+        if state == "filtered" and not flags & 0x02 and \
+                self.filters_syn_only(destination, dport):
+            state = "closed"
+        header = IP(src=destination, dst=source)
+
+        if state == "filtered":
+            if self._random.random() >= self.unreachable:
+                return None
+            reply = header / ICMP(type=3, code=13) / bytes(data[:28])
+        elif flags & 0x10:
+            reply = header / TCP(sport=dport, dport=sport, flags="R", seq=ack)
+        elif state == "open":
+            if not flags & 0x02:
+                return None
+            reply = header / TCP(sport=dport, dport=sport, flags="SA",
+                                 seq=self._random.getrandbits(32), ack=(seq + 1) & 0xFFFFFFFF)
+        else:
+            consumed = 1 if flags & 0x03 else 0
+            reply = header / TCP(sport=dport, dport=sport, flags="RA",
+                                 ack=(seq + consumed) & 0xFFFFFFFF)
+        return raw(reply)
+
+    def handle(self, packet, deliver):
+        """
+        Receive a probe and schedule its reply.
+
+        :param packet: IP/TCP probe, as a scapy packet or serialized.
+        :param deliver: called with the serialized reply once the simulated RTT has passed.
+        :return: delay of the reply in seconds, or None if there is no reply.
+        """
+        if not isinstance(packet, (bytes, bytearray)):
+            packet = raw(packet)
+        destination, dport = PROBE_HEADER.unpack_from(packet)[1:4:2]
+        key = (socket.inet_ntoa(destination), dport)
+        with self._condition:
+            self.probes += 1
+            self.first_sent.setdefault(key, time.monotonic())
+            lost = self._random.random() < self.loss or self._random.random() < self.loss
+            delay = max(0.0, self.rtt + self._random.uniform(-self.jitter, self.jitter))
+        if lost:
+            return None
+        reply = self.reply(packet)
+        if reply is None:
+            return None
+        with self._condition:
+            heapq.heappush(self._events,
+                           (time.monotonic() + delay, next(self._counter), deliver, reply))
+            self._condition.notify_all()
+        return delay
+
+    def sr1(self, packet, timeout=None, **kwargs):
+        """
+        Drop-in replacement of scapy sr1() answering from the simulated network.
+
+        :param packet: IP/TCP probe.
+        :param timeout: seconds to wait for a reply.
+        :return: reply or None.
+        """
+        replies = []
+        delay = self.handle(packet, replies.append)
+        if delay is None or (timeout is not None and delay > timeout):
+            time.sleep(timeout or 0)
+            return None
+        time.sleep(delay)
+        deadline = time.monotonic() + 1
+        while not replies and time.monotonic() < deadline:
+            time.sleep(0.0005)
+        return IP(replies[0]) if replies else None
+
+    def socket(self, iface=None):
+        """
+        Socket factory for ProbeEngine(socket_factory=...).
+
+        :param iface: ignored.
+        :return: SimulatedSocket.
+        """
+        return SimulatedSocket(self)
+
+    def raw_socket(self, iface=None):
+        """
+        Raw socket factory for ProbeEngine(raw_socket_factory=...). Replies are received
+        by the last socket created by socket().
+
+        :param iface: ignored.
+        :return: SimulatedRawSocket.
+        """
+        return SimulatedRawSocket(self)
+
+    def _deliver_loop(self):
+        while True:
+            with self._condition:
+                while self._running and (
+                        not self._events or self._events[0][0] > time.monotonic()):
+                    timeout = self._events[0][0] - time.monotonic() if self._events else None
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                _, _, deliver, reply = heapq.heappop(self._events)
+            deliver(reply)
+
+
+class SimulatedNetwork:
+    """
+    Picklable socket factory for ProbeEngine(socket_factory=...) in worker processes.
+    Every process gets its own SimulatedResponder built from the same arguments,
+    so all processes see the same port states.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self._responder = None
+
+    def __call__(self, iface=None):
+        return self._start().socket(iface)
+
+    def __getstate__(self):
+        return {"args": self.args, "kwargs": self.kwargs, "_responder": None}
+
+    def raw_socket(self, iface=None):
+        """
+        Raw socket factory for ProbeEngine(raw_socket_factory=...), sending to the
+        responder of the sockets created by calling this object. The probe engine
+        opens its raw socket first.
+
+        :param iface: ignored.
+        :return: SimulatedRawSocket.
+        """
+        return self._start().raw_socket(iface)
+
+    def _start(self):
+        """
+        Returns the responder of this process, started on first use.
+
+        :return: SimulatedResponder.
+        """
+        if self._responder is None:
+            self._responder = SimulatedResponder(*self.args, **self.kwargs)
+            self._responder.start()
+        return self._responder
+
+
+class SimulatedSocket:
+    """Scapy-like L3 socket connected to a SimulatedResponder."""
+
+    def __init__(self, responder):
+        self.responder = responder
+        responder.receiver = self
+        self._replies = collections.deque()
+        self._read_fd, self._write_fd = os.pipe()
+
+    def fileno(self):
+        """File descriptor that is readable while replies are waiting."""
+        return self._read_fd
+
+    def send(self, packet):
+        """
+        Send a probe to the simulated network.
+
+        :param packet: IP/TCP probe.
+        """
+        self.responder.handle(packet, self._deliver)
+
+    def recv(self, x=None):
+        """
+        Returns the next reply. Must only be called when fileno() is readable.
+
+        :return: bytes of the IP packet.
+        """
+        os.read(self._read_fd, 1)
+        return self._replies.popleft()
+
+    def close(self):
+        """Close the socket."""
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _deliver(self, reply):
+        self._replies.append(reply)
+        try:
+            os.write(self._write_fd, b"\0")
+        except OSError:
+            pass
+
+
+class SimulatedRawSocket:
+    """Raw IPv4 socket sending serialized probes to a SimulatedResponder."""
+
+    def __init__(self, responder):
+        self.responder = responder
+
+    def sendto(self, packet, address):
+        """
+        Send a serialized probe to the simulated network.
+
+        :param packet: bytes-like IPv4 packet.
+        :param address: (host, port) pair, ignored.
+        :return: number of bytes sent.
+        """
+        self.responder.handle(bytes(packet), self.responder.receiver._deliver)
+        return len(packet)
+
+    def close(self):
+        """Close the socket."""
+
+
+class SimulatedSocksProxy:
+    """
+    Local SOCKS5 proxy (RFC 1928, with the username/password method of RFC 1929
+    if username is set) answering CONNECT requests from a SimulatedResponder:
+    open ports succeed and closed ports are refused after rtt +- jitter seconds,
+    filtered ports get no reply. Destinations given as domain names are answered
+    as if they were the address 10.0.0.1. Runs its own event loop in a thread.
+    """
+
+    def __init__(self, responder, host="127.0.0.1", port=0, username=None, password=None):
+        self.responder = responder
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sessions = 0
+        self.requests = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        """Start listening, self.port is the listening port afterwards."""
+        self._thread = threading.Thread(target=self._run, name="socks-proxy", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stop listening and close the sessions."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=4096))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._server.close()
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+    async def _handle(self, reader, writer):
+        self.sessions += 1
+        try:
+            version, count = await reader.readexactly(2)
+            methods = await reader.readexactly(count)
+            method = 0 if self.username is None else 2
+            if version != 5 or method not in methods:
+                writer.write(b"\x05\xff")
+                return
+            writer.write(bytes([5, method]))
+            if method == 2:
+                _, size = await reader.readexactly(2)
+                username = await reader.readexactly(size)
+                size, = await reader.readexactly(1)
+                password = await reader.readexactly(size)
+                valid = (username.decode(), password.decode()) == (self.username, self.password)
+                writer.write(bytes([1, 0 if valid else 1]))
+                if not valid:
+                    return
+            _, command, _, address_type = await reader.readexactly(4)
+            if address_type == 1:
+                host = socket.inet_ntoa(await reader.readexactly(4))
+            else:
+                size, = await reader.readexactly(1)
+                await reader.readexactly(size)
+                host = "10.0.0.1"
+            port, = struct.unpack("!H", await reader.readexactly(2))
+            self.requests += 1
+            key = (host, port)
+            with self.responder._condition:
+                self.responder.probes += 1
+                self.responder.first_sent.setdefault(key, time.monotonic())
+            state = self.responder.port_state(host, port)
+            if command != 1 or state == "filtered":
+                await reader.read()
+                return
+            rtt, jitter = self.responder.rtt, self.responder.jitter
+            await asyncio.sleep(max(0.0, rtt + random.uniform(-jitter, jitter)))
+            writer.write(bytes([5, 0 if state == "open" else 5, 0, 1, 0, 0, 0, 0, 0, 0]))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class LocalServices:
+    """
+    Local TCP listeners standing in for the services of open ports. Listener i
+    plays SERVICES[i % len(SERVICES)]: it sends its banner after delay seconds,
+    or answers the first request if the service waits for the client, and a
+    silent service sends nothing. connections counts the accepted connections
+    and max_active the most open at a time. Runs its own event loop in a thread.
+    """
+
+    SERVICES = (
+        ("ssh", b"SSH-2.0-OpenSSH_9.6\r\n", True),
+        ("smtp", b"220 mail.example.com ESMTP Postfix\r\n", True),
+        ("ftp", b"220 (vsFTPd 3.0.5) FTP server ready\r\n", True),
+        ("http", b"HTTP/1.1 200 OK\r\nServer: nginx/1.24.0\r\nContent-Length: 0\r\n\r\n", False),
+        ("unknown", b"", False),
+    )
+
+    def __init__(self, count, delay=0.005, host="127.0.0.1"):
+        self.count = count
+        self.delay = delay
+        self.host = host
+        self.ports = []
+        self.expected = {}
+        self.connections = 0
+        self.max_active = 0
+        self._active = 0
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        """Start listening, self.ports are the listening ports afterwards."""
+        self._thread = threading.Thread(target=self._run, name="local-services", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stop listening and close the connections."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        servers = []
+        for index in range(self.count):
+            name, banner, server_first = self.SERVICES[index % len(self.SERVICES)]
+            server = self._loop.run_until_complete(asyncio.start_server(
+                lambda reader, writer, banner=banner, server_first=server_first:
+                self._handle(reader, writer, banner, server_first), self.host, 0))
+            port = server.sockets[0].getsockname()[1]
+            servers.append(server)
+            self.ports.append(port)
+            self.expected[port] = name
+        self._ready.set()
+        self._loop.run_forever()
+        for server in servers:
+            server.close()
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+    async def _handle(self, reader, writer, banner, server_first):
+        self.connections += 1
+        self._active += 1
+        self.max_active = max(self.max_active, self._active)
+        try:
+            if not server_first:
+                await reader.read(1024)
+            await asyncio.sleep(self.delay)
+            if banner:
+                writer.write(banner)
+                await writer.drain()
+            await reader.read()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._active -= 1
+            writer.close()
@@ -1,4 +1,47 @@
-SOCKS_PORT = 9050
-SOCKS_IP = '127.0.0.1'
+import os
+
 MAX_WORKERS = 15
+MAX_PORTS_IN_FLIGHT = 30
 TIMEOUT = 10
+MAX_PROBES_IN_FLIGHT = 512
+MAX_PROBES_PER_HOST = 32
+MIN_RTT_TIMEOUT = 0.1
+INITIAL_RTT_TIMEOUT = 1
+MAX_RETRIES = 2
+MAX_RATE = 1000
+MIN_RATE = 10
+DATABASE_URL = 'sqlite:///scans.db'
+DATABASE_BATCH_SIZE = 5000
+MAX_ACTIVE_HOSTS = 256
+RANDOMIZE_TARGETS = True
+PORTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ports.txt')
+METRICS_FILE = None
+METRICS_INTERVAL = 5
+SCAN_PROCESSES = 1
+RESOLVER_WORKERS = 32
+DNS_CACHE_SIZE = 10000
+DNS_CACHE_TTL = 300
+DNS_NEGATIVE_TTL = 30
+HOST_DISCOVERY = True
+DISCOVERY_PORTS = (22, 80, 443, 3389)
+ARP_TIMEOUT = 1
+ARP_BATCH_SIZE = 256
+CHECKPOINT_FILE = None
+CHECKPOINT_INTERVAL = 30
+SOCKS_PROXIES = []
+SOCKS_PROXY_LIMIT = 64
+SOCKS_SPARE_SESSIONS = 8
+CONNECT_TIMEOUT = 3
+CONNECT_CONCURRENCY = 2000
+EXPORT_FILE = None
+EXPORT_BUFFER_SIZE = 1 << 20
+RESCAN_SAMPLE_RATE = 0.1
+SERVICE_DETECTION = False
+SERVICE_CONCURRENCY = 200
+SERVICE_HOST_LIMIT = 8
+SERVICE_CONNECT_TIMEOUT = 3
+SERVICE_READ_TIMEOUT = 2
+SERVICE_CACHE_SIZE = 100000
+SERVICE_CACHE_TTL = 86400
+SERVICE_CACHE_FILE = None
+COMBINED_SCAN_FLAGS = ("S", "A", "F", "")
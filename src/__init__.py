@@ -1,26 +1,28 @@
-from . import scanner
-from . import mainwindow
-from . import utils
+import importlib
 
 
 __doc__ = "Проект сканирования портов с использованием GTK."
 
-
-class MainWindow(mainwindow.MainWindow):
-    pass
-
-
-class Scanner(scanner.Scanner):
-    pass
-
-
-class HostNotSpecifiedException(utils.HostNotSpecifiedException):
-    pass
-
-
-class ScanErrorException(utils.ScanErrorException):
-    pass
-
-
-class CustomPortsNotSpecifiedException(utils.CustomPortsNotSpecifiedException):
-    pass
+_EXPORTS = {
+    "MainWindow": "mainwindow",
+    "Scanner": "scanner",
+    "HostNotSpecifiedException": "utils",
+    "ScanErrorException": "utils",
+    "CustomPortsNotSpecifiedException": "utils",
+}
+
+
+def __getattr__(name):
+    """
+    Import the module of an exported name on first access, so that importing
+    the package does not import GTK or scapy.
+
+    :param name: exported name.
+    :return: exported class.
+    """
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,176 @@
+"""Module providing the BPF-filtered receive socket of the probe engine."""
+
+import ctypes
+import socket
+import struct
+
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+RECV_SIZE = 65535
+MAX_FILTER_RANGES = 32
+
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xB1
+BPF_JEQ = 0x15
+BPF_JGT = 0x25
+BPF_JGE = 0x35
+BPF_JSET = 0x45
+BPF_RET = 0x06
+
+BPF_INSTRUCTION = struct.Struct("=HBBI")
+TCP_REPLY = struct.Struct("!HHII")
+QUOTED_TCP = struct.Struct("!HHI")
+ECHO_REPLY = struct.Struct("!HH")
+ICMP_HEADER_SIZE = 8
+
+
+def compile_filter(sport_base, sport_range, address_ranges=None):
+    """
+    Compile the classic BPF program of a scan, for sockets without link-layer header.
+    It accepts unfragmented TCP packets to a port in [sport_base, sport_base + sport_range),
+    sent from one of address_ranges if given, and ICMP destination unreachable and echo
+    reply messages.
+
+    :param sport_base: first source port of the probes.
+    :param sport_range: number of source ports of the probes.
+    :param address_ranges: inclusive (first, last) IPv4 ranges as integers, None for any.
+    :return: list of (code, jt, jf, k) instructions.
+    """
+    program = []
+
+    def emit(code, k=0, jt=None, jf=None):
+        program.append([code, jt, jf, k])
+
+    emit(BPF_LD_B_ABS, 9)
+    emit(BPF_JEQ, socket.IPPROTO_TCP, jt="tcp", jf="next")
+    emit(BPF_JEQ, socket.IPPROTO_ICMP, jt="icmp", jf="reject")
+    labels = {"tcp": len(program)}
+    emit(BPF_LD_H_ABS, 6)
+    emit(BPF_JSET, 0x1FFF, jt="reject", jf="next")
+    if address_ranges:
+        emit(BPF_LD_W_ABS, 12)
+        for index, (first, last) in enumerate(address_ranges):
+            miss = f"range{index + 1}" if index + 1 < len(address_ranges) else "reject"
+            labels[f"range{index}"] = len(program)
+            emit(BPF_JGE, first, jt="next", jf=miss)
+            emit(BPF_JGT, last, jt=miss, jf="ports")
+        labels["ports"] = len(program)
+    emit(BPF_LDX_B_MSH, 0)
+    emit(BPF_LD_H_IND, 2)
+    emit(BPF_JGE, sport_base, jt="next", jf="reject")
+    emit(BPF_JGE, sport_base + sport_range, jt="reject", jf="accept")
+    labels["icmp"] = len(program)
+    emit(BPF_LDX_B_MSH, 0)
+    emit(BPF_LD_B_IND, 0)
+    emit(BPF_JEQ, 3, jt="accept", jf="next")
+    emit(BPF_JEQ, 0, jt="accept", jf="reject")
+    labels["accept"] = len(program)
+    emit(BPF_RET, RECV_SIZE)
+    labels["reject"] = len(program)
+    emit(BPF_RET, 0)
+
+    instructions = []
+    for position, (code, jt, jf, k) in enumerate(program):
+        offsets = [0 if label in (None, "next") else labels[label] - position - 1
+                   for label in (jt, jf)]
+        instructions.append((code, offsets[0], offsets[1], k))
+    return instructions
+
+
+def attach_filter(sock, instructions):
+    """
+    Attach a classic BPF program to a socket, replacing the previous one.
+
+    :param sock: socket.socket.
+    :param instructions: list of (code, jt, jf, k), see compile_filter().
+    """
+    code = b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in instructions)
+    buffer = ctypes.create_string_buffer(code, len(code))
+    program = struct.pack("HL", len(instructions), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, program)
+
+
+class CaptureSocket:
+    """
+    Packet socket receiving IPv4 packets without link-layer header on one interface,
+    or all of them, filtered in the kernel by a BPF program. Packets sent by this host
+    are skipped, so only replies reach the engine.
+    """
+
+    def __init__(self, iface=None, instructions=None):
+        self.iface = iface
+        self._socket = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM,
+                                     socket.htons(ETH_P_IP))
+        try:
+            if instructions is not None:
+                attach_filter(self._socket, instructions)
+            if iface is not None:
+                self._socket.bind((str(iface), ETH_P_IP))
+        except OSError:
+            self._socket.close()
+            raise
+
+    def fileno(self):
+        """File descriptor of the socket, for select()."""
+        return self._socket.fileno()
+
+    def set_filter(self, instructions):
+        """
+        Replace the BPF program of the socket.
+
+        :param instructions: list of (code, jt, jf, k), see compile_filter().
+        """
+        attach_filter(self._socket, instructions)
+
+    def recv(self, size=RECV_SIZE):
+        """
+        Returns the next received packet.
+
+        :param size: maximum packet size.
+        :return: bytes of the IPv4 packet, or None for a packet sent by this host.
+        """
+        data, address = self._socket.recvfrom(size)
+        if address[2] == PACKET_OUTGOING:
+            return None
+        return data
+
+    def close(self):
+        """Close the socket."""
+        self._socket.close()
+
+
+def reply_key(data):
+    """
+    Parse the addresses of a reply to a TCP or ICMP echo probe without dissecting
+    the whole packet.
+
+    :param data: bytes of an IPv4 packet.
+    :return: tuple of the (host, dport, sport) key of the probe, the sequence number
+        of the reply or of the quoted probe, the acknowledgement number of the reply
+        (None for ICMP), or None if the packet is not a reply. Echo replies have
+        the key (host, 0, identifier).
+    """
+    try:
+        header_size = (data[0] & 0x0F) * 4
+        protocol = data[9]
+        if protocol == socket.IPPROTO_TCP:
+            sport, dport, seq, ack = TCP_REPLY.unpack_from(data, header_size)
+            return (socket.inet_ntoa(data[12:16]), sport, dport), seq, ack
+        if protocol == socket.IPPROTO_ICMP and data[header_size] == 0:
+            ident, seq = ECHO_REPLY.unpack_from(data, header_size + 4)
+            return (socket.inet_ntoa(data[12:16]), 0, ident), seq, None
+        if protocol == socket.IPPROTO_ICMP and data[header_size] == 3:
+            quoted = header_size + ICMP_HEADER_SIZE
+            if data[quoted + 9] != socket.IPPROTO_TCP:
+                return None
+            quoted_tcp = quoted + (data[quoted] & 0x0F) * 4
+            sport, dport, seq = QUOTED_TCP.unpack_from(data, quoted_tcp)
+            return (socket.inet_ntoa(data[quoted + 16:quoted + 20]), dport, sport), seq, None
+    except (IndexError, struct.error):
+        pass
+    return None
@@ -0,0 +1,488 @@
+"""
+Module providing the command line interface. It does not import GTK, and scapy
+and SQLAlchemy are imported only when a scan or the result store needs them,
+so short scans start quickly.
+
+Usage: python -m src HOSTS [-p PORTS] [-s {ACK,COMBINED,CONNECT,FIN,NULL,SYN}] [-o FILE]
+       [--all-states] [--store] [--rate PPS] [--timeout SECONDS] [--processes N] [--metrics FILE]
+       [--no-discovery] [--checkpoint FILE] [--concurrency N]
+       [--export FILE] [--export-format {jsonl,csv,binary}] [--compress]
+       [--baseline FILE] [--sample-rate FRACTION] [--services] [--service-cache FILE]
+       python -m src --resume FILE [-o FILE] [--all-states] [--store] [--rate PPS] ...
+"""
+
+import argparse
+import functools
+import sys
+import threading
+from concurrent.futures import Future
+
+from config import TIMEOUT, MAX_RATE, MIN_RATE, SCAN_PROCESSES, \
+    HOST_DISCOVERY, CONNECT_TIMEOUT, CONNECT_CONCURRENCY, RESCAN_SAMPLE_RATE, \
+    SERVICE_DETECTION, SERVICE_CACHE_FILE
+from src.metrics import METRICS, MetricsWriter
+from src.ports import PortSet
+from src.resolver import RESOLVER
+from src.results import PortState, REPORTED_STATES
+from src.scanner import ACKScanner, CombinedScanner, ConnectScanner, FINScanner, NULLScanner, \
+    SYNScanner
+from src.targets import TargetSet
+from src.utils import HostInputErrorException, PortInputErrorException, \
+    ProbeEngineErrorException, ScanErrorException, InsertDatabaseErrorException
+
+SCANNER_CLASSES = {
+    "ACK": ACKScanner,
+    "COMBINED": CombinedScanner,
+    "CONNECT": ConnectScanner,
+    "FIN": FINScanner,
+    "NULL": NULLScanner,
+    "SYN": SYNScanner,
+}
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments.
+
+    :param argv: arguments, sys.argv[1:] by default.
+    :return: argparse.Namespace.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m src", description="Scan the ports of hosts without the GUI.")
+    parser.add_argument("hosts", nargs="?", help='hosts, e.g. "127.0.0.1, 192.168.0.2-192.168.0.4, '
+                                      '10.0.0.0/24, localhost"')
+    parser.add_argument("-p", "--ports", default="default",
+                        help='ports, e.g. "default,8000-8100,!8080" (default: %(default)s)')
+    parser.add_argument("-s", "--scan-type", default="SYN", choices=SCANNER_CLASSES,
+                        type=str.upper, help="scan type (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("--all-states", action="store_true",
+                        help="report ports in every state, not only open and filtered ones")
+    parser.add_argument("--store", action="store_true",
+                        help="also save the results to the result store")
+    parser.add_argument("--rate", type=float, default=MAX_RATE,
+                        help="maximum packets per second (default: %(default)s)")
+    parser.add_argument("--timeout", type=float,
+                        help=f"maximum probe timeout, seconds (default: {TIMEOUT}, "
+                             f"{CONNECT_TIMEOUT} for CONNECT)")
+    parser.add_argument("--processes", type=int, default=SCAN_PROCESSES,
+                        help="worker processes to spread the scan over (default: %(default)s)")
+    parser.add_argument("--metrics", help="append snapshots of the scan metrics to this file")
+    parser.add_argument("--no-discovery", dest="discovery", action="store_false",
+                        default=HOST_DISCOVERY,
+                        help="scan the ports of every target, even of hosts that seem down")
+    parser.add_argument("--checkpoint",
+                        help="save the progress of the scan to this file, see --resume")
+    parser.add_argument("--resume", help="continue the scan saved in this checkpoint file")
+    parser.add_argument("--concurrency", type=int, default=CONNECT_CONCURRENCY,
+                        help="maximum connects at a time for CONNECT (default: %(default)s)")
+    parser.add_argument("--export",
+                        help="also stream the reported results to this file")
+    parser.add_argument("--export-format", choices=("jsonl", "csv", "binary"),
+                        help="format of the export file (default: by its extension, "
+                             ".jsonl, .csv, else binary)")
+    parser.add_argument("--compress", action="store_true", default=None,
+                        help="gzip the export file (default: if its name ends with .gz)")
+    parser.add_argument("--baseline",
+                        help="rescan against this binary export of an earlier scan "
+                             "and report only the ports whose state changed")
+    parser.add_argument("--sample-rate", type=float, default=RESCAN_SAMPLE_RATE,
+                        help="fraction of the closed and filtered ports of the baseline "
+                             "that are probed again (default: %(default)s)")
+    parser.add_argument("--services", action="store_true", default=SERVICE_DETECTION,
+                        help="identify the service of each open port by its banner")
+    parser.add_argument("--service-cache", default=SERVICE_CACHE_FILE,
+                        help="reuse the services found by earlier scans from this file "
+                             "and save them to it, see --services")
+    args = parser.parse_args(argv)
+
+    args.saved = None
+    if (args.checkpoint or args.resume) and args.processes > 1:
+        parser.error("--checkpoint and --resume need --processes 1")
+    if args.scan_type == "CONNECT" and (args.checkpoint or args.processes > 1):
+        parser.error("--checkpoint and --processes are not supported by CONNECT")
+    if args.baseline and (args.checkpoint or args.resume or args.processes > 1):
+        parser.error("--baseline does not support --checkpoint, --resume and --processes")
+    if not 0 <= args.sample_rate <= 1:
+        parser.error("--sample-rate must be between 0 and 1")
+    if args.timeout is None:
+        args.timeout = CONNECT_TIMEOUT if args.scan_type == "CONNECT" else TIMEOUT
+    if args.resume:
+        from src.jobs import read_checkpoint
+
+        try:
+            args.targets, args.port_set, scanner_class, *args.saved = \
+                read_checkpoint(args.resume)
+        except (OSError, ScanErrorException) as error:
+            parser.error(str(error))
+        args.scan_type = next(name for name, value in SCANNER_CLASSES.items()
+                              if value is scanner_class)
+        args.checkpoint = args.resume
+        args.discovery = False
+        return args
+
+    if args.hosts is None:
+        parser.error("the following arguments are required: hosts")
+    try:
+        args.targets = TargetSet.parse(args.hosts)
+        args.port_set = PortSet.parse(args.ports)
+    except (HostInputErrorException, PortInputErrorException) as error:
+        parser.error(str(error))
+    if not args.targets:
+        parser.error("Host is not specified")
+    if not args.port_set:
+        parser.error("Ports are not specified")
+    return args
+
+
+class Reporter:
+    """
+    Writes the result of each port as "host<TAB>port<TAB>state" lines, and to
+    the exporter if set. rtt, if set, is called as rtt(host) for the round-trip
+    time of exported records. If diff is set to a DifferentialScan, only ports
+    whose state changed are written, as "host<TAB>port<TAB>old -> new" lines,
+    and every result is exported, with the baseline states of the ports that
+    were not probed, so that the export is the baseline of the next rescan.
+    If services is set to a ServiceDetector, open ports are written once their
+    service is identified, with "<TAB>service banner" appended.
+    """
+
+    def __init__(self, output, all_states=False, store=None, run_id=None, scan_type=None,
+                 exporter=None):
+        self.output = output
+        self.all_states = all_states
+        self.store = store
+        self.run_id = run_id
+        self.scan_type = scan_type
+        self.exporter = exporter
+        self.rtt = None
+        self.diff = None
+        self.services = None
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def port(self, host, port, state):
+        """
+        Report the result of one port.
+
+        :param host: ip address or domain name that was scanned.
+        :param port: scanned port.
+        :param state: PortState of the port.
+        """
+        if self.store is not None:
+            self.store.add(self.run_id, self.scan_type, host, port, state)
+        if self.diff is not None:
+            old = self.diff.change(host, port, state)
+            if old is not None:
+                self.write(host, port, state, f"{host}\t{port}\t{old.label} -> {state.label}")
+            self.export(host, port, state)
+            return
+        if self.all_states or state in REPORTED_STATES:
+            self.write(host, port, state, f"{host}\t{port}\t{state.label}")
+            self.export(host, port, state)
+
+    def write(self, host, port, state, line):
+        """
+        Write one line of output, once the service of the port is identified if
+        it is open and services is set.
+
+        :param host: ip address or domain name that was scanned.
+        :param port: scanned port.
+        :param state: PortState of the port.
+        :param line: text of the line.
+        """
+        if self.services is not None and state == PortState.OPEN:
+            self.services.submit(host, port).add_done_callback(
+                lambda future: self._write_service(future, line))
+            return
+        with self._lock:
+            self.output.write(line + "\n")
+
+    def _write_service(self, future, line):
+        if not future.cancelled() and future.exception() is None:
+            line = f"{line}\t{future.result()}"
+        with self._lock:
+            self.output.write(line + "\n")
+
+    def export(self, host, port, state, rtt=True):
+        """
+        Export the result of one port if there is an exporter.
+
+        :param host: ip address or domain name that was scanned.
+        :param port: scanned port.
+        :param state: PortState of the port.
+        :param rtt: False to leave the round-trip time out.
+        """
+        if self.exporter is not None:
+            self.exporter.add(host, port, state, self.scan_type,
+                              self.rtt(host) if rtt and self.rtt is not None else None)
+
+    def host(self, future, host):
+        """
+        Report the end of the scan of a host, see ScanScheduler.submit_targets().
+
+        :param future: future resolved with the HostResult of the host.
+        :param host: ip address or domain name.
+        """
+        error = future.exception()
+        if error is not None:
+            self.error(host, error)
+        elif self.diff is not None:
+            for port, state in self.diff.carried(future.result()):
+                self.export(host, port, state, rtt=False)
+
+    def error(self, host, error):
+        """
+        Report a host that could not be scanned.
+
+        :param host: ip address or domain name.
+        :param error: exception.
+        """
+        with self._lock:
+            self.errors += 1
+        print(f"{host}: error: {error}", file=sys.stderr)
+
+
+def discover_hosts(args, engine):
+    """
+    Find the targets that are up, see HostDiscovery.
+
+    :param args: parsed arguments.
+    :param engine: started ProbeEngine.
+    :return: TargetSet of the targets to scan.
+    """
+    from src.discovery import HostDiscovery
+
+    live = HostDiscovery(engine).run(args.targets)
+    down = len(args.targets) - len(live)
+    if down:
+        print(f"{down} of {len(args.targets)} hosts seem down, "
+              f"use --no-discovery to scan them", file=sys.stderr)
+    return live
+
+
+def scan_with_engine(args, scanner_class, reporter):
+    """
+    Scan all targets as a ScanJob through one probe engine, after host discovery
+    unless it is turned off. Interrupting the scan cancels the job, whose progress
+    is kept in args.checkpoint if set.
+
+    :param args: parsed arguments.
+    :param scanner_class: PortScanner subclass.
+    :param reporter: Reporter.
+    :return: False if the probe engine could not be started.
+    """
+    from src.engine import ProbeEngine
+    from src.jobs import ScanJob
+    from src.ratelimit import RateLimiter
+
+    engine = ProbeEngine(timeout=args.timeout,
+                         rate_limiter=RateLimiter(args.rate, min(MIN_RATE, args.rate)),
+                         targets=args.targets)
+    try:
+        engine.start()
+    except ProbeEngineErrorException:
+        return False
+
+    hosts = discover_hosts(args, engine) if args.discovery else args.targets
+    RESOLVER.prefetch(hosts.domains)
+    job = ScanJob(hosts, args.port_set, scanner_class, engine, args.checkpoint,
+                  port_plan=reporter.diff.ports_for if reporter.diff is not None else None)
+    if args.saved is not None:
+        job.restore(*args.saved)
+    reporter.rtt = lambda host: engine.srtt(RESOLVER.resolve(host))
+    with engine:
+        job.start(reporter.port, reporter.host)
+        try:
+            job.wait()
+        except KeyboardInterrupt:
+            job.cancel()
+            if args.checkpoint:
+                print(f"Scan interrupted, continue it with --resume {args.checkpoint}",
+                      file=sys.stderr)
+            raise
+    return True
+
+
+def scan_with_processes(args, scanner_class, reporter):
+    """
+    Scan all targets with args.processes worker processes, see ShardedScan.
+    Host discovery runs first in this process.
+
+    :param args: parsed arguments.
+    :param scanner_class: PortScanner subclass.
+    :param reporter: Reporter.
+    :return: False if no probe engine could be started, before any host was reported.
+    """
+    from src.engine import ProbeEngine
+    from src.ratelimit import RateLimiter
+    from src.sharding import ShardedScan
+
+    hosts = args.targets
+    if args.discovery:
+        engine = ProbeEngine(timeout=args.timeout,
+                             rate_limiter=RateLimiter(args.rate, min(MIN_RATE, args.rate)),
+                             targets=args.targets)
+        try:
+            engine.start()
+        except ProbeEngineErrorException:
+            return False
+        with engine:
+            hosts = discover_hosts(args, engine)
+        if not hosts:
+            return True
+
+    scan = ShardedScan(hosts, args.port_set, scanner_class, args.processes,
+                       args.rate, args.timeout)
+    try:
+        scan.run(reporter.port, reporter.host)
+    except ProbeEngineErrorException:
+        return False
+    return True
+
+
+def scan_with_connect(args, scanner_class, reporter):
+    """
+    Scan all targets with one ConnectEngine, through the SOCKS5 proxies of config.py
+    if any. Needs no root privileges, so there is neither host discovery nor
+    a fallback.
+
+    :param args: parsed arguments.
+    :param scanner_class: ConnectScanner.
+    :param reporter: Reporter.
+    :return: True.
+    """
+    from src.connect import ConnectEngine, ProxyPool
+
+    engine = ConnectEngine(timeout=args.timeout, concurrency=args.concurrency,
+                           proxies=ProxyPool.from_config())
+    ports = args.port_set
+    if reporter.diff is not None:
+        ports = functools.partial(reporter.diff.ports_for, ports=args.port_set)
+    engine.run(args.targets, ports, reporter.port, reporter.host)
+    return True
+
+
+def scan_sequentially(args, scanner_class, reporter):
+    """
+    Scan the targets one after another with one sr1() per port.
+
+    :param args: parsed arguments.
+    :param scanner_class: PortScanner subclass.
+    :param reporter: Reporter.
+    """
+    RESOLVER.prefetch(args.targets.domains)
+    for host in args.targets:
+        ports = args.port_set
+        if reporter.diff is not None:
+            ports = reporter.diff.ports_for(host, ports)
+        future = Future()
+        try:
+            future.set_result(scanner_class(host, ports).port_scan(
+                lambda port, state, host=host: reporter.port(host, port, state)))
+        except ScanErrorException as error:
+            future.set_exception(error)
+        reporter.host(future, host=host)
+
+
+def main(argv=None):
+    """
+    Run a scan from the command line.
+
+    :param argv: arguments, sys.argv[1:] by default.
+    :return: exit status, 1 if any host could not be scanned, 2 if the baseline could not
+        be read, 130 if interrupted.
+    """
+    args = parse_args(argv)
+    scanner_class = SCANNER_CLASSES[args.scan_type]
+
+    diff = None
+    if args.baseline:
+        from src.rescan import Baseline, DifferentialScan
+
+        try:
+            diff = DifferentialScan(Baseline.from_export(args.baseline, args.scan_type),
+                                    args.sample_rate)
+        except (OSError, ScanErrorException) as error:
+            print(f"error: {error}", file=sys.stderr)
+            return 2
+
+    store, run_id = None, None
+    if args.store:
+        from src.database import ResultStore
+
+        try:
+            store = ResultStore()
+            run_id = store.start_run(args.scan_type)
+        except InsertDatabaseErrorException as error:
+            print(f"error: results will not be saved: {error}", file=sys.stderr)
+            store = None
+
+    writer = None
+    if args.metrics:
+        writer = MetricsWriter(METRICS, args.metrics)
+        writer.start()
+
+    exporter = None
+    if args.export:
+        from src.export import create_exporter
+
+        try:
+            exporter = create_exporter(args.export, args.export_format, args.compress)
+        except OSError as error:
+            print(f"error: results will not be exported: {error}", file=sys.stderr)
+
+    services = None
+    if args.services:
+        from src.services import ServiceCache, ServiceDetector
+
+        cache = ServiceCache()
+        if args.service_cache:
+            try:
+                cache.load(args.service_cache)
+            except OSError as error:
+                print(f"error: the service cache was not read: {error}", file=sys.stderr)
+        services = ServiceDetector(cache=cache)
+        services.start()
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    reporter = Reporter(output, args.all_states, store, run_id, args.scan_type, exporter)
+    reporter.diff = diff
+    reporter.services = services
+    interrupted = False
+    try:
+        if scanner_class is ConnectScanner:
+            scan = scan_with_connect
+        elif args.processes > 1:
+            scan = scan_with_processes
+        else:
+            scan = scan_with_engine
+        if not scan(args, scanner_class, reporter):
+            scan_sequentially(args, scanner_class, reporter)
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        if services is not None:
+            services.stop(wait=not interrupted)
+            if args.service_cache:
+                try:
+                    services.cache.save(args.service_cache)
+                except OSError as error:
+                    print(f"error: the service cache was not saved: {error}", file=sys.stderr)
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+        if writer is not None:
+            writer.stop()
+        if exporter is not None:
+            exporter.close()
+        if store is not None:
+            try:
+                store.finish_run(run_id)
+            except InsertDatabaseErrorException as error:
+                print(f"error: results were not saved: {error}", file=sys.stderr)
+            store.close()
+    if interrupted:
+        return 130
+    return 1 if reporter.errors else 0
@@ -0,0 +1,485 @@
+"""Module providing the unprivileged connect scan engine and the SOCKS5 proxy pool."""
+
+import asyncio
+import collections
+import errno
+import re
+import resource
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+from config import CONNECT_TIMEOUT, CONNECT_CONCURRENCY, MAX_ACTIVE_HOSTS, SOCKS_PROXIES, \
+    SOCKS_PROXY_LIMIT, SOCKS_SPARE_SESSIONS
+from src.metrics import METRICS
+from src.resolver import RESOLVER
+from src.results import HostResult, PortState
+from src.utils import ProxyErrorException, ScanErrorException, IP_PATTERN
+
+SOCKS_VERSION = 5
+NO_AUTHENTICATION = 0
+USERNAME_AUTHENTICATION = 2
+SOCKS_CONNECT = 1
+ADDRESS_IPV4 = 1
+ADDRESS_DOMAIN = 3
+SOCKS_REPLY_STATES = {
+    0: PortState.OPEN,
+    3: PortState.FILTERED,
+    4: PortState.FILTERED,
+    5: PortState.CLOSED,
+    6: PortState.FILTERED,
+}
+UNREACHABLE_ERRORS = {errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EACCES, errno.EPERM}
+RESOURCE_ERRORS = {errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS}
+RESOURCE_RETRIES = 3
+RESOURCE_RETRY_DELAY = 0.1
+PROXY_RETRY_INTERVAL = 30
+FD_RESERVE = 64
+PORT = struct.Struct("!H")
+
+
+def max_open_sockets():
+    """
+    Returns the number of sockets the process can open, leaving FD_RESERVE descriptors.
+
+    :return: number of sockets.
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return CONNECT_CONCURRENCY
+    return max(1, soft - FD_RESERVE)
+
+
+class SocksProxy:
+    """
+    One SOCKS5 proxy of a ProxyPool, carrying at most limit connects at a time.
+    A SOCKS5 session carries a single CONNECT, so finished sessions are replaced
+    by new ones negotiated in advance, up to spare idle sessions.
+    """
+
+    def __init__(self, host, port, username=None, password=None, limit=SOCKS_PROXY_LIMIT,
+                 spare=SOCKS_SPARE_SESSIONS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.limit = limit
+        self.spare = spare
+        self.in_use = 0
+        self.down_until = 0.0
+        self._idle = collections.deque()
+        self._preparing = 0
+
+    def __repr__(self):
+        return f"SocksProxy({self.host}:{self.port})"
+
+    @property
+    def available(self):
+        """True if the proxy is not known to be down and can carry one more connect."""
+        return self.in_use < self.limit and self.down_until <= time.monotonic()
+
+    async def session(self, timeout):
+        """
+        Returns a negotiated session, an idle one if any.
+
+        :param timeout: seconds to open and negotiate a new session.
+        :return: (reader, writer, reused) tuple, reused being True for an idle session.
+        """
+        while self._idle:
+            reader, writer = self._idle.popleft()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(self._negotiate(), timeout)
+        return reader, writer, False
+
+    def prepare(self, timeout):
+        """
+        Negotiate a spare session in the background if there are not enough of them.
+
+        :param timeout: seconds to open and negotiate the session.
+        """
+        if len(self._idle) + self._preparing >= min(self.spare, self.limit - self.in_use):
+            return
+        self._preparing += 1
+        asyncio.get_running_loop().create_task(self._prepare(timeout))
+
+    async def _prepare(self, timeout):
+        try:
+            self._idle.append(await asyncio.wait_for(self._negotiate(), timeout))
+        except (OSError, asyncio.TimeoutError, ProxyErrorException):
+            pass
+        finally:
+            self._preparing -= 1
+
+    async def _negotiate(self):
+        """
+        Open a connection to the proxy and authenticate (RFC 1928, RFC 1929).
+
+        :return: (reader, writer) pair.
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            methods = [NO_AUTHENTICATION]
+            if self.username is not None:
+                methods.append(USERNAME_AUTHENTICATION)
+            writer.write(bytes([SOCKS_VERSION, len(methods)] + methods))
+            version, method = await reader.readexactly(2)
+            if version != SOCKS_VERSION or method not in methods:
+                raise ProxyErrorException(f"{self!r} refused the authentication methods")
+            if method == USERNAME_AUTHENTICATION:
+                username = self.username.encode()
+                password = (self.password or "").encode()
+                writer.write(bytes([1, len(username)]) + username +
+                             bytes([len(password)]) + password)
+                _, status = await reader.readexactly(2)
+                if status != 0:
+                    raise ProxyErrorException(f"{self!r} refused the credentials")
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def close(self):
+        """Close the idle sessions."""
+        while self._idle:
+            _, writer = self._idle.popleft()
+            writer.close()
+
+
+class ProxyPool:
+    """
+    Pool of SOCKS5 proxies. Each connect goes through the least busy proxy that
+    is not down; a proxy that can not be reached is left out for PROXY_RETRY_INTERVAL
+    seconds. Destinations are sent as domain names when they are not ip addresses,
+    so names are resolved by the proxy.
+    """
+
+    def __init__(self, proxies):
+        self.proxies = list(proxies)
+        self._condition = None
+
+    @classmethod
+    def from_config(cls, entries=SOCKS_PROXIES, limit=SOCKS_PROXY_LIMIT):
+        """
+        Create the pool of proxies listed as (host, port) or (host, port, username,
+        password) tuples, as SOCKS_PROXIES in config.py.
+
+        :param entries: list of proxy tuples.
+        :param limit: maximum number of connects at a time through each proxy.
+        :return: ProxyPool, or None for no proxies.
+        """
+        if not entries:
+            return None
+        return cls(SocksProxy(*entry, limit=limit) for entry in entries)
+
+    @property
+    def capacity(self):
+        """Maximum number of connects at a time through all proxies."""
+        return sum(proxy.limit for proxy in self.proxies)
+
+    async def connect(self, host, port, timeout, metrics=METRICS):
+        """
+        Ask a proxy to connect to host:port.
+
+        :param host: ip address or domain name of the target.
+        :param port: port number.
+        :param timeout: seconds to wait for the reply of the proxy.
+        :param metrics: Metrics to count proxy failures in.
+        :return: PortState given by the reply of the proxy.
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        for _ in range(len(self.proxies)):
+            proxy = await self._acquire()
+            proxy.in_use += 1
+            try:
+                return await self._request(proxy, host, port, timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                    ProxyErrorException):
+                metrics.inc("proxy_errors")
+                proxy.down_until = time.monotonic() + PROXY_RETRY_INTERVAL
+            finally:
+                proxy.in_use -= 1
+                async with self._condition:
+                    self._condition.notify()
+        raise ProxyErrorException("No SOCKS proxy could be used")
+
+    async def close(self):
+        """Close the idle sessions of all proxies."""
+        for proxy in self.proxies:
+            await proxy.close()
+        self._condition = None
+
+    async def _acquire(self):
+        """
+        Wait for a proxy that can carry one more connect.
+
+        :return: SocksProxy.
+        """
+        async with self._condition:
+            while True:
+                candidates = [proxy for proxy in self.proxies if proxy.available]
+                if candidates:
+                    return min(candidates, key=lambda proxy: proxy.in_use)
+                if all(proxy.down_until > time.monotonic() for proxy in self.proxies):
+                    raise ProxyErrorException("All SOCKS proxies are down")
+                await self._condition.wait()
+
+    @staticmethod
+    async def _request(proxy, host, port, timeout):
+        """
+        Send one CONNECT request through a session of a proxy. An idle session
+        closed by the proxy meanwhile is replaced by a new one.
+
+        :return: PortState.
+        """
+        if re.match(IP_PATTERN, host) is not None:
+            address = bytes([ADDRESS_IPV4]) + socket.inet_aton(host)
+        else:
+            name = host.encode("idna")
+            address = bytes([ADDRESS_DOMAIN, len(name)]) + name
+        request = bytes([SOCKS_VERSION, SOCKS_CONNECT, 0]) + address + PORT.pack(port)
+        while True:
+            reader, writer, reused = await proxy.session(timeout)
+            try:
+                writer.write(request)
+                try:
+                    version, reply = await asyncio.wait_for(reader.readexactly(2), timeout)
+                except asyncio.TimeoutError:
+                    return PortState.FILTERED
+                except (asyncio.IncompleteReadError, ConnectionResetError):
+                    if reused:
+                        continue
+                    raise
+                if version != SOCKS_VERSION:
+                    raise ProxyErrorException(f"{proxy!r} sent an incorrect reply")
+                return SOCKS_REPLY_STATES.get(reply, PortState.UNKNOWN)
+            finally:
+                writer.close()
+                proxy.prepare(timeout)
+
+
+class ConnectHost:
+    """Host being scanned by a ConnectEngine."""
+
+    __slots__ = ('host', 'address', 'ports', 'in_flight', 'result', 'future', 'started_at',
+                 'exhausted')
+
+    def __init__(self, host, ports):
+        self.host = host
+        self.address = host
+        self.ports = iter(ports)
+        self.in_flight = 0
+        self.result = HostResult(host)
+        self.future = Future()
+        self.started_at = time.monotonic()
+        self.exhausted = False
+
+
+class ConnectEngine:
+    """
+    Unprivileged scan engine classifying ports by complete TCP connects from
+    non-blocking sockets on an asyncio event loop: an accepted connection means
+    open, a refused one closed, and a timeout or an unreachable error filtered.
+    At most concurrency connects are in progress at a time, bounded by the number
+    of sockets the process can open, and at most max_hosts hosts are scanned at
+    a time with their ports interleaved. Through a ProxyPool, connects are made
+    by the proxies instead. Probes, latencies and timeouts are recorded in metrics.
+    """
+
+    def __init__(self, timeout=CONNECT_TIMEOUT, concurrency=CONNECT_CONCURRENCY, proxies=None,
+                 max_hosts=MAX_ACTIVE_HOSTS, metrics=None):
+        self.timeout = timeout
+        self.proxies = proxies
+        self.max_hosts = max_hosts
+        self.metrics = metrics if metrics is not None else METRICS
+        limit = max_open_sockets()
+        if proxies is not None:
+            limit = min(limit, proxies.capacity)
+        self.concurrency = max(1, min(concurrency, limit))
+        self._stopped = threading.Event()
+        self._loop = None
+        self._workers = []
+        self._in_flight = 0
+
+    def run(self, hosts, ports, callback=None, done_callback=None):
+        """
+        Scan the ports of hosts and wait for the end of the scan.
+
+        :param hosts: iterable of ip addresses or domain names, e.g. TargetSet.
+        :param ports: PortSet of the ports to scan, or a function called as ports(host)
+            returning the ports of each host.
+        :param callback: if set, called as callback(host, port, state) for each port.
+        :param done_callback: if set, called as done_callback(future, host=host) when
+            a host is finished, the future being resolved with its HostResult.
+        """
+        self.metrics.register_gauge("connects_in_flight", lambda: self._in_flight)
+        try:
+            asyncio.run(self._run(iter(hosts), ports, callback, done_callback))
+        finally:
+            self.metrics.register_gauge("connects_in_flight", None)
+
+    def stop(self):
+        """
+        Stop the scan from any thread. Connects in progress are abandoned, and
+        the hosts not finished are reported with an error.
+        """
+        self._stopped.set()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._cancel_workers)
+            except RuntimeError:
+                pass
+
+    def _cancel_workers(self):
+        for task in self._workers:
+            task.cancel()
+
+    async def probe(self, host, port):
+        """
+        Classify one port by connecting to it.
+
+        :param host: ip address, or domain name through proxies.
+        :param port: port number.
+        :return: PortState.
+        """
+        self.metrics.inc("probes_sent")
+        self._in_flight += 1
+        started = time.monotonic()
+        try:
+            if self.proxies is not None:
+                state = await self.proxies.connect(host, port, self.timeout, self.metrics)
+            else:
+                state = await self._connect(host, port)
+        finally:
+            self._in_flight -= 1
+        if state == PortState.FILTERED:
+            self.metrics.inc("timeouts")
+        else:
+            self.metrics.inc("replies")
+            self.metrics.observe("probe_latency", time.monotonic() - started)
+        return state
+
+    async def _connect(self, host, port):
+        loop = asyncio.get_running_loop()
+        for _ in range(RESOURCE_RETRIES):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (host, port)), self.timeout)
+                return PortState.OPEN
+            except ConnectionRefusedError:
+                return PortState.CLOSED
+            except asyncio.TimeoutError:
+                return PortState.FILTERED
+            except OSError as error:
+                if error.errno in UNREACHABLE_ERRORS:
+                    return PortState.FILTERED
+                if error.errno not in RESOURCE_ERRORS:
+                    return PortState.UNKNOWN
+            finally:
+                sock.close()
+            await asyncio.sleep(RESOURCE_RETRY_DELAY)
+        return PortState.UNKNOWN
+
+    async def _run(self, hosts, ports, callback, done_callback):
+        active = collections.deque()
+        open_hosts = []
+        condition = asyncio.Condition()
+        error = []
+
+        async def next_probe():
+            while not self._stopped.is_set() and not error:
+                for _ in range(len(active)):
+                    entry = active[0]
+                    active.rotate(-1)
+                    port = next(entry.ports, None)
+                    if port is not None:
+                        entry.in_flight += 1
+                        return entry, port
+                    active.remove(entry)
+                    entry.exhausted = True
+                    if entry.in_flight == 0:
+                        finish(entry)
+                    break
+                else:
+                    if len(open_hosts) < self.max_hosts:
+                        host = next(hosts, None)
+                        if host is not None:
+                            await activate(ConnectHost(
+                                host, ports(host) if callable(ports) else ports))
+                            continue
+                    if not open_hosts:
+                        return None
+                    async with condition:
+                        await condition.wait()
+            return None
+
+        async def activate(entry):
+            open_hosts.append(entry)
+            if self.proxies is None and re.match(IP_PATTERN, entry.host) is None:
+                try:
+                    entry.address = await asyncio.wrap_future(RESOLVER.submit(entry.host))
+                except Exception as resolve_error:
+                    finish(entry, ScanErrorException(resolve_error))
+                    return
+            active.append(entry)
+            await notify()
+
+        def finish(entry, host_error=None):
+            if entry.future.done():
+                return
+            open_hosts.remove(entry)
+            if entry in active:
+                active.remove(entry)
+            self.metrics.observe("host_duration", time.monotonic() - entry.started_at)
+            if host_error is not None:
+                self.metrics.inc("host_errors")
+                entry.future.set_exception(host_error)
+            else:
+                self.metrics.inc("hosts_scanned")
+                entry.future.set_result(entry.result)
+            if done_callback is not None:
+                done_callback(entry.future, host=entry.host)
+            loop.create_task(notify())
+
+        async def notify():
+            async with condition:
+                condition.notify_all()
+
+        async def worker():
+            while True:
+                item = await next_probe()
+                if item is None:
+                    return
+                entry, port = item
+                try:
+                    state = await self.probe(entry.address, port)
+                except ProxyErrorException as proxy_error:
+                    error.append(proxy_error)
+                    await notify()
+                    return
+                entry.result[port] = state
+                entry.in_flight -= 1
+                if callback is not None:
+                    callback(entry.host, port, state)
+                if entry.exhausted and entry.in_flight == 0:
+                    finish(entry)
+
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(worker()) for _ in range(self.concurrency)]
+        self._loop = loop
+        if self._stopped.is_set():
+            self._cancel_workers()
+        try:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        finally:
+            self._loop, self._workers = None, []
+            if self.proxies is not None:
+                await self.proxies.close()
+        for entry in list(open_hosts):
+            finish(entry, ScanErrorException(error[0] if error else "Scan stopped"))
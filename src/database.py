@@ -0,0 +1,273 @@
+"""Module providing the persistent scan result store."""
+
+import queue
+import threading
+import time
+
+from sqlalchemy import (Column, Float, ForeignKey, Index, Integer, SmallInteger, String,
+                        create_engine, event, insert, select, update)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase
+
+from config import DATABASE_URL, DATABASE_BATCH_SIZE
+from src.results import HostResult
+from src.utils import InsertDatabaseErrorException
+
+HOST_CHUNK_SIZE = 500
+
+
+class Base(DeclarativeBase):
+    """Declarative base of the result store tables."""
+
+
+class ScanRun(Base):
+    """One scan started from the GUI or the CLI."""
+
+    __tablename__ = "scan_runs"
+
+    id = Column(Integer, primary_key=True)
+    scan_type = Column(String(16), nullable=False)
+    started_at = Column(Float, nullable=False)
+    finished_at = Column(Float)
+
+
+class Host(Base):
+    """Scanned host address."""
+
+    __tablename__ = "hosts"
+
+    id = Column(Integer, primary_key=True)
+    address = Column(String(255), nullable=False, unique=True)
+
+
+class PortResult(Base):
+    """State of one port of one host in one scan run."""
+
+    __tablename__ = "port_results"
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("scan_runs.id"), nullable=False)
+    host_id = Column(Integer, ForeignKey("hosts.id"), nullable=False)
+    port = Column(Integer, nullable=False)
+    scan_type = Column(String(16), nullable=False)
+    state = Column(SmallInteger, nullable=False)
+    timestamp = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_port_results_lookup", "host_id", "port", "scan_type", "timestamp"),
+        Index("ix_port_results_run", "run_id"),
+    )
+
+
+def enable_wal(dbapi_connection, connection_record):
+    """Switch SQLite connections to WAL mode so readers do not block the writer."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+class ResultStore:
+    """
+    SQLite result store. Port results are buffered and written in batches of
+    batch_size rows, each batch in one transaction, by a writer thread, so
+    adding results does not slow the scan down.
+    """
+
+    def __init__(self, url=DATABASE_URL, batch_size=DATABASE_BATCH_SIZE):
+        self.batch_size = batch_size
+        try:
+            self.engine = create_engine(url)
+            if self.engine.dialect.name == "sqlite":
+                event.listen(self.engine, "connect", enable_wal)
+            Base.metadata.create_all(self.engine)
+        except SQLAlchemyError as error:
+            raise InsertDatabaseErrorException(error) from error
+
+        self._host_ids = {}
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, name="result-store",
+                                        daemon=True)
+        self._thread.start()
+
+    def start_run(self, scan_type):
+        """
+        Register a new scan run.
+
+        :param scan_type: name of the scan type, e.g. "SYN".
+        :return: id of the run.
+        """
+        try:
+            with self.engine.begin() as connection:
+                return connection.execute(
+                    insert(ScanRun).values(scan_type=scan_type, started_at=time.time())
+                ).inserted_primary_key[0]
+        except SQLAlchemyError as error:
+            raise InsertDatabaseErrorException(error) from error
+
+    def add(self, run_id, scan_type, host, port, state):
+        """
+        Buffer the result of one port. Does not block on the database.
+
+        :param run_id: id of the scan run.
+        :param scan_type: name of the scan type.
+        :param host: ip address or domain name of the host.
+        :param port: port number.
+        :param state: PortState of the port.
+        """
+        row = (run_id, host, port, scan_type, int(state), time.time())
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._queue.put(batch)
+
+    def add_host_result(self, run_id, scan_type, result):
+        """
+        Buffer every scanned port of a host result.
+
+        :param run_id: id of the scan run.
+        :param scan_type: name of the scan type.
+        :param result: HostResult.
+        """
+        for port in result.ports():
+            self.add(run_id, scan_type, result.host, port, result.states[port])
+
+    def flush(self):
+        """Write every buffered result and wait until it is committed."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._queue.put(batch)
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise InsertDatabaseErrorException(error) from error
+
+    def finish_run(self, run_id):
+        """
+        Flush the results of a scan run and mark it as finished.
+
+        :param run_id: id of the scan run.
+        """
+        self.flush()
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    update(ScanRun).where(ScanRun.id == run_id).values(finished_at=time.time()))
+        except SQLAlchemyError as error:
+            raise InsertDatabaseErrorException(error) from error
+
+    def close(self):
+        """Flush buffered results and stop the writer thread."""
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self.engine.dispose()
+
+    def _write_loop(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._write(batch)
+            except SQLAlchemyError as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _host_id_map(self, connection, addresses):
+        """
+        Returns ids of host addresses, inserting unknown hosts.
+
+        :param connection: connection of the current transaction.
+        :param addresses: set of addresses.
+        :return: dict of address to host id.
+        """
+        missing = [address for address in addresses if address not in self._host_ids]
+        for start in range(0, len(missing), HOST_CHUNK_SIZE):
+            chunk = missing[start:start + HOST_CHUNK_SIZE]
+            known = dict(connection.execute(
+                select(Host.address, Host.id).where(Host.address.in_(chunk))).all())
+            new = [address for address in chunk if address not in known]
+            if new:
+                connection.execute(insert(Host), [{"address": address} for address in new])
+                known.update(connection.execute(
+                    select(Host.address, Host.id).where(Host.address.in_(new))).all())
+            self._host_ids.update(known)
+        return self._host_ids
+
+    def _write(self, batch):
+        with self.engine.begin() as connection:
+            host_ids = self._host_id_map(connection, {row[1] for row in batch})
+            connection.execute(insert(PortResult), [
+                {"run_id": run_id, "host_id": host_ids[host], "port": port,
+                 "scan_type": scan_type, "state": state, "timestamp": timestamp}
+                for run_id, host, port, scan_type, state, timestamp in batch])
+
+    def query(self, host=None, port=None, scan_type=None, since=None, limit=None):
+        """
+        Query stored port results, newest first.
+
+        :param host: address of the host.
+        :param port: port number.
+        :param scan_type: name of the scan type.
+        :param since: only results newer than this unix timestamp.
+        :param limit: maximum number of rows.
+        :return: list of (host, port, scan_type, state, timestamp) rows.
+        """
+        statement = (
+            select(Host.address, PortResult.port, PortResult.scan_type, PortResult.state,
+                   PortResult.timestamp)
+            .join(Host, Host.id == PortResult.host_id)
+            .order_by(PortResult.timestamp.desc()))
+        if host is not None:
+            statement = statement.where(Host.address == host)
+        if port is not None:
+            statement = statement.where(PortResult.port == port)
+        if scan_type is not None:
+            statement = statement.where(PortResult.scan_type == scan_type)
+        if since is not None:
+            statement = statement.where(PortResult.timestamp > since)
+        if limit is not None:
+            statement = statement.limit(limit)
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(statement)]
+
+    def host_result(self, host, scan_type, run_id=None):
+        """
+        Load the stored states of a host as a HostResult.
+
+        :param host: address of the host.
+        :param scan_type: name of the scan type.
+        :param run_id: id of the scan run, the latest run of scan_type with the host if None.
+        :return: HostResult, empty if the host was never scanned.
+        """
+        result = HostResult(host)
+        with self.engine.connect() as connection:
+            host_id = connection.execute(
+                select(Host.id).where(Host.address == host)).scalar()
+            if host_id is None:
+                return result
+            if run_id is None:
+                run_id = connection.execute(
+                    select(PortResult.run_id)
+                    .where(PortResult.host_id == host_id, PortResult.scan_type == scan_type)
+                    .order_by(PortResult.timestamp.desc()).limit(1)).scalar()
+                if run_id is None:
+                    return result
+            rows = connection.execute(
+                select(PortResult.port, PortResult.state)
+                .where(PortResult.run_id == run_id, PortResult.host_id == host_id,
+                       PortResult.scan_type == scan_type)
+                .order_by(PortResult.timestamp))
+            for port, state in rows:
+                result.states[port] = state
+        return result
@@ -0,0 +1,204 @@
+"""Module providing host discovery before port scanning."""
+
+import functools
+import itertools
+import threading
+
+from scapy.config import conf
+from scapy.layers.inet import ICMP, TCP
+from scapy.layers.l2 import ARP, Ether
+from scapy.sendrecv import srp
+
+from config import DISCOVERY_PORTS, ARP_TIMEOUT, ARP_BATCH_SIZE, MAX_ACTIVE_HOSTS, \
+    RANDOMIZE_TARGETS
+from src.resolver import RESOLVER
+from src.targets import TargetSet, int_to_ip, ip_to_int
+from src.utils import ProbeEngineErrorException
+
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+
+
+def local_networks():
+    """
+    Returns the directly connected IPv4 networks, except the loopback network.
+
+    :return: list of (first, last, iface), addresses as integers.
+    """
+    networks = []
+    for net, mask, gateway, iface, _, _ in conf.route.routes:
+        if gateway != "0.0.0.0" or mask == 0 or str(iface) == conf.loopback_name:
+            continue
+        networks.append((net, net | (~mask & 0xFFFFFFFF), iface))
+    return networks
+
+
+def local_addresses(targets, networks):
+    """
+    Returns the addresses of targets on directly connected networks, as intervals
+    so that large networks are not materialized.
+
+    :param targets: TargetSet.
+    :param networks: see local_networks().
+    :return: dict of the list of (first, last) intervals of addresses (as integers)
+        of each interface.
+    """
+    addresses = {}
+    for start, end in targets.intervals:
+        for first, last, iface in networks:
+            low, high = max(start, first), min(end, last)
+            if low <= high:
+                addresses.setdefault(iface, []).append((low, high))
+    return addresses
+
+
+def iter_addresses(intervals):
+    """
+    Yields the addresses of intervals one by one, interval by interval.
+
+    :param intervals: list of (first, last) intervals, see local_addresses().
+    :return: generator of ip addresses.
+    """
+    for low, high in intervals:
+        for value in range(low, high + 1):
+            yield int_to_ip(value)
+
+
+class HostDiscovery:
+    """
+    Finds out which targets are up before their ports are scanned, so dead hosts
+    do not cost a timeout per port. Every host gets an ICMP echo request and a SYN
+    to each of ports through the probe engine, and any echo reply or TCP answer
+    marks it up. At most max_hosts hosts are probed at a time. Targets on directly
+    connected networks are also asked for with ARP, which firewalls do not block.
+    Domain names are resolved first; a name that can not be resolved is kept,
+    so that the port scan reports the error.
+    """
+
+    def __init__(self, engine, ports=DISCOVERY_PORTS, arp=True, max_hosts=MAX_ACTIVE_HOSTS,
+                 arp_timeout=ARP_TIMEOUT):
+        self.engine = engine
+        self.ports = ports
+        self.arp = arp
+        self.max_hosts = max_hosts
+        self.arp_timeout = arp_timeout
+        self._alive = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_hosts)
+        self._stopped = threading.Event()
+
+    def run(self, targets):
+        """
+        Probe every target and wait for the answers.
+
+        :param targets: TargetSet.
+        :return: TargetSet of the targets that are up.
+        """
+        self._alive = set()
+        self._stopped.clear()
+        RESOLVER.prefetch(targets.domains)
+        arp_thread = None
+        if self.arp:
+            addresses = local_addresses(targets, local_networks())
+            if addresses:
+                arp_thread = threading.Thread(target=self._arp_sweep, args=(addresses,),
+                                              name="arp-sweep", daemon=True)
+                arp_thread.start()
+
+        addresses, unresolved = {}, []
+        for host in targets.shuffled() if RANDOMIZE_TARGETS else targets:
+            if self._stopped.is_set():
+                break
+            lookup = RESOLVER.submit(host)
+            if lookup.exception() is not None:
+                unresolved.append(host)
+                continue
+            if host in targets.domains:
+                addresses[host] = lookup.result()
+            self._probe(lookup.result())
+        for _ in range(self.max_hosts):
+            self._slots.acquire()
+        for _ in range(self.max_hosts):
+            self._slots.release()
+        if arp_thread is not None:
+            arp_thread.join()
+
+        live = TargetSet()
+        alive = self._alive
+        for value in sorted(ip_to_int(host) for host in alive if host in targets):
+            live.add_range(value, value)
+        for domain in targets.domains:
+            if addresses.get(domain) in alive:
+                live.add_domain(domain)
+        for domain in unresolved:
+            live.add_domain(domain)
+        metrics = self.engine.metrics
+        metrics.inc("hosts_up", len(live))
+        metrics.inc("hosts_down", len(targets) - len(live))
+        return live
+
+    def stop(self):
+        """Stop sending probes to new hosts, run() returns the hosts found so far."""
+        self._stopped.set()
+
+    def _probe(self, address):
+        """
+        Send the discovery probes of one host once a slot is free.
+
+        :param address: ip address of the host.
+        """
+        self._slots.acquire()
+        remaining = [1 + len(self.ports)]
+        on_reply = functools.partial(self._on_reply, remaining)
+        sent = 0
+        try:
+            self.engine.submit_echo(address, on_reply)
+            sent += 1
+            for port in self.ports:
+                self.engine.submit(address, port, "S", on_reply)
+                sent += 1
+        except ProbeEngineErrorException:
+            self._stopped.set()
+            self._release(remaining, 1 + len(self.ports) - sent)
+
+    def _on_reply(self, remaining, host, port, flags, response):
+        if response is not None and (
+                (flags is None and response.haslayer(ICMP) and response[ICMP].type == 0) or
+                (flags is not None and response.haslayer(TCP))):
+            with self._lock:
+                self._alive.add(host)
+        self._release(remaining, 1)
+
+    def _release(self, remaining, count):
+        """
+        Count finished probes of a host, freeing its slot after the last one.
+
+        :param remaining: one-item list with the number of unfinished probes of the host.
+        :param count: number of probes that finished.
+        """
+        with self._lock:
+            remaining[0] -= count
+            done = remaining[0] == 0
+        if done:
+            self._slots.release()
+
+    def _arp_sweep(self, addresses):
+        """
+        Ask for the hardware addresses of targets on directly connected networks.
+
+        :param addresses: see local_addresses().
+        """
+        interval = 1 / self.engine.rate_limiter.rate
+        for iface, intervals in addresses.items():
+            hosts = iter_addresses(intervals)
+            while not self._stopped.is_set():
+                batch = list(itertools.islice(hosts, ARP_BATCH_SIZE))
+                if not batch:
+                    break
+                try:
+                    answered, _ = srp(Ether(dst=BROADCAST_MAC) / ARP(pdst=batch), iface=iface,
+                                      timeout=self.arp_timeout, inter=interval, verbose=0)
+                except OSError:
+                    self.engine.metrics.inc("arp_errors")
+                    return
+                with self._lock:
+                    self._alive.update(reply[ARP].psrc for _, reply in answered)
@@ -0,0 +1,505 @@
+"""Module providing the batched probe engine."""
+
+import hashlib
+import heapq
+import itertools
+import os
+import queue
+import random
+import select
+import struct
+import threading
+import time
+
+from scapy.config import conf
+from scapy.layers.inet import IP, TCP, ICMP, IPerror, TCPerror
+
+from config import TIMEOUT, MAX_RETRIES, MAX_PROBES_PER_HOST
+from src.capture import CaptureSocket, MAX_FILTER_RANGES, compile_filter, reply_key
+from src.metrics import METRICS
+from src.packets import TemplateCache, build_echo, open_raw_socket
+from src.ports import PortSet
+from src.ratelimit import RateLimiter
+from src.timing import RttEstimator
+from src.utils import ProbeEngineErrorException
+
+SPORT_BASE = 40000
+SPORT_RANGE = 16384
+POLL_INTERVAL = 0.05
+
+
+class Probe:
+    """
+    Single (host, port, flags) probe tracked by the engine. ICMP echo probes have
+    port 0 and flags None, their source port being the echo identifier.
+    """
+
+    __slots__ = ('host', 'port', 'flags', 'sport', 'seq', 'callback', 'deadline', 'sent_at',
+                 'first_sent_at', 'tries')
+
+    def __init__(self, host, port, flags, sport, seq, callback):
+        self.host = host
+        self.port = port
+        self.flags = flags
+        self.sport = sport
+        self.seq = seq
+        self.callback = callback
+        self.deadline = None
+        self.sent_at = None
+        self.first_sent_at = None
+        self.tries = 0
+
+    @property
+    def key(self):
+        """Key the reply of this probe is matched by: (host, dport, sport)."""
+        return self.host, self.port, self.sport
+
+
+class ProbeEngine:
+    """
+    Stateless probe engine. All probes go out through one shared raw socket
+    from a sender thread, and a single receiver thread matches replies back
+    to the probes by addresses, ports and a keyed sequence number cookie.
+    Probe timeouts are derived from the round-trip time of each host, and
+    unanswered probes are retransmitted up to max_retries times. The send rate
+    is limited by rate_limiter. The socket is created by socket_factory(iface=iface),
+    conf.L3socket by default. Sent probes, replies, timeouts and probe latencies
+    are recorded in metrics.
+    Probes are sent as precompiled packets (see PacketTemplate) through a raw socket
+    created by raw_socket_factory(iface=iface), open_raw_socket() by default when
+    socket_factory is not set. If there is no raw socket, scapy builds the packets
+    and socket_factory's socket sends them.
+    Probes are sent from the sport_range source ports starting at sport_base, so
+    engines running side by side can be given disjoint ranges.
+    Without socket_factory, replies are received by one CaptureSocket whose kernel
+    filter only passes replies to the source ports of the engine, from the addresses
+    of targets if given. Replies are matched by their parsed headers, and only
+    matched ones are dissected by scapy. Sockets may return scapy packets or bytes.
+    Besides TCP probes, ICMP echo requests can be sent with submit_echo() for host discovery.
+    """
+
+    def __init__(self, timeout=TIMEOUT, iface=None, max_retries=MAX_RETRIES,
+                 rate_limiter=None, socket_factory=None, metrics=None,
+                 raw_socket_factory=None, targets=None, sport_base=SPORT_BASE,
+                 sport_range=SPORT_RANGE):
+        self.timeout = timeout
+        self.iface = iface
+        self.socket_factory = socket_factory
+        self.raw_socket_factory = raw_socket_factory
+        self.targets = targets
+        self.sport_base = sport_base
+        self.sport_range = sport_range
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else METRICS
+        self._rtt = {}
+        self._secret = os.urandom(16)
+        self._sports = itertools.cycle(range(sport_range))
+        self._sport_offset = random.randrange(sport_range)
+        self._counter = itertools.count()
+        self._pending = {}
+        self._deadlines = []
+        self._lock = threading.Lock()
+        self._send_queue = queue.Queue()
+        self._templates = TemplateCache()
+        self._socket = None
+        self._raw_socket = None
+        self._threads = []
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Open the raw socket and start the sender and receiver threads."""
+        if self._running:
+            return
+        raw_socket_factory = self.raw_socket_factory
+        if raw_socket_factory is None and self.socket_factory is None:
+            raw_socket_factory = open_raw_socket
+        if raw_socket_factory is not None:
+            try:
+                self._raw_socket = raw_socket_factory(iface=self.iface)
+            except (OSError, ValueError):
+                self._raw_socket = None
+        try:
+            if self.socket_factory is not None:
+                self._socket = self.socket_factory(iface=self.iface)
+            elif self._raw_socket is not None:
+                try:
+                    self._socket = CaptureSocket(self.iface, self.receive_filter())
+                except OSError:
+                    self._socket = None
+            if self._socket is None:
+                self._socket = conf.L3socket(iface=self.iface)
+        except Exception as error:
+            if self._raw_socket is not None:
+                self._raw_socket.close()
+                self._raw_socket = None
+            raise ProbeEngineErrorException(error) from error
+
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._send_loop, name="probe-sender", daemon=True),
+            threading.Thread(target=self._receive_loop, name="probe-receiver", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.metrics.register_gauge("send_queue_depth", self._send_queue.qsize)
+        self.metrics.register_gauge("pending_probes", lambda: len(self._pending))
+
+    def stop(self):
+        """Stop the threads, close the socket and time out every pending probe."""
+        if not self._running:
+            return
+        self._running = False
+        self.metrics.register_gauge("send_queue_depth", None)
+        self.metrics.register_gauge("pending_probes", None)
+        self._send_queue.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        self._socket.close()
+        self._socket = None
+        if self._raw_socket is not None:
+            self._raw_socket.close()
+            self._raw_socket = None
+
+        with self._lock:
+            probes = list(self._pending.values())
+            self._pending.clear()
+            self._deadlines = []
+        for probe in probes:
+            probe.callback(probe.host, probe.port, probe.flags, None)
+
+    def receive_filter(self):
+        """
+        Compile the kernel filter of the receive socket. Reply addresses are checked
+        only if self.targets has no domain names and at most MAX_FILTER_RANGES ranges.
+
+        :return: BPF instructions, see compile_filter().
+        """
+        address_ranges = None
+        targets = self.targets
+        if targets is not None and not targets.domains and \
+                len(targets.intervals) <= MAX_FILTER_RANGES:
+            address_ranges = targets.intervals
+        return compile_filter(self.sport_base, self.sport_range, address_ranges)
+
+    def cookie(self, host, port, sport):
+        """
+        Returns the sequence number cookie of a probe.
+
+        :param host: ip address of the target.
+        :param port: destination port.
+        :param sport: source port.
+        :return: 32-bit keyed hash of the probe addresses.
+        """
+        digest = hashlib.blake2b(
+            f"{host}:{port}:{sport}".encode(), key=self._secret, digest_size=4).digest()
+        return struct.unpack("!I", digest)[0]
+
+    def rtt_estimator(self, host):
+        """
+        Returns the round-trip time estimator of a host.
+
+        :param host: ip address of the target.
+        :return: RttEstimator instance.
+        """
+        estimator = self._rtt.get(host)
+        if estimator is None:
+            estimator = self._rtt.setdefault(host, RttEstimator(max_timeout=self.timeout))
+        return estimator
+
+    def srtt(self, host):
+        """
+        Returns the smoothed round-trip time of a host.
+
+        :param host: ip address of the target.
+        :return: seconds, None if no reply was timed yet.
+        """
+        estimator = self._rtt.get(host)
+        return None if estimator is None else estimator.srtt
+
+    def submit(self, host, port, flags, callback):
+        """
+        Queue a probe for sending. Does not block.
+
+        :param host: ip address of the target.
+        :param port: destination port.
+        :param flags: TCP flags of the probe.
+        :param callback: called as callback(host, port, flags, response) from an engine
+            thread, where response is the reply packet or None if all transmissions
+            timed out.
+        """
+        self._send_queue.put(self._add_probe(host, port, flags, callback))
+
+    def submit_echo(self, host, callback):
+        """
+        Queue an ICMP echo request for sending. Does not block.
+
+        :param host: ip address of the target.
+        :param callback: called as callback(host, 0, None, response) from an engine
+            thread, where response is the echo reply or None if all transmissions
+            timed out.
+        """
+        self._send_queue.put(self._add_probe(host, 0, None, callback))
+
+    def _add_probe(self, host, port, flags, callback):
+        """
+        Register a new pending probe with a free source port.
+
+        :return: probe.
+        """
+        if not self._running:
+            raise ProbeEngineErrorException("Probe engine is not started")
+
+        with self._lock:
+            for _ in range(self.sport_range):
+                sport = self.sport_base + \
+                    (next(self._sports) + self._sport_offset) % self.sport_range
+                if (host, port, sport) not in self._pending:
+                    break
+            else:
+                raise ProbeEngineErrorException("No free source ports")
+            seq = self.cookie(host, port, sport)
+            if flags is None:
+                seq &= 0xFFFF
+            probe = Probe(host, port, flags, sport, seq, callback)
+            self._pending[probe.key] = probe
+        return probe
+
+    def run_iter(self, host, ports, flags, window=MAX_PROBES_PER_HOST):
+        """
+        Probe every port of one host. Yields the response of each port as soon as
+        the port is answered or timed out. At most window probes are pending at a time,
+        the next port being taken from ports only when a response has been consumed.
+        If flags is a tuple, each port is probed once with each of its flags, the probes
+        of a port being sent together, and its response is a dict of flags to response,
+        yielded once every probe of the port is answered or timed out. At least one
+        port is pending at a time, whatever the number of flags.
+
+        :param host: ip address of the target.
+        :param ports: ports to probe.
+        :param flags: TCP flags of the probes, or tuple of TCP flags.
+        :param window: maximum number of probes pending at a time.
+        :return: generator of (port, response) pairs.
+        """
+        replies = queue.Queue()
+
+        def on_reply(host_, port_, flags_, response):
+            replies.put((port_, flags_, response))
+
+        unique_ports = iter(ports)
+        if not isinstance(ports, PortSet):
+            seen = set()
+            unique_ports = (port for port in ports if not (port in seen or seen.add(port)))
+        techniques = flags if isinstance(flags, tuple) else (flags,)
+        partial = {}
+        pending = 0
+        while True:
+            while not pending or pending + len(techniques) <= window:
+                port = next(unique_ports, None)
+                if port is None:
+                    break
+                for flags_ in techniques:
+                    self.submit(host, port, flags_, on_reply)
+                pending += len(techniques)
+            if not pending:
+                return
+            port, flags_, response = replies.get()
+            pending -= 1
+            if not isinstance(flags, tuple):
+                yield port, response
+                continue
+            responses = partial.setdefault(port, {})
+            responses[flags_] = response
+            if len(responses) == len(techniques):
+                del partial[port]
+                yield port, responses
+
+    def run(self, host, ports, flags):
+        """
+        Probe every port of one host and wait for all of them.
+
+        :param host: ip address of the target.
+        :param ports: ports to probe.
+        :param flags: TCP flags of the probes.
+        :return: list of (port, response) pairs in the order of ports.
+        """
+        ports = list(ports)
+        responses = dict(self.run_iter(host, ports, flags))
+        return [(port, responses[port]) for port in ports]
+
+    def build_packet(self, probe):
+        """
+        Build the scapy packet of a probe. Reference for build_raw().
+
+        :param probe: probe to build the packet for.
+        :return: IP/TCP packet, or IP/ICMP for echo probes.
+        """
+        if probe.flags is None:
+            return IP(dst=probe.host) / ICMP(id=probe.sport, seq=probe.seq)
+        return IP(dst=probe.host) / TCP(
+            sport=probe.sport, dport=probe.port, flags=probe.flags,
+            seq=probe.seq, ack=probe.seq if 'A' in probe.flags else 0)
+
+    def build_raw(self, probe):
+        """
+        Build the serialized packet of a probe from the template of its host and flags.
+        Must only be called from the sender thread, see PacketTemplate.build().
+
+        :param probe: probe to build the packet for.
+        :return: bytearray with the same bytes as raw(build_packet(probe)).
+        """
+        if probe.flags is None:
+            return build_echo(probe.host, probe.sport, probe.seq)
+        return self._templates.get(probe.host, probe.flags).build(
+            probe.sport, probe.port, probe.seq, probe.seq if 'A' in probe.flags else 0)
+
+    def _send_loop(self):
+        while True:
+            probe = self._send_queue.get()
+            if probe is None or not self._running:
+                return
+            with self._lock:
+                if self._pending.get(probe.key) is not probe:
+                    continue
+            raw_socket = self._raw_socket
+            packet = self.build_raw(probe) if raw_socket is not None else \
+                self.build_packet(probe)
+            timeout = self.rtt_estimator(probe.host).timeout(probe.tries)
+            self.rate_limiter.acquire()
+            probe.sent_at = time.monotonic()
+            if probe.first_sent_at is None:
+                probe.first_sent_at = probe.sent_at
+            try:
+                if raw_socket is not None:
+                    raw_socket.sendto(packet, (probe.host, 0))
+                else:
+                    self._socket.send(packet)
+            except OSError:
+                self.metrics.inc("send_errors")
+            self.metrics.inc("probes_sent")
+            if probe.tries:
+                self.metrics.inc("retransmits")
+            with self._lock:
+                probe.deadline = probe.sent_at + timeout
+                heapq.heappush(self._deadlines, (probe.deadline, next(self._counter), probe))
+
+    def _receive_loop(self):
+        while self._running:
+            try:
+                readable, _, _ = select.select([self._socket], [], [], POLL_INTERVAL)
+                if readable:
+                    packet = self._socket.recv()
+                    if packet is not None:
+                        self._dispatch(packet)
+            except (OSError, ValueError):
+                if not self._running:
+                    return
+            self._expire(time.monotonic())
+
+    def _match_raw(self, data):
+        """
+        Find the pending probe a received serialized packet answers.
+
+        :param data: bytes of the received IP packet.
+        :return: probe or None.
+        """
+        reply = reply_key(data)
+        if reply is None:
+            return None
+        key, seq, ack = reply
+        with self._lock:
+            probe = self._pending.get(key)
+        if probe is None:
+            return None
+        if seq == probe.seq or ack in (probe.seq, (probe.seq + 1) & 0xFFFFFFFF):
+            return probe
+        return None
+
+    def _match(self, packet):
+        """
+        Find the pending probe a received packet answers.
+
+        :param packet: received IP packet.
+        :return: probe or None.
+        """
+        if not packet.haslayer(IP):
+            return None
+        if packet.haslayer(TCP):
+            ip_layer, tcp_layer = packet.getlayer(IP), packet.getlayer(TCP)
+            with self._lock:
+                probe = self._pending.get((ip_layer.src, tcp_layer.sport, tcp_layer.dport))
+            if probe is None:
+                return None
+            if tcp_layer.ack in (probe.seq, (probe.seq + 1) & 0xFFFFFFFF) or \
+                    tcp_layer.seq == probe.seq:
+                return probe
+            return None
+        if packet.haslayer(ICMP) and packet.getlayer(ICMP).type == 0:
+            icmp_layer = packet.getlayer(ICMP)
+            with self._lock:
+                probe = self._pending.get((packet.getlayer(IP).src, 0, icmp_layer.id))
+            if probe is not None and icmp_layer.seq == probe.seq:
+                return probe
+            return None
+        if packet.haslayer(ICMP) and packet.haslayer(IPerror) and packet.haslayer(TCPerror):
+            ip_layer, tcp_layer = packet.getlayer(IPerror), packet.getlayer(TCPerror)
+            with self._lock:
+                probe = self._pending.get((ip_layer.dst, tcp_layer.dport, tcp_layer.sport))
+            if probe is not None and tcp_layer.seq == probe.seq:
+                return probe
+        return None
+
+    def _dispatch(self, packet):
+        received_at = time.monotonic()
+        if isinstance(packet, (bytes, bytearray)):
+            probe = self._match_raw(packet)
+            if probe is None:
+                return
+            packet = IP(packet)
+        else:
+            probe = self._match(packet)
+        if probe is None:
+            return
+        with self._lock:
+            if self._pending.pop(probe.key, None) is not probe:
+                return
+        if probe.tries == 0 and probe.sent_at is not None:
+            self.rtt_estimator(probe.host).update(received_at - probe.sent_at)
+        icmp_layer = packet.getlayer(ICMP)
+        self.rate_limiter.record(
+            retransmitted=probe.tries > 0,
+            unreachable=icmp_layer is not None and icmp_layer.type == 3)
+        self.metrics.inc("replies")
+        if icmp_layer is not None:
+            self.metrics.inc(f"icmp_{icmp_layer.type}_{icmp_layer.code}")
+        if probe.first_sent_at is not None:
+            self.metrics.observe("probe_latency", received_at - probe.first_sent_at)
+        probe.callback(probe.host, probe.port, probe.flags, packet)
+
+    def _expire(self, now):
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, _, probe = heapq.heappop(self._deadlines)
+                if self._pending.get(probe.key) is not probe or probe.deadline != deadline:
+                    continue
+                if probe.tries < self.max_retries:
+                    probe.tries += 1
+                    probe.deadline = None
+                    self._send_queue.put(probe)
+                else:
+                    del self._pending[probe.key]
+                    expired.append(probe)
+        for probe in expired:
+            self.rate_limiter.record_timeout()
+            self.metrics.inc("timeouts")
+            probe.callback(probe.host, probe.port, probe.flags, None)
@@ -0,0 +1,344 @@
+"""Module providing streaming export of scan results to files."""
+
+import csv
+import gzip
+import io
+import json
+import math
+import mmap
+import sys
+import threading
+from array import array
+
+from config import EXPORT_BUFFER_SIZE
+from src.results import PortState
+from src.utils import ScanErrorException
+
+EXPORT_VERSION = 1
+FIELDS = ("host", "port", "state", "scan_type", "rtt")
+HOSTS_BLOCK, SCAN_TYPES_BLOCK, RECORDS_BLOCK = b"H", b"T", b"R"
+COLUMNS = (('I', "host_indexes"), ('H', "ports"), ('B', "states"), ('B', "scan_type_indexes"),
+           ('f', "rtts"))
+
+
+def open_output(path, compress=None):
+    """
+    Open a file for writing, through gzip if compress is set or the path ends with .gz.
+
+    :param path: path of the file.
+    :param compress: True or False to force compression, None to decide by the path.
+    :return: binary file.
+    """
+    if compress is None:
+        compress = str(path).endswith(".gz")
+    return gzip.open(path, "wb") if compress else open(path, "wb")
+
+
+class Exporter:
+    """
+    Base class of the streaming exporters. Records are encoded as they are added
+    and written in one write() call once buffer_size bytes are pending, so neither
+    the results nor their encoding are held in memory. Records can be added from
+    any thread.
+    """
+
+    def __init__(self, path, compress=None, buffer_size=EXPORT_BUFFER_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._file = open_output(path, compress)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, host, port, state, scan_type, rtt=None):
+        """
+        Export the result of one port.
+
+        :param host: ip address or domain name of the host.
+        :param port: port number.
+        :param state: PortState of the port.
+        :param scan_type: name of the scan type, e.g. "SYN".
+        :param rtt: round-trip time to the host in seconds, None if unknown.
+        """
+        with self._lock:
+            if self._encode(host, port, state, scan_type, rtt) >= self.buffer_size:
+                self._write()
+            self.count += 1
+
+    def flush(self):
+        """Write the pending records."""
+        with self._lock:
+            self._write()
+            self._file.flush()
+
+    def close(self):
+        """Write the pending records and close the file."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._write()
+            finally:
+                self._file.close()
+
+    def _encode(self, host, port, state, scan_type, rtt):
+        """
+        Encode one record into the buffer.
+
+        :return: number of bytes pending.
+        """
+        raise NotImplementedError
+
+    def _write(self):
+        """Write the pending bytes to the file."""
+        raise NotImplementedError
+
+
+class JsonLinesExporter(Exporter):
+    """Writes one JSON object per line, with the state as its label."""
+
+    def __init__(self, path, compress=None, buffer_size=EXPORT_BUFFER_SIZE):
+        super().__init__(path, compress, buffer_size)
+        self._lines = []
+        self._size = 0
+
+    def _encode(self, host, port, state, scan_type, rtt):
+        line = json.dumps({"host": host, "port": port, "state": PortState(state).label,
+                           "scan_type": scan_type, "rtt": rtt}) + "\n"
+        self._lines.append(line)
+        self._size += len(line)
+        return self._size
+
+    def _write(self):
+        if self._lines:
+            self._file.write("".join(self._lines).encode())
+            self._lines, self._size = [], 0
+
+
+class CsvExporter(Exporter):
+    """Writes a header row and one row per record, an unknown rtt being empty."""
+
+    def __init__(self, path, compress=None, buffer_size=EXPORT_BUFFER_SIZE):
+        super().__init__(path, compress, buffer_size)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator="\n")
+        self._writer.writerow(FIELDS)
+
+    def _encode(self, host, port, state, scan_type, rtt):
+        self._writer.writerow((host, port, PortState(state).label, scan_type,
+                               "" if rtt is None else rtt))
+        return self._buffer.tell()
+
+    def _write(self):
+        if self._buffer.tell():
+            self._file.write(self._buffer.getvalue().encode())
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+
+class BinaryExporter(Exporter):
+    """
+    Writes a JSON header line followed by length-prefixed blocks, each a tag byte
+    and a little-endian uint32 length. Host names and scan types are written once,
+    in "H" and "T" blocks of length-prefixed UTF-8 strings, and numbered in order
+    of appearance. An "R" block holds a uint32 record count followed by one column
+    per field: host numbers (uint32), ports (uint16), states (uint8), scan type
+    numbers (uint8) and rtts (float32, NaN if unknown), so a record takes 12 bytes
+    and read_binary() decodes columns without a loop over the records.
+    """
+
+    def __init__(self, path, compress=None, buffer_size=EXPORT_BUFFER_SIZE):
+        super().__init__(path, compress, buffer_size)
+        self._hosts = {}
+        self._scan_types = {}
+        self._new_hosts = []
+        self._new_scan_types = []
+        self._columns = [array(code) for code, _ in COLUMNS]
+        header = {"version": EXPORT_VERSION, "format": "scan-records", "fields": FIELDS}
+        self._file.write(json.dumps(header).encode() + b"\n")
+
+    def _encode(self, host, port, state, scan_type, rtt):
+        host_index = self._hosts.get(host)
+        if host_index is None:
+            host_index = self._hosts[host] = len(self._hosts)
+            self._new_hosts.append(host)
+        type_index = self._scan_types.get(scan_type)
+        if type_index is None:
+            type_index = self._scan_types[scan_type] = len(self._scan_types)
+            self._new_scan_types.append(scan_type)
+        hosts, ports, states, scan_types, rtts = self._columns
+        hosts.append(host_index)
+        ports.append(port)
+        states.append(state)
+        scan_types.append(type_index)
+        rtts.append(math.nan if rtt is None else rtt)
+        return 12 * len(ports)
+
+    def _write(self):
+        chunks = []
+        for tag, names in ((HOSTS_BLOCK, self._new_hosts),
+                           (SCAN_TYPES_BLOCK, self._new_scan_types)):
+            if names:
+                encoded = [name.encode() for name in names]
+                chunks.append(self._block(tag, b"".join(
+                    len(name).to_bytes(2, "little") + name for name in encoded)))
+                names.clear()
+        if self._columns[0]:
+            count = array('I', [len(self._columns[0])])
+            if sys.byteorder != "little":
+                count.byteswap()
+                for column in self._columns:
+                    column.byteswap()
+            chunks.append(self._block(RECORDS_BLOCK, count.tobytes() + b"".join(
+                column.tobytes() for column in self._columns)))
+            self._columns = [array(code) for code, _ in COLUMNS]
+        if chunks:
+            self._file.write(b"".join(chunks))
+
+    @staticmethod
+    def _block(tag, data):
+        return tag + len(data).to_bytes(4, "little") + data
+
+
+EXPORTERS = {
+    "jsonl": JsonLinesExporter,
+    "csv": CsvExporter,
+    "binary": BinaryExporter,
+}
+
+
+def export_format(path):
+    """
+    Returns the export format of a file by its extension, .gz excluded:
+    .jsonl and .json give "jsonl", .csv gives "csv", anything else "binary".
+
+    :param path: path of the file.
+    :return: key of EXPORTERS.
+    """
+    name = str(path).lower()
+    if name.endswith(".gz"):
+        name = name[:-len(".gz")]
+    if name.endswith((".jsonl", ".json")):
+        return "jsonl"
+    if name.endswith(".csv"):
+        return "csv"
+    return "binary"
+
+
+def create_exporter(path, format_name=None, compress=None):
+    """
+    Create the exporter of a file.
+
+    :param path: path of the file.
+    :param format_name: key of EXPORTERS, None to choose by the extension.
+    :param compress: see open_output().
+    :return: Exporter.
+    """
+    return EXPORTERS[format_name or export_format(path)](path, compress)
+
+
+class Records:
+    """
+    Records read by read_binary(), kept as one array per field. Iterating yields
+    (host, port, PortState, scan_type, rtt) tuples, rtt being None if unknown.
+    """
+
+    def __init__(self, hosts, scan_types, host_indexes, ports, states, scan_type_indexes, rtts):
+        self.hosts = hosts
+        self.scan_types = scan_types
+        self.host_indexes = host_indexes
+        self.ports = ports
+        self.states = states
+        self.scan_type_indexes = scan_type_indexes
+        self.rtts = rtts
+
+    def __len__(self):
+        return len(self.ports)
+
+    def __iter__(self):
+        hosts, scan_types = self.hosts, self.scan_types
+        for host, port, state, scan_type, rtt in zip(
+                self.host_indexes, self.ports, self.states, self.scan_type_indexes, self.rtts):
+            yield (hosts[host], port, PortState(state), scan_types[scan_type],
+                   None if math.isnan(rtt) else rtt)
+
+
+def read_binary(path):
+    """
+    Read a file written by BinaryExporter. Uncompressed files are memory-mapped
+    and each block of records is decoded into the columns with array.frombytes().
+
+    :param path: path of the file.
+    :return: Records.
+    """
+    with open(path, "rb") as file:
+        if file.read(2) == b"\x1f\x8b":
+            file.seek(0)
+            with gzip.open(file) as compressed:
+                return _parse_binary(compressed.read(), path)
+        file.seek(0)
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            data = b""
+        try:
+            return _parse_binary(data, path)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def _parse_binary(data, path):
+    """
+    Decode the contents of a file written by BinaryExporter. A block cut short ends the file.
+
+    :param data: bytes-like contents of the file.
+    :param path: path of the file, for error messages.
+    :return: Records.
+    """
+    end = data.find(b"\n")
+    try:
+        header = json.loads(bytes(data[:end]))
+    except ValueError as error:
+        raise ScanErrorException(f"Incorrect export file: {path}") from error
+    if end < 0 or header.get("version") != EXPORT_VERSION:
+        raise ScanErrorException(f"Unsupported export file: {path}")
+
+    view = memoryview(data)
+    hosts, scan_types = [], []
+    columns = [array(code) for code, _ in COLUMNS]
+    offset = end + 1
+    try:
+        while offset + 5 <= len(view):
+            tag = bytes(view[offset:offset + 1])
+            size = int.from_bytes(view[offset + 1:offset + 5], "little")
+            start, offset = offset + 5, offset + 5 + size
+            if offset > len(view):
+                break
+            if tag in (HOSTS_BLOCK, SCAN_TYPES_BLOCK):
+                names = hosts if tag == HOSTS_BLOCK else scan_types
+                position = start
+                while position < offset:
+                    length = int.from_bytes(view[position:position + 2], "little")
+                    names.append(str(view[position + 2:position + 2 + length], "utf-8"))
+                    position += 2 + length
+            elif tag == RECORDS_BLOCK:
+                count = int.from_bytes(view[start:start + 4], "little")
+                position = start + 4
+                for column in columns:
+                    size = count * column.itemsize
+                    column.frombytes(view[position:position + size])
+                    position += size
+    finally:
+        view.release()
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+    return Records(hosts, scan_types, *columns)
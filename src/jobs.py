@@ -0,0 +1,508 @@
+"""Module providing resumable scan jobs."""
+
+import json
+import os
+import struct
+import threading
+import zlib
+from array import array
+from concurrent.futures import Future
+
+from config import CHECKPOINT_INTERVAL, RANDOMIZE_TARGETS
+from src import scanner as scanner_module
+from src.ports import PortSet
+from src.results import HostResult, REPORTED_STATES
+from src.targets import TargetSet, permutation
+from src.utils import ScanErrorException
+
+CHECKPOINT_VERSION = 1
+HOST_RECORD = struct.Struct("!cII")
+FINISHED, PARTIAL = b"D", b"P"
+
+
+def write_header(checkpoint, targets, ports, scanner_class):
+    """
+    Write the description of a job at the start of a checkpoint file.
+
+    :param checkpoint: binary file.
+    :param targets: TargetSet.
+    :param ports: PortSet.
+    :param scanner_class: PortScanner subclass.
+    """
+    header = {
+        "version": CHECKPOINT_VERSION,
+        "scanner": scanner_class.__name__,
+        "intervals": targets.intervals,
+        "domains": list(targets.domains),
+        "ports": ports.ranges(),
+    }
+    checkpoint.write(json.dumps(header).encode() + b"\n")
+
+
+def write_host(checkpoint, tag, index, result):
+    """
+    Append the result of one host to a checkpoint file.
+
+    :param checkpoint: binary file.
+    :param tag: FINISHED, or PARTIAL for a host whose scan is not finished.
+    :param index: index of the host in the target set.
+    :param result: HostResult.
+    :return: number of bytes written.
+    """
+    data = zlib.compress(result.states.tobytes())
+    return write_record(checkpoint, tag, index, data)
+
+
+def write_record(checkpoint, tag, index, data):
+    """
+    Append one compressed host record to a checkpoint file.
+
+    :param checkpoint: binary file.
+    :param tag: FINISHED or PARTIAL.
+    :param index: index of the host in the target set.
+    :param data: compressed port states of the host.
+    :return: number of bytes written.
+    """
+    checkpoint.write(HOST_RECORD.pack(tag, index, len(data)) + data)
+    return HOST_RECORD.size + len(data)
+
+
+def read_records(checkpoint):
+    """
+    Read the host records following the header of a checkpoint file. A record cut
+    short by a crash ends the file.
+
+    :param checkpoint: binary file positioned after the header.
+    :return: generator of (tag, index, compressed data) tuples.
+    """
+    while True:
+        record = checkpoint.read(HOST_RECORD.size)
+        if len(record) < HOST_RECORD.size:
+            return
+        tag, index, size = HOST_RECORD.unpack(record)
+        data = checkpoint.read(size)
+        if len(data) < size:
+            return
+        yield tag, index, data
+
+
+class FinishedHosts:
+    """
+    Hosts of a target set whose scan is finished, kept as one bit per host and
+    the ports of each host in REPORTED_STATES, so that resuming a large scan does
+    not hold the whole HostResult of every finished host.
+    """
+
+    __slots__ = ('_bitmap', '_count', '_reported')
+
+    def __init__(self, size):
+        self._bitmap = bytearray((size + 7) // 8)
+        self._count = 0
+        self._reported = {}
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, index):
+        return bool(self._bitmap[index >> 3] & (1 << (index & 7)))
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self._bitmap):
+            while byte:
+                bit = byte & -byte
+                yield (byte_index << 3) + bit.bit_length() - 1
+                byte ^= bit
+
+    def add(self, index, result):
+        """
+        Mark a host as finished.
+
+        :param index: index of the host in the target set.
+        :param result: HostResult of the host.
+        """
+        if index in self:
+            return
+        self._bitmap[index >> 3] |= 1 << (index & 7)
+        self._count += 1
+        ports = result.ports(*REPORTED_STATES)
+        if ports:
+            self._reported[index] = (ports, bytes(result.states[port] for port in ports))
+
+    def result(self, index, host):
+        """
+        Returns the result of a finished host with its reported ports only.
+
+        :param index: index of the host in the target set.
+        :param host: ip address or domain name of the host.
+        :return: HostResult.
+        """
+        result = HostResult(host)
+        ports, states = self._reported.get(index, ((), b""))
+        for port, state in zip(ports, states):
+            result[port] = state
+        return result
+
+
+def read_checkpoint(path):
+    """
+    Read a checkpoint file. A record cut short by a crash ends the file. Each
+    record is decompressed once; of finished hosts, only the ports in
+    REPORTED_STATES are kept, see FinishedHosts.
+
+    :param path: path of the file.
+    :return: tuple of the TargetSet, the PortSet, the PortScanner subclass, the
+        FinishedHosts, and a dict of the HostResult of partially scanned hosts
+        by host index.
+    """
+    with open(path, "rb") as checkpoint:
+        try:
+            header = json.loads(checkpoint.readline())
+        except ValueError as error:
+            raise ScanErrorException(f"Incorrect checkpoint file: {path}") from error
+        if header.get("version") != CHECKPOINT_VERSION:
+            raise ScanErrorException(f"Unsupported checkpoint file: {path}")
+        targets = TargetSet()
+        for start, end in header["intervals"]:
+            targets.add_range(start, end)
+        for domain in header["domains"]:
+            targets.add_domain(domain)
+        ports = PortSet()
+        for start, end in header["ports"]:
+            ports.add_range(start, end)
+        scanner_class = getattr(scanner_module, header["scanner"], None)
+        if scanner_class is None:
+            raise ScanErrorException(f"Unknown scan type in checkpoint file: {path}")
+
+        finished, partial = FinishedHosts(len(targets)), {}
+        for tag, index, data in read_records(checkpoint):
+            try:
+                result = HostResult(targets[index], array('B', zlib.decompress(data)))
+            except (zlib.error, IndexError):
+                break
+            if tag == FINISHED:
+                finished.add(index, result)
+                partial.pop(index, None)
+            elif index not in finished:
+                partial[index] = result
+    return targets, ports, scanner_class, finished, partial
+
+
+class ScanJob:
+    """
+    Scan of a target set through a started probe engine that can be paused,
+    resumed and cancelled. Hosts are scanned by a ScanScheduler of the job,
+    and cancelling stops it, so no new probe is issued afterwards.
+    If checkpoint_path is set, finished hosts are appended to the checkpoint file
+    every checkpoint_interval seconds, with the partial results of the hosts being
+    scanned, and once more when the job ends. Once the outdated partial results
+    take more room than the rest, the file is compacted, see compact().
+    from_checkpoint() creates the job again from the file, so that scanned
+    (host, port) pairs are not probed again; of the hosts finished before, only
+    the ports in REPORTED_STATES are reported again.
+    If port_plan is set, it is called as port_plan(host, ports) for the ports of
+    each host, e.g. DifferentialScan.ports_for().
+    """
+
+    def __init__(self, targets, ports, scanner_class, engine, checkpoint_path=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, port_plan=None):
+        self.targets = targets
+        self.ports = ports
+        self.port_plan = port_plan
+        self.scanner_class = scanner_class
+        self.engine = engine
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.cancelled = False
+        self._finished = FinishedHosts(len(targets))
+        self._partial = {}
+        self._active = {}
+        self._unsaved = []
+        self._remaining = 0
+        self._resumed = False
+        self._scheduler = None
+        self._checkpoint = None
+        self._checkpoint_thread = None
+        self._finished_size = 0
+        self._partial_size = 0
+        self._callback = None
+        self._done_callback = None
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._done = threading.Event()
+
+    @classmethod
+    def from_checkpoint(cls, path, engine, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        Create the job saved in a checkpoint file. Further checkpoints are
+        appended to the same file.
+
+        :param path: path of the checkpoint file.
+        :param engine: started ProbeEngine.
+        :param checkpoint_interval: seconds between checkpoints.
+        :return: ScanJob.
+        """
+        targets, ports, scanner_class, finished, partial = read_checkpoint(path)
+        job = cls(targets, ports, scanner_class, engine, path, checkpoint_interval)
+        job.restore(finished, partial)
+        return job
+
+    def restore(self, finished, partial):
+        """
+        Restore the results read from the checkpoint file of the job, see read_checkpoint().
+        Must be called before start(); checkpoints are then appended to the file.
+
+        :param finished: FinishedHosts.
+        :param partial: dict of the HostResult of partially scanned hosts by host index.
+        """
+        self._finished, self._partial = finished, partial
+        self._resumed = True
+
+    @property
+    def paused(self):
+        """True while the job is paused."""
+        return self._scheduler is not None and self._scheduler.paused
+
+    @property
+    def done(self):
+        """True when every host is finished or the job is cancelled."""
+        return self._done.is_set()
+
+    def start(self, callback=None, done_callback=None):
+        """
+        Start scanning. Results restored from the checkpoint are reported first,
+        from this thread, and the checkpoint file is compacted.
+
+        :param callback: if set, called as callback(host, port, state) for each port.
+        :param done_callback: if set, called as done_callback(future, host=host) when
+            a host is finished, the future being resolved with its whole HostResult.
+        """
+        from src.scheduler import ScanScheduler
+
+        self._callback, self._done_callback = callback, done_callback
+        if self.checkpoint_path is not None:
+            if self._resumed:
+                self._checkpoint = open(self.checkpoint_path, "ab")
+                self.compact()
+            else:
+                self._checkpoint = open(self.checkpoint_path, "wb")
+                write_header(self._checkpoint, self.targets, self.ports, self.scanner_class)
+                self._checkpoint.flush()
+                self._finished_size = self._checkpoint.tell()
+
+        for index in self._finished:
+            self._report(index, self._finished.result(index, self.targets[index]))
+        self._remaining = len(self.targets) - len(self._finished)
+        if self._remaining == 0:
+            self._end()
+            return
+
+        self._scheduler = ScanScheduler(self.engine)
+        self._scheduler.start()
+        indexes = permutation(len(self.targets)) if RANDOMIZE_TARGETS else \
+            range(len(self.targets))
+        self._scheduler.submit_targets(
+            (index for index in indexes if index not in self._finished),
+            self._make_scanner, self._on_port, self._on_host)
+        if self._checkpoint is not None:
+            self._checkpoint_thread = threading.Thread(
+                target=self._checkpoint_loop, name="scan-checkpoint", daemon=True)
+            self._checkpoint_thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to end.
+
+        :param timeout: seconds to wait at most, None to wait until the end.
+        :return: True if the job has ended.
+        """
+        return self._done.wait(timeout)
+
+    def pause(self):
+        """Stop issuing probes. Probes already sent are still answered."""
+        if self._scheduler is not None:
+            self._scheduler.pause()
+
+    def resume(self):
+        """Issue probes again after pause()."""
+        if self._scheduler is not None:
+            self._scheduler.resume()
+
+    def cancel(self):
+        """
+        Stop the job. No probe is issued afterwards; the hosts being scanned are
+        not reported, their partial results go to the last checkpoint.
+        Does nothing if every host is already finished.
+        """
+        with self._lock:
+            if self._done.is_set() or self._remaining == 0:
+                return
+            self.cancelled = True
+        if self._scheduler is not None:
+            self._scheduler.stop()
+        self._end()
+
+    def checkpoint(self):
+        """
+        Append the hosts finished since the last checkpoint and the partial results,
+        or compact the file if the partial results written so far take more room
+        than the header and the finished hosts.
+        """
+        if self._checkpoint is None:
+            return
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, []
+            partial = [(index, HostResult(result.host, array('B', result.states)))
+                       for index, result in self._active.items()]
+        with self._file_lock:
+            if self._checkpoint is None:
+                return
+            for tag, index, result in unsaved:
+                size = write_host(self._checkpoint, tag, index, result)
+                if tag == FINISHED:
+                    self._finished_size += size
+                else:
+                    self._partial_size += size
+            if self._partial_size > self._finished_size:
+                self._compact(partial)
+            else:
+                for index, result in partial:
+                    self._partial_size += write_host(self._checkpoint, PARTIAL, index, result)
+                self._checkpoint.flush()
+                os.fsync(self._checkpoint.fileno())
+        self.engine.metrics.inc("checkpoints")
+
+    def compact(self):
+        """
+        Rewrite the checkpoint file with its header, the finished hosts and the
+        latest partial result of each unfinished host only.
+        """
+        with self._lock:
+            partial = [(index, HostResult(result.host, array('B', result.states)))
+                       for index, result in self._active.items()]
+        with self._file_lock:
+            if self._checkpoint is not None:
+                self._compact(partial)
+
+    def _compact(self, active):
+        """
+        Write the compacted checkpoint to a temporary file and replace the
+        checkpoint file with it. Must be called with the file lock held.
+
+        :param active: list of (index, HostResult) pairs of the hosts being scanned.
+        """
+        with self._lock:
+            latest = dict(self._partial)
+        latest.update(active)
+        self._checkpoint.flush()
+        path = self.checkpoint_path
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as compacted:
+            write_header(compacted, self.targets, self.ports, self.scanner_class)
+            with open(path, "rb") as checkpoint:
+                checkpoint.readline()
+                for tag, index, data in read_records(checkpoint):
+                    if tag == FINISHED:
+                        write_record(compacted, tag, index, data)
+            self._finished_size = compacted.tell()
+            self._partial_size = 0
+            for index, result in latest.items():
+                self._partial_size += write_host(compacted, PARTIAL, index, result)
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        self._checkpoint.close()
+        os.replace(temporary, path)
+        self._checkpoint = open(path, "ab")
+
+    def _checkpoint_loop(self):
+        while not self._done.wait(self.checkpoint_interval):
+            self.checkpoint()
+
+    def _end(self):
+        """Write the last checkpoint and mark the job as ended."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+        self.checkpoint()
+        with self._file_lock:
+            if self._checkpoint is not None:
+                self._checkpoint.close()
+                self._checkpoint = None
+        self._done.set()
+
+    def _make_scanner(self, index):
+        """
+        Returns the port scanner of a host, for the ports not scanned before.
+        Ports restored from the checkpoint are reported first.
+
+        :param index: index of the host in the target set.
+        :return: PortScanner.
+        """
+        ports = self.ports
+        partial = self._partial.get(index)
+        if partial is not None:
+            ports = ports - PortSet(partial.ports())
+            for port in partial.ports():
+                self._on_port(index, port, partial[port])
+        if self.port_plan is not None:
+            ports = self.port_plan(self.targets[index], ports)
+        return self.scanner_class(self.targets[index], ports, self.engine)
+
+    def _merge(self, index, result):
+        """
+        Returns the result of a host merged with its restored partial result.
+        """
+        partial = self._partial.get(index)
+        return result if partial is None else partial.merge(result)
+
+    def _on_port(self, index, port, state):
+        """
+        Record and report the state of one port. States coming after cancel() are
+        dropped, so that neither the callback nor the checkpoint get them.
+        """
+        with self._lock:
+            if self.cancelled:
+                return
+            result = self._active.get(index)
+            if result is None:
+                result = self._active[index] = HostResult(self.targets[index])
+            result[port] = state
+        if self._callback is not None:
+            self._callback(self.targets[index], port, state)
+
+    def _on_host(self, future, host):
+        index = host
+        with self._lock:
+            active = self._active.pop(index, None)
+            error = future.exception()
+            if error is None:
+                result = self._merge(index, future.result())
+                self._partial.pop(index, None)
+                self._unsaved.append((FINISHED, index, result))
+            elif active is not None:
+                result = self._partial[index] = self._merge(index, active)
+                self._unsaved.append((PARTIAL, index, result))
+            self._remaining -= 1
+            last = self._remaining == 0
+        if error is None:
+            if not self.cancelled:
+                self._report(index, result, skip_ports=True)
+        elif self._done_callback is not None and not self.cancelled:
+            self._done_callback(future, host=self.targets[index])
+        if last and not self.cancelled:
+            threading.Thread(target=self._end, name="scan-job-end", daemon=True).start()
+
+    def _report(self, index, result, skip_ports=False):
+        """
+        Report a finished host to the callbacks.
+
+        :param index: index of the host in the target set.
+        :param result: whole HostResult of the host.
+        :param skip_ports: True if its ports were already reported.
+        """
+        host = self.targets[index]
+        if self._callback is not None and not skip_ports:
+            for port in result.ports():
+                self._callback(host, port, result[port])
+        if self._done_callback is not None:
+            future = Future()
+            future.set_result(HostResult(host, result.states))
+            self._done_callback(future, host=host)
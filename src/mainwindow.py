@@ -1,91 +1,62 @@
 """Module providing the main window of the application"""
 
 import functools
-import ipaddress
-from concurrent.futures import ThreadPoolExecutor
-import re
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+from config import RANDOMIZE_TARGETS, METRICS_FILE, CHECKPOINT_FILE, EXPORT_FILE, \
+    SERVICE_DETECTION, SERVICE_CACHE_FILE
 from src.utils import HostNotSpecifiedException, ScanErrorException, HostInputErrorException, \
-    CustomPortsNotSpecifiedException, default_ports, IP_PATTERN, DOMAIN_PATTERN
-from src.scanner import ACKScanner, FINScanner, NULLScanner, SYNScanner
+    CustomPortsNotSpecifiedException, ProbeEngineErrorException, InsertDatabaseErrorException, \
+    PortInputErrorException, default_ports
+from src.scanner import ACKScanner, CombinedScanner, ConnectScanner, FINScanner, NULLScanner, \
+    SYNScanner
+from src.database import ResultStore
+from src.connect import ConnectEngine, ProxyPool
+from src.discovery import HostDiscovery
+from src.engine import ProbeEngine
+from src.export import create_exporter
+from src.jobs import ScanJob
+from src.metrics import METRICS, MetricsWriter
+from src.ports import PortSet, named_ports
+from src.resolver import RESOLVER
+from src.results import PortState, REPORTED_STATES
+from src.resultsview import ResultsView, FRAME_BUDGET
+from src.services import ServiceCache, ServiceDetector
+from src.targets import TargetSet
 import gi
 
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
+
+STATS_INTERVAL = 500
+FRAME_LINES = 500
+MESSAGES_HEIGHT = 120
+HOST_COLUMN_WIDTH = 20
 
 
 def parse_number_string(input_string):
     """
     Parse a string of numbers separated by commas and/or hyphens.
-    For example, "1,2,3,4-5,6" will return [1, 2, 3, 4, 5, 6].
+    For example, "1,2,3,4-5,6" will return a port set of 1, 2, 3, 4, 5, 6.
+    Named port lists and exclusions are supported, see PortSet.parse().
 
     :param input_string: The string to parse.
-    :return: list of numbers of string.
+    :return: PortSet of numbers of string.
     """
-    parts = input_string.split(',')
-    numbers = []
-
-    for part in parts:
-        if '-' in part:
-            start, end = map(int, part.split('-'))
-            numbers.extend(range(start, end + 1))
-        else:
-            numbers.append(int(part.strip()))
-
-    return numbers
+    return PortSet.parse(input_string)
 
 
 def parse_host_string(input_string):
     """
-    Parse a string of hosts separated by commas and/or hyphens .
-    For example, "127.0.0.1, 192.168.0.2-192.168.0.4, localhost" will return [127.0.0.1,
-    192.168.0.2, 192.168.0.3, 192.168.0.4].
+    Parse a string of hosts separated by commas and/or hyphens.
+    For example, "127.0.0.1, 192.168.0.2-192.168.0.4, localhost" will return a target set of
+    127.0.0.1, 192.168.0.2, 192.168.0.3, 192.168.0.4 and localhost, see TargetSet.parse().
 
     :param input_string: The string to parse.
-    :return: list of hosts of string.
+    :return: TargetSet of hosts of string.
     """
-    if re.match(r'^[a-zA-Zа-яА-ЯёЁ0-9.\-]+$', input_string) is None:
-        raise HostInputErrorException("Host entered incorrectly.")
-
-    host_list = []
-    input_string = input_string.strip()
-    input_string = input_string.replace(" ", "")
-
-    input_parts = input_string.split(",")
-
-    for part in input_parts:
-        if '-' in part:
-            # Range processing
-            start, end = part.split('-')
-            if (re.match(IP_PATTERN, start) is None or
-                    re.match(IP_PATTERN, end) is None):
-                raise HostInputErrorException(f"Incorrect IP range: {part}")
-
-            start_ip = ipaddress.ip_address(start)
-            end_ip = ipaddress.ip_address(end)
-
-            if start_ip > end_ip:
-                raise HostInputErrorException(f"Incorrect IP range: {part}")
-
-            while start_ip <= end_ip:
-                host_list.append(str(start_ip))
-                start_ip += 1
-        elif '/' in part:
-            # CIDR notation processing (subnet mask)
-            try:
-                network = ipaddress.ip_network(part, strict=False)
-                host_list.extend(str(ip) for ip in network.hosts())
-            except Exception as error:
-                raise HostInputErrorException(f"Incorrect CIDR notation: {part}") from error
-        else:
-            # Single IP address or domain name processing
-            if re.match(IP_PATTERN, part) is not None:
-                host_list.append(part)
-            elif part == 'localhost' or re.match(DOMAIN_PATTERN, part) is not None:
-                host_list.append(part)
-            else:
-                raise HostInputErrorException(f"Incorrect IP address: {part}")
-
-    return host_list
+    return TargetSet.parse(input_string)
 
 
 class MainWindow:
@@ -93,25 +64,49 @@ class MainWindow:
 
     scanner_classes = {
         "ACK": ACKScanner,
+        "COMBINED": CombinedScanner,
+        "CONNECT": ConnectScanner,
         "FIN": FINScanner,
         "NULL": NULLScanner,
         "SYN": SYNScanner,
     }
 
-    result = []
+    flush_scheduled = False
     hosts_count = 0
-    host_edit = Gtk.Entry()
-    spinner = Gtk.Spinner()
-    scan_type_combo = Gtk.ComboBoxText()
-    default_radio = Gtk.RadioButton.new_with_label_from_widget(None, "Default")
-    custom_radio = Gtk.RadioButton.new_from_widget(default_radio)
-    submit_button = Gtk.Button(label="Submit")
-    cancel_button = Gtk.Button(label="Cancel")
-    output_edit = Gtk.TextView()
-    ports_edit = Gtk.Entry()
-    thread_pool = ThreadPoolExecutor(max_workers=1)
+    engine = None
+    job = None
+    discovery = None
+    fallback_scanner = None
+    connect_engine = None
+    metrics_writer = None
+    scanning = False
+    store = None
+    run_id = None
+    run_scan_type = None
+    exporter = None
+    service_detector = None
 
     def __init__(self):
+        self.pending_lines = []
+        self.hosts_lock = threading.Lock()
+        self.lines_lock = threading.Lock()
+        self.thread_pool = ThreadPoolExecutor(max_workers=1)
+        self.fallback_stopped = threading.Event()
+
+        self.host_edit = Gtk.Entry()
+        self.spinner = Gtk.Spinner()
+        self.scan_type_combo = Gtk.ComboBoxText()
+        self.default_radio = Gtk.RadioButton.new_with_label_from_widget(None, "Default")
+        self.custom_radio = Gtk.RadioButton.new_from_widget(self.default_radio)
+        self.submit_button = Gtk.Button(label="Submit")
+        self.cancel_button = Gtk.Button(label="Cancel")
+        self.pause_button = Gtk.ToggleButton(label="Pause")
+        self.output_edit = Gtk.TextView()
+        self.results_view = ResultsView()
+        self.stats_label = Gtk.Label(label="", xalign=0.0)
+        self.ports_edit = Gtk.Entry()
+        self.skip_discovery_check = Gtk.CheckButton(label="Skip host discovery")
+
         self.window = Gtk.Window(title="Scanner")
         self.window.connect("delete-event", Gtk.main_quit)
         self.window.set_default_size(800, 400)
@@ -133,6 +128,8 @@ class MainWindow:
         self.submit_button.connect("clicked", self.start_scan)
         self.cancel_button.connect("clicked", self.cancel_button_clicked)
         self.cancel_button.set_sensitive(False)
+        self.pause_button.connect("toggled", self.on_pause_toggled)
+        self.pause_button.set_sensitive(False)
 
         style_provider = Gtk.CssProvider()
         style_provider.load_from_data(b"""
@@ -144,13 +141,19 @@ class MainWindow:
         context = self.output_edit.get_style_context()
         context.add_provider(style_provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
 
-        overlay = Gtk.Overlay()
-        overlay.add(self.output_edit)
-        overlay.add_overlay(self.spinner)
+        self.results_view.overlay.add_overlay(self.spinner)
 
         output_scroll = Gtk.ScrolledWindow()
         output_scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
-        output_scroll.add(overlay)
+        output_scroll.set_size_request(-1, MESSAGES_HEIGHT)
+        output_scroll.add(self.output_edit)
+
+        right_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=8)
+        right_box.set_margin_top(8)
+        right_box.set_margin_end(8)
+        right_box.set_margin_bottom(8)
+        right_box.pack_start(self.results_view.widget, True, True, 0)
+        right_box.pack_start(output_scroll, False, True, 0)
 
         self.main_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
         self.main_box.set_margin_start(8)
@@ -173,17 +176,17 @@ class MainWindow:
         self.ports_edit.set_text(", ".join([str(i) for i in default_ports]))
         self.left_box.pack_start(self.ports_edit, False, True, 0)
         self.ports_edit.set_sensitive(False)
+        self.left_box.pack_start(self.skip_discovery_check, False, True, 0)
 
         button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         button_box.pack_start(self.submit_button, True, True, 0)
+        button_box.pack_start(self.pause_button, True, True, 0)
         button_box.pack_start(self.cancel_button, True, True, 0)
 
         self.left_box.pack_start(button_box, False, True, 0)
+        self.left_box.pack_start(self.stats_label, False, True, 0)
 
-        self.main_box.pack_start(output_scroll, True, True, 0)
-        self.output_edit.set_margin_top(8)
-        self.output_edit.set_margin_end(8)
-        self.output_edit.set_margin_bottom(8)
+        self.main_box.pack_start(right_box, True, True, 0)
 
         accel_group = Gtk.AccelGroup()
         self.window.add_accel_group(accel_group)
@@ -192,6 +195,21 @@ class MainWindow:
 
         self.window.show_all()
 
+    def on_pause_toggled(self, button):
+        """
+        Pause or resume the scan job.
+
+        :param button: pause toggle button.
+        :return:
+        """
+        paused = button.get_active()
+        button.set_label("Resume" if paused else "Pause")
+        if self.job is not None:
+            if paused:
+                self.job.pause()
+            else:
+                self.job.resume()
+
     def on_custom_toggled(self, button):
         """
         Handle custom ports toggling.
@@ -229,29 +247,344 @@ class MainWindow:
         except HostInputErrorException as error:
             self.output_text(str(error))
 
+        if not hosts:
+            return
+
+        scan_type = self.scan_type_combo.get_active_text()
+        try:
+            if self.ports_edit.get_text() == "":
+                raise CustomPortsNotSpecifiedException("Custom ports are not specified")
+            ports_ = parse_number_string(
+                self.ports_edit.get_text()) if self.custom_radio.get_active() \
+                else named_ports("default")
+        except (CustomPortsNotSpecifiedException, PortInputErrorException) as error:
+            self.output_text(str(error))
+            return
+
         self.hosts_count = len(hosts)
-        self.result = []
-        for host in hosts:
-            scan_type = self.scan_type_combo.get_active_text()
+        self.results_view.clear()
+        self.upload_toggle('start')
+        self.start_metrics()
+        self.start_run(scan_type)
+        self.start_export()
+        self.start_services()
+
+        scanner_class = self.scanner_classes[scan_type]
+        if scanner_class is ConnectScanner:
+            self.connect_engine = ConnectEngine(proxies=ProxyPool.from_config())
+            self.pause_button.set_sensitive(False)
+            self.thread_pool.submit(self.connect_scan, self.connect_engine, hosts, ports_)
+            return
+        self.start_engine(hosts)
+        if self.engine is not None:
+            if self.skip_discovery_check.get_active():
+                self.start_job(hosts, scanner_class, ports_)
+            else:
+                self.discovery = HostDiscovery(self.engine)
+                self.thread_pool.submit(self.discover_hosts, hosts, scanner_class, ports_)
+            return
+        self.fallback_stopped = threading.Event()
+        self.thread_pool.submit(
+            self.scan_sequentially, hosts, scanner_class, ports_, self.fallback_stopped)
+
+    def scan_sequentially(self, hosts, scanner_class, ports_, stopped):
+        """
+        Scan the hosts one after another with one sr1() per port, when there is no
+        probe engine. The scanner of a host is created only when its turn comes.
+        Runs in the thread pool.
+
+        :param hosts: TargetSet of the hosts to scan.
+        :param scanner_class: PortScanner subclass.
+        :param ports_: PortSet of the ports to scan.
+        :param stopped: event set when the scan is cancelled.
+        :return:
+        """
+        RESOLVER.prefetch(hosts.domains)
+        for host in hosts.shuffled() if RANDOMIZE_TARGETS else hosts:
+            if stopped.is_set():
+                return
+            scanner = self.fallback_scanner = scanner_class(host, ports_)
+            future = Future()
             try:
-                if self.ports_edit.get_text() == "":
-                    raise CustomPortsNotSpecifiedException("Custom ports are not specified")
-            except CustomPortsNotSpecifiedException as error:
-                self.output_text(str(error))
+                future.set_result(
+                    scanner.port_scan(functools.partial(self.port_processing, host)))
+            except ScanErrorException as error:
+                future.set_exception(error)
+            if stopped.is_set():
                 return
-            ports_ = parse_number_string(
-                self.ports_edit.get_text()) if self.custom_radio.get_active() \
-                else default_ports
+            self.scan_processing(future, host=host)
+
+    def connect_scan(self, engine, hosts, ports_):
+        """
+        Scan the hosts with a connect engine, which needs no root privileges.
+        Hosts stopped by cancelling the scan are not reported. Runs in the thread pool.
+
+        :param engine: ConnectEngine.
+        :param hosts: TargetSet of the hosts to scan.
+        :param ports_: PortSet of the ports to scan.
+        :return:
+        """
+        def on_host(future, host):
+            if self.connect_engine is engine:
+                self.scan_processing(future, host=host)
+
+        engine.run(hosts, ports_, self.port_processing, on_host)
+
+    def start_job(self, hosts, scanner_class, ports_):
+        """
+        Start the scan job of hosts through the probe engine. Its progress is saved
+        to CHECKPOINT_FILE if set.
+
+        :param hosts: TargetSet of the hosts to scan.
+        :param scanner_class: PortScanner subclass.
+        :param ports_: PortSet of the ports to scan.
+        :return:
+        """
+        RESOLVER.prefetch(hosts.domains)
+        self.job = ScanJob(hosts, ports_, scanner_class, self.engine, CHECKPOINT_FILE)
+        if self.pause_button.get_active():
+            self.job.pause()
+        self.job.start(self.port_processing, self.scan_processing)
+
+    def discover_hosts(self, hosts, scanner_class, ports_):
+        """
+        Find the hosts that are up, then start the scan job of their ports.
+        Runs in the thread pool, see HostDiscovery.
+
+        :param hosts: TargetSet of the scan.
+        :param scanner_class: PortScanner subclass.
+        :param ports_: ports to scan.
+        :return:
+        """
+        discovery = self.discovery
+        if discovery is None:
+            return
+        live = discovery.run(hosts)
+        if self.discovery is not discovery or self.engine is None:
+            return
+        self.discovery = None
+
+        down = len(hosts) - len(live)
+        if down:
+            self.queue_line(f"{down} of {len(hosts)} hosts seem down, "
+                            f"check 'Skip host discovery' to scan them.\n")
+        with self.hosts_lock:
+            self.hosts_count = len(live)
+        if not live:
+            self.update_window_state()
+            return
+        try:
+            self.start_job(live, scanner_class, ports_)
+        except ScanErrorException:
+            return
+
+    def start_engine(self, targets):
+        """
+        Start the probe engine shared by all scanners of the scan.
+        If the engine can not be started, hosts are scanned one after another
+        with one sr1() per port.
+
+        :param targets: TargetSet of the scan.
+        :return:
+        """
+        self.engine = ProbeEngine(targets=targets)
+        try:
+            self.engine.start()
+        except ProbeEngineErrorException:
+            self.engine = None
+
+    def start_metrics(self):
+        """
+        Reset the scan metrics, start the live statistics panel and, if METRICS_FILE
+        is set, the periodic snapshots of the metrics.
+
+        :return:
+        """
+        METRICS.reset()
+        self.scanning = True
+        if METRICS_FILE is not None:
+            self.metrics_writer = MetricsWriter(METRICS)
+            self.metrics_writer.start()
+        GLib.timeout_add(STATS_INTERVAL, self.update_stats)
+
+    def stop_metrics(self):
+        """
+        Stop the periodic snapshots of the metrics.
+
+        :return:
+        """
+        self.scanning = False
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+            self.metrics_writer = None
 
-            self.upload_toggle('start')
+    def update_stats(self):
+        """
+        Show live statistics of the scan. Called periodically while scanning.
+
+        :return: True while scanning, to keep the timer.
+        """
+        snapshot = METRICS.snapshot()
+        counters, gauges = snapshot["counters"], snapshot["gauges"]
+        latency = snapshot["histograms"].get("probe_latency", {})
+        unreachable = sum(value for name, value in counters.items()
+                          if name.startswith("icmp_3_"))
+        queue_depth = gauges.get("send_queue_depth", gauges.get("executor_queue_depth", 0))
+        lines = []
+        engine = self.engine
+        if engine is not None:
+            stats = engine.rate_limiter.stats()
+            lines.append(f"Rate: {stats['pps']:.0f} pps (limit {stats['rate']:.0f})")
+            lines.append(f"Drops: {stats['drop_rate']:.1%}")
+        lines += [
+            f"Sent: {counters.get('probes_sent', 0)} "
+            f"(retransmits: {counters.get('retransmits', 0)})",
+            f"Replies: {counters.get('replies', 0)}",
+            f"Timeouts: {counters.get('timeouts', 0)}",
+            f"ICMP unreachable: {unreachable}",
+            f"Latency p50/p99: {latency.get('p50', 0) * 1000:.1f}/"
+            f"{latency.get('p99', 0) * 1000:.1f} ms",
+            f"Queue: {queue_depth}",
+            f"Hosts: {counters.get('hosts_scanned', 0)} done, "
+            f"{counters.get('host_errors', 0)} failed",
+        ]
+        if "hosts_up" in counters:
+            lines.append(f"Discovery: {counters['hosts_up']} up, "
+                         f"{counters.get('hosts_down', 0)} down")
+        self.stats_label.set_text("\n".join(lines))
+        return self.scanning
+
+    def stop_engine(self):
+        """
+        Stop the scan job and the probe engine of the scan, the connect engine,
+        or the scanners when there is no engine.
+
+        :return:
+        """
+        if self.discovery is not None:
+            self.discovery.stop()
+            self.discovery = None
+        job, self.job = self.job, None
+        if job is not None:
+            job.cancel()
+            if job.cancelled and CHECKPOINT_FILE is not None:
+                self.queue_line(f"Scan cancelled, continue it with "
+                                f"python -m src --resume {CHECKPOINT_FILE}\n")
+        connect_engine, self.connect_engine = self.connect_engine, None
+        if connect_engine is not None:
+            connect_engine.stop()
+        self.fallback_stopped.set()
+        scanner, self.fallback_scanner = self.fallback_scanner, None
+        if scanner is not None:
+            scanner.cancel()
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+
+    def start_export(self):
+        """
+        Stream the reported results of the scan to EXPORT_FILE if set, see create_exporter().
+
+        :return:
+        """
+        if EXPORT_FILE is None:
+            return
+        try:
+            self.exporter = create_exporter(EXPORT_FILE)
+        except OSError as error:
+            self.queue_line(f"Error: results will not be exported: {error}\n")
+
+    def finish_export(self):
+        """
+        Write the remaining results to the export file and close it.
+
+        :return:
+        """
+        exporter, self.exporter = self.exporter, None
+        if exporter is None:
+            return
+        try:
+            exporter.close()
+        except OSError as error:
+            self.queue_line(f"Error: results were not exported: {error}\n")
+
+    def start_services(self):
+        """
+        Start the detection of the services of open ports if SERVICE_DETECTION is set.
+        The detector is kept for the next scans, so that its cache spares them the
+        ports already identified, and it is loaded from SERVICE_CACHE_FILE if set.
+
+        :return:
+        """
+        if not SERVICE_DETECTION or self.service_detector is not None:
+            return
+        cache = ServiceCache()
+        if SERVICE_CACHE_FILE is not None:
+            try:
+                cache.load(SERVICE_CACHE_FILE)
+            except OSError as error:
+                self.queue_line(f"Error: the service cache was not read: {error}\n")
+        self.service_detector = ServiceDetector(cache=cache)
+        self.service_detector.start()
 
-            future = self.thread_pool.submit(
-                self.scanner_classes[scan_type](host, ports_).port_scan)
-            future.add_done_callback(functools.partial(self.scan_processing, host=host))
+    def save_services(self):
+        """
+        Save the services found so far to SERVICE_CACHE_FILE if set.
+
+        :return:
+        """
+        if self.service_detector is None or SERVICE_CACHE_FILE is None:
+            return
+        try:
+            self.service_detector.cache.save(SERVICE_CACHE_FILE)
+        except OSError as error:
+            self.queue_line(f"Error: the service cache was not saved: {error}\n")
+
+    def service_found(self, host, port, future):
+        """
+        Show the service found on an open port.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :param future: future returned by ServiceDetector.submit().
+        :return:
+        """
+        if not future.cancelled() and future.exception() is None:
+            self.results_view.set_service(host, port, str(future.result()))
+
+    def start_run(self, scan_type):
+        """
+        Register the scan in the result store. Storing is disabled
+        if the store can not be opened.
+
+        :param scan_type: name of the scan type.
+        :return:
+        """
+        self.run_scan_type = scan_type
+        try:
+            if self.store is None:
+                self.store = ResultStore()
+            self.run_id = self.store.start_run(scan_type)
+        except InsertDatabaseErrorException:
+            self.run_id = None
+
+    def finish_run(self):
+        """
+        Write the remaining results of the scan to the result store.
+
+        :return:
+        """
+        if self.run_id is None:
+            return
+        run_id, self.run_id = self.run_id, None
+        try:
+            self.store.finish_run(run_id)
+        except InsertDatabaseErrorException as error:
+            self.queue_line(f"Error: results were not saved: {error}\n")
 
     def output_text(self, text):
         """
-        Output text in the output window.
+        Output text in the message window.
 
         :param text: text to be outputted.
         :return:
@@ -261,7 +594,7 @@ class MainWindow:
 
     def append_text(self, text):
         """
-        Append text in the output window.
+        Append text in the message window.
 
         :param text: text to be added.
         :return:
@@ -289,61 +622,121 @@ class MainWindow:
         if state == 'start':
             self.spinner.start()
             self.cancel_button.set_sensitive(True)
+            self.pause_button.set_sensitive(True)
             self.submit_button.set_sensitive(False)
         elif state == 'stop':
             Gdk.threads_enter()
             self.spinner.stop()
             self.cancel_button.set_sensitive(False)
+            self.pause_button.set_active(False)
+            self.pause_button.set_sensitive(False)
             self.submit_button.set_sensitive(True)
             Gdk.threads_leave()
 
     def update_window_state(self):
         """
-        Output results of scanning and update window state.
-        Called when scanning is complete.
+        Update window state. Called when scanning is complete.
 
         :return:
         """
+        self.stop_engine()
+        self.finish_run()
+        self.finish_export()
+        self.save_services()
+        self.stop_metrics()
         self.upload_toggle('stop')
-        self.output_text("".join(self.result))
-        self.result = []
+
+    def queue_line(self, line):
+        """
+        Queue a line for the output window. Queued lines are inserted in batches
+        from the GTK main loop by flush_lines().
+
+        :param line: line to be added.
+        :return:
+        """
+        with self.lines_lock:
+            self.pending_lines.append(line)
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                GLib.idle_add(self.flush_lines)
+
+    def flush_lines(self):
+        """
+        Insert queued lines into the output window, spending at most FRAME_BUDGET
+        seconds per call so the main loop stays responsive.
+
+        :return: True if lines are left, to be called again when the main loop is idle.
+        """
+        deadline = time.monotonic() + FRAME_BUDGET
+        while time.monotonic() < deadline:
+            with self.lines_lock:
+                if not self.pending_lines:
+                    self.flush_scheduled = False
+                    return False
+                batch = self.pending_lines[:FRAME_LINES]
+                del self.pending_lines[:FRAME_LINES]
+            self.append_text("".join(batch))
+        return True
+
+    def port_processing(self, host, port, state):
+        """
+        Processes the result of one port as soon as it is scanned.
+
+        :param host: ip address or domain name that was scanned.
+        :param port: scanned port.
+        :param state: PortState of the port.
+        :return:
+        """
+        if self.run_id is not None:
+            self.store.add(self.run_id, self.run_scan_type, host, port, state)
+        if state in REPORTED_STATES:
+            self.results_view.add(host, port, state)
+            detector = self.service_detector
+            if detector is not None and state == PortState.OPEN:
+                detector.submit(host, port).add_done_callback(
+                    functools.partial(self.service_found, host, port))
+            exporter = self.exporter
+            if exporter is not None:
+                exporter.add(host, port, state, self.run_scan_type, self.host_rtt(host))
+
+    def host_rtt(self, host):
+        """
+        Returns the smoothed round-trip time of a host measured by the probe engine.
+
+        :param host: ip address or domain name.
+        :return: seconds, None if unknown.
+        """
+        engine = self.engine
+        lookup = RESOLVER.submit(host)
+        if engine is None or not lookup.done() or lookup.exception() is not None:
+            return None
+        return engine.srtt(lookup.result())
 
     def scan_processing(self, future, host):
         """
-        Processes the scan results.
+        Processes the end of the scan of a host.
 
         :param future: future object returned by scanner.scan() method.
         :param host: ip address or domain name that was scanned.
         :return:
         """
 
-        try:
+        with self.hosts_lock:
             self.hosts_count -= 1
-            ports_status = future.result()
-            if ports_status == "":
-                self.result.append(
-                    "Host: " +
-                    host +
-                    "\n" +
-                    "All scanned ports are in ignored states.\n")
-            else:
-                self.result.append(
-                    "Host: " +
-                    host +
-                    "\n" +
-                    "PORT\t\tSTATUS\n" +
-                    ports_status +
-                    '\n')
+            last_host = self.hosts_count == 0
+        try:
+            if future.result().count(*REPORTED_STATES) == 0:
+                self.queue_line(
+                    f"{host:<{HOST_COLUMN_WIDTH}}All scanned ports are in ignored states.\n")
         except ScanErrorException as error:
-            self.result.append(
-                "Host: " +
-                host +
-                "\n" +
-                "Error: something went wrong with host " + host + "\n\n")
-        if self.hosts_count == 0:
+            self.queue_line(f"{host:<{HOST_COLUMN_WIDTH}}Error: {error}\n")
+        if last_host:
             self.update_window_state()
 
     def cancel_button_clicked(self, widget):
-        self.hosts_count = 0
-        self.result = []
+        with self.hosts_lock:
+            self.hosts_count = 0
+        with self.lines_lock:
+            self.pending_lines.clear()
+        self.results_view.discard_pending()
         self.update_window_state()
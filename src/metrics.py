@@ -0,0 +1,245 @@
+"""Module providing scan instrumentation."""
+
+import bisect
+import collections
+import functools
+import json
+import threading
+import time
+
+from config import METRICS_FILE, METRICS_INTERVAL
+
+HISTOGRAM_BOUNDS = tuple(0.0001 * 2 ** index for index in range(21))
+
+
+class Histogram:
+    """Histogram of durations with fixed exponential buckets from 0.1 ms to 100 s."""
+
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        """
+        Add a value. Must be called with the lock of the owning Metrics held.
+
+        :param value: duration in seconds.
+        """
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding a percentile.
+
+        :param fraction: percentile between 0 and 1.
+        :return: duration in seconds, 0 for an empty histogram.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return HISTOGRAM_BOUNDS[index] if index < len(HISTOGRAM_BOUNDS) else self.maximum
+        return self.maximum
+
+    def snapshot(self):
+        """
+        Returns the summary of the histogram.
+
+        :return: dict with count, mean, max and p50/p90/p99.
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.maximum,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and duration histograms of scans.
+    When disabled, every method returns immediately.
+    Hooks added with add_hook() are called as hook(name, value) on every update.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_functions = {}
+        self._histograms = {}
+        self._hooks = []
+
+    def inc(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: counter name.
+        :param value: increment.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        for hook in self._hooks:
+            hook(name, value)
+
+    def add_gauge(self, name, delta):
+        """
+        Change a gauge, e.g. a queue depth.
+
+        :param name: gauge name.
+        :param delta: change of the value.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def register_gauge(self, name, function):
+        """
+        Register a gauge read from function at snapshot time.
+
+        :param name: gauge name.
+        :param function: callable returning the value, None to unregister.
+        """
+        with self._lock:
+            if function is None:
+                self._gauge_functions.pop(name, None)
+            else:
+                self._gauge_functions[name] = function
+
+    def observe(self, name, value):
+        """
+        Add a duration to a histogram.
+
+        :param name: histogram name.
+        :param value: duration in seconds.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+        for hook in self._hooks:
+            hook(name, value)
+
+    def add_hook(self, hook):
+        """
+        Add a hook called as hook(name, value) on every counter increment and observation.
+
+        :param hook: callable.
+        """
+        self._hooks.append(hook)
+
+    def instrument(self, func, name):
+        """
+        Wrap a function submitted to an executor. The wrapper keeps the
+        "<name>_queue_depth" gauge of calls waiting for a worker, and observes
+        the queue wait and the duration of each call in the "<name>_wait"
+        and "<name>_duration" histograms.
+
+        :param func: function to wrap.
+        :param name: prefix of the metric names.
+        :return: tuple of the wrapper and a function to call on each submission.
+        """
+        if not self.enabled:
+            return func, lambda: None
+        queue_name, wait_name, duration_name = (
+            f"{name}_queue_depth", f"{name}_wait", f"{name}_duration")
+        submitted = collections.deque()
+
+        def on_submit():
+            submitted.append(time.monotonic())
+            self.add_gauge(queue_name, 1)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            self.add_gauge(queue_name, -1)
+            if submitted:
+                self.observe(wait_name, start - submitted.popleft())
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(duration_name, time.monotonic() - start)
+
+        return wrapper, on_submit
+
+    def snapshot(self):
+        """
+        Returns the current values of all metrics.
+
+        :return: dict with "time", "counters", "gauges" and "histograms".
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            functions = dict(self._gauge_functions)
+            histograms = {name: histogram.snapshot()
+                          for name, histogram in self._histograms.items()}
+        for name, function in functions.items():
+            gauges[name] = function()
+        return {"time": time.time(), "counters": counters, "gauges": gauges,
+                "histograms": histograms}
+
+    def reset(self):
+        """Clear all counters, gauges and histograms."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+class MetricsWriter:
+    """Thread appending a JSON snapshot of the metrics to a file every interval seconds."""
+
+    def __init__(self, metrics, path=METRICS_FILE, interval=METRICS_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start writing snapshots."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._write_loop, name="metrics-writer",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write a last snapshot and stop."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write(self):
+        """Append one snapshot to the file."""
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(self.metrics.snapshot()) + "\n")
+
+    def _write_loop(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+
+METRICS = Metrics()
@@ -0,0 +1,122 @@
+"""Module providing precompiled raw probe packets."""
+
+import socket
+import struct
+
+from scapy.compat import raw
+from scapy.layers.inet import IP, TCP
+
+TCP_OFFSET = 20
+TCP_FIELDS = struct.Struct("!HHII")
+TCP_CHECKSUM = struct.Struct("!H")
+TCP_CHECKSUM_OFFSET = TCP_OFFSET + 16
+TEMPLATE_CACHE_SIZE = 4096
+ECHO_PACKET = struct.Struct("!BBHHHBBH4s4sBBHHH")
+ECHO_PACKET_SIZE = ECHO_PACKET.size
+IP_DEFAULT_TTL = 64
+ICMP_ECHO_REQUEST = 8
+
+
+class PacketTemplate:
+    """
+    Serialized IPv4+TCP probe to one host with one set of flags, built once by scapy.
+    Probes are made by patching the source and destination ports, the sequence and
+    acknowledgement numbers and the TCP checksum in a preallocated buffer. The checksum
+    is updated incrementally from the sum of the template (RFC 1624), and the IP
+    header does not depend on the patched fields, so packets are byte-identical
+    to the ones scapy builds.
+    """
+
+    __slots__ = ('host', 'flags', 'buffer', '_sum')
+
+    def __init__(self, host, flags):
+        self.host = host
+        self.flags = flags
+        self.buffer = bytearray(raw(IP(dst=host) / TCP(sport=0, dport=0, flags=flags,
+                                                       seq=0, ack=0)))
+        (checksum,) = TCP_CHECKSUM.unpack_from(self.buffer, TCP_CHECKSUM_OFFSET)
+        self._sum = ~checksum & 0xFFFF
+
+    def build(self, sport, dport, seq, ack):
+        """
+        Patch the template into the packet of one probe. The buffer is reused
+        by the next call, so the packet must be sent before that.
+
+        :param sport: source port.
+        :param dport: destination port.
+        :param seq: sequence number.
+        :param ack: acknowledgement number.
+        :return: bytearray with the packet.
+        """
+        total = (self._sum + sport + dport + (seq >> 16) + (seq & 0xFFFF) +
+                 (ack >> 16) + (ack & 0xFFFF))
+        total = (total & 0xFFFF) + (total >> 16)
+        total = (total & 0xFFFF) + (total >> 16)
+        TCP_FIELDS.pack_into(self.buffer, TCP_OFFSET, sport, dport, seq, ack)
+        TCP_CHECKSUM.pack_into(self.buffer, TCP_CHECKSUM_OFFSET, ~total & 0xFFFF)
+        return self.buffer
+
+
+class TemplateCache:
+    """Packet templates by (host, flags), dropped all at once when the cache is full."""
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self._templates = {}
+
+    def get(self, host, flags):
+        """
+        Returns the template of a host and flags, building it on first use.
+
+        :param host: ip address of the target.
+        :param flags: TCP flags of the probes.
+        :return: PacketTemplate.
+        """
+        template = self._templates.get((host, flags))
+        if template is None:
+            if len(self._templates) >= self.size:
+                self._templates.clear()
+            template = self._templates[(host, flags)] = PacketTemplate(host, flags)
+        return template
+
+
+def internet_checksum(data):
+    """
+    Returns the one's complement checksum of data (RFC 1071).
+
+    :param data: bytes of even length.
+    :return: 16-bit checksum.
+    """
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def build_echo(host, ident, seq):
+    """
+    Build an ICMP echo request without payload for a raw socket. The kernel fills in
+    the source address, the identification and the checksum of the IP header.
+
+    :param host: ip address of the target.
+    :param ident: echo identifier.
+    :param seq: echo sequence number.
+    :return: bytes of the packet.
+    """
+    icmp_checksum = internet_checksum(struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq))
+    return ECHO_PACKET.pack(0x45, 0, ECHO_PACKET_SIZE, 0, 0, IP_DEFAULT_TTL, socket.IPPROTO_ICMP,
+                            0, bytes(4), socket.inet_aton(host),
+                            ICMP_ECHO_REQUEST, 0, icmp_checksum, ident, seq)
+
+
+def open_raw_socket(iface=None):
+    """
+    Open a raw socket sending complete IPv4 packets.
+
+    :param iface: interface to bind the socket to, the routing table decides if None.
+    :return: socket.socket, packets are sent with sendto(packet, (host, 0)).
+    """
+    raw_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    if iface is not None:
+        raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, str(iface).encode())
+    return raw_socket
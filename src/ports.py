@@ -0,0 +1,221 @@
+"""Module providing the port set type and named port lists."""
+
+import functools
+import re
+
+from config import PORTS_FILE
+from src.utils import PortInputErrorException, default_ports
+
+PORTS_COUNT = 65536
+BITMAP_SIZE = PORTS_COUNT // 8
+POPCOUNT = bytes(bin(value).count("1") for value in range(256))
+NONZERO_RUN_PATTERN = re.compile(rb'[^\x00]+')
+
+
+class PortSet:
+    """
+    Set of ports backed by a 65536-bit bitmap: 8 KB whatever the number of ports.
+    Iterates over the ports in ascending order without building a list.
+    """
+
+    __slots__ = ('bits', '_count')
+
+    def __init__(self, ports=None):
+        self.bits = bytearray(BITMAP_SIZE)
+        self._count = 0
+        if ports is not None:
+            for port in ports:
+                self.add(port)
+
+    @classmethod
+    def from_bitmap(cls, bits):
+        """
+        Create a port set from a bitmap.
+
+        :param bits: bytes-like of BITMAP_SIZE bytes.
+        :return: PortSet.
+        """
+        port_set = cls()
+        port_set.bits[:] = bits
+        port_set._count = None
+        return port_set
+
+    @classmethod
+    def parse(cls, input_string):
+        """
+        Parse a port specification. Parts are separated by commas and are single ports,
+        ranges like "1-1024", or names of port lists (see named_ports()).
+        Parts starting with "!" are excluded from the result,
+        e.g. "default,8000-8100,!8080" or "all,!1-1023".
+
+        :param input_string: The string to parse.
+        :return: PortSet.
+        """
+        included, excluded = cls(), cls()
+        for part in input_string.replace(" ", "").split(","):
+            if not part:
+                continue
+            target = included
+            if part.startswith("!"):
+                target, part = excluded, part[1:]
+            if part.isalpha():
+                target |= named_ports(part)
+            elif "-" in part:
+                start, _, end = part.partition("-")
+                target.add_range(parse_port(start), parse_port(end))
+            else:
+                target.add(parse_port(part))
+        if not included and excluded:
+            included = named_ports("all")
+        return included - excluded
+
+    def __len__(self):
+        if self._count is None:
+            self._count = sum(self.bits.translate(POPCOUNT))
+        return self._count
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, port):
+        return 0 <= port < PORTS_COUNT and bool(self.bits[port >> 3] & (1 << (port & 7)))
+
+    def __iter__(self):
+        bits = bytes(self.bits)
+        for match in NONZERO_RUN_PATTERN.finditer(bits):
+            for index in range(match.start(), match.end()):
+                byte = bits[index]
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (index << 3) | bit
+
+    def __eq__(self, other):
+        if not isinstance(other, PortSet):
+            return NotImplemented
+        return self.bits == other.bits
+
+    def __or__(self, other):
+        return self._combine(other, lambda left, right: left | right)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda left, right: left & ~right)
+
+    def __and__(self, other):
+        return self._combine(other, lambda left, right: left & right)
+
+    def __ior__(self, other):
+        self.bits[:] = (self | other).bits
+        self._count = None
+        return self
+
+    def __repr__(self):
+        return f"PortSet('{self}')"
+
+    def __str__(self):
+        return ",".join(str(start) if start == end else f"{start}-{end}"
+                        for start, end in self.ranges())
+
+    def _combine(self, other, operation):
+        left = int.from_bytes(self.bits, "little")
+        right = int.from_bytes(other.bits, "little")
+        return PortSet.from_bitmap(
+            (operation(left, right) & ((1 << PORTS_COUNT) - 1)).to_bytes(BITMAP_SIZE, "little"))
+
+    def add(self, port):
+        """
+        Add a port.
+
+        :param port: port number.
+        """
+        check_port(port)
+        if port not in self:
+            self.bits[port >> 3] |= 1 << (port & 7)
+            if self._count is not None:
+                self._count += 1
+
+    def add_range(self, start, end):
+        """
+        Add an inclusive range of ports.
+
+        :param start: first port.
+        :param end: last port.
+        """
+        check_port(start)
+        check_port(end)
+        if start > end:
+            raise PortInputErrorException(f"Incorrect port range: {start}-{end}")
+        mask = ((1 << (end - start + 1)) - 1) << start
+        self |= PortSet.from_bitmap(mask.to_bytes(BITMAP_SIZE, "little"))
+
+    def ranges(self):
+        """
+        Returns the ports as inclusive ranges.
+
+        :return: list of (start, end) pairs.
+        """
+        ranges = []
+        for port in self:
+            if ranges and ranges[-1][1] == port - 1:
+                ranges[-1] = (ranges[-1][0], port)
+            else:
+                ranges.append((port, port))
+        return ranges
+
+
+def check_port(port):
+    """
+    Check that a port number is in range.
+
+    :param port: port number.
+    """
+    if not 0 < port < PORTS_COUNT:
+        raise PortInputErrorException(f"Incorrect port: {port}")
+
+
+def parse_port(text):
+    """
+    Parse one port number.
+
+    :param text: The string to parse.
+    :return: port number.
+    """
+    try:
+        port = int(text)
+    except ValueError as error:
+        raise PortInputErrorException(f"Incorrect port: {text}") from error
+    check_port(port)
+    return port
+
+
+@functools.lru_cache(maxsize=None)
+def load_named_ports(name):
+    """
+    Load a named port list once.
+
+    :param name: "default" for the default ports, "extended" for the ports of PORTS_FILE,
+        "all" for every port.
+    :return: PortSet, shared between calls.
+    """
+    if name == "default":
+        return PortSet(default_ports)
+    if name == "all":
+        port_set = PortSet()
+        port_set.add_range(1, PORTS_COUNT - 1)
+        return port_set
+    if name == "extended":
+        try:
+            with open(PORTS_FILE, encoding="utf-8") as file:
+                return PortSet(parse_port(line) for line in file if line.strip())
+        except OSError as error:
+            raise PortInputErrorException(f"Can not read {PORTS_FILE}: {error}") from error
+    raise PortInputErrorException(f"Unknown port list: {name}")
+
+
+def named_ports(name):
+    """
+    Returns a named port list, see load_named_ports().
+
+    :param name: name of the port list.
+    :return: PortSet owned by the caller.
+    """
+    return PortSet.from_bitmap(load_named_ports(name.lower()).bits)
@@ -0,0 +1,138 @@
+"""Module providing the packet rate limiter."""
+
+import threading
+import time
+
+from config import MAX_RATE, MIN_RATE
+
+BURST_SECONDS = 0.05
+ADJUST_INTERVAL = 1.0
+MIN_SAMPLES = 20
+MAX_DROP_RATE = 0.05
+UNREACHABLE_RISE = 0.1
+RATE_DECREASE = 0.5
+RATE_INCREASE = 1.1
+BASELINE_WEIGHT = 0.25
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the number of packets per second sent by the engine.
+    The rate is adjusted every ADJUST_INTERVAL seconds: it is halved when the share
+    of probes answered only after a retransmission or never answered (drops) goes
+    over MAX_DROP_RATE, or when the share of ICMP unreachable replies rises over its
+    usual level, and it grows back towards max_rate while both stay low.
+    """
+
+    def __init__(self, max_rate=MAX_RATE, min_rate=MIN_RATE):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = float(max_rate)
+        self._tokens = self._burst()
+        self._last_fill = time.monotonic()
+        self._last_adjust = self._last_fill
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._samples = 0
+        self._drops = 0
+        self._unreachable = 0
+        self._unreachable_baseline = None
+        self._stats = {
+            "rate": self.rate,
+            "pps": 0.0,
+            "drop_rate": 0.0,
+            "unreachable_rate": 0.0,
+            "sent": 0,
+        }
+
+    def _burst(self):
+        return max(1.0, self.rate * BURST_SECONDS)
+
+    def acquire(self):
+        """Block until one packet may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._adjust(now)
+                self._tokens = min(self._burst(),
+                                   self._tokens + (now - self._last_fill) * self.rate)
+                self._last_fill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._sent += 1
+                    self._stats["sent"] += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def record(self, retransmitted=False, unreachable=False):
+        """
+        Record a reply to a probe.
+
+        :param retransmitted: the probe was answered only after a retransmission.
+        :param unreachable: the reply is an ICMP destination unreachable message.
+        """
+        with self._lock:
+            self._samples += 1
+            if retransmitted:
+                self._drops += 1
+            if unreachable:
+                self._unreachable += 1
+            self._adjust(time.monotonic())
+
+    def record_timeout(self):
+        """Record a probe left unanswered after its last retransmission, as a drop."""
+        with self._lock:
+            self._samples += 1
+            self._drops += 1
+            self._adjust(time.monotonic())
+
+    def _adjust(self, now):
+        """
+        Adjust the rate once per ADJUST_INTERVAL. Must be called with the lock held.
+
+        :param now: current monotonic time.
+        """
+        elapsed = now - self._last_adjust
+        if elapsed < ADJUST_INTERVAL:
+            return
+
+        drop_rate = unreachable_rate = 0.0
+        congested = False
+        if self._samples >= MIN_SAMPLES:
+            drop_rate = self._drops / self._samples
+            unreachable_rate = self._unreachable / self._samples
+            baseline = self._unreachable_baseline
+            if baseline is None:
+                baseline = unreachable_rate
+            congested = (drop_rate > MAX_DROP_RATE or
+                         unreachable_rate > baseline + UNREACHABLE_RISE)
+            self._unreachable_baseline = (
+                (1 - BASELINE_WEIGHT) * baseline + BASELINE_WEIGHT * unreachable_rate)
+
+        if congested:
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+        elif self._sent:
+            self.rate = min(self.max_rate, self.rate * RATE_INCREASE)
+
+        self._stats = {
+            "rate": self.rate,
+            "pps": self._sent / elapsed,
+            "drop_rate": drop_rate,
+            "unreachable_rate": unreachable_rate,
+            "sent": self._stats["sent"],
+        }
+        self._sent = self._samples = self._drops = self._unreachable = 0
+        self._last_adjust = now
+
+    def stats(self):
+        """
+        Returns live statistics of the limiter.
+
+        :return: dict with the current rate limit, the measured packets per second,
+            the drop and ICMP unreachable rates of the last interval and the number
+            of packets sent.
+        """
+        with self._lock:
+            self._adjust(time.monotonic())
+            return dict(self._stats)
@@ -0,0 +1,158 @@
+"""Module providing differential rescans against a baseline of earlier results."""
+
+import math
+import random
+from array import array
+
+from config import RESCAN_SAMPLE_RATE
+from src.results import HostResult, PortState, REPORTED_STATES, PORTS_COUNT, \
+    SCANNED_RUN_PATTERN
+
+PRIORITY_STATES = (PortState.NOT_SCANNED, PortState.OPEN, PortState.OPEN_FILTERED,
+                   PortState.UNKNOWN)
+STABLE_STATES = (PortState.CLOSED, PortState.FILTERED, PortState.UNFILTERED,
+                 PortState.FILTERED_STATEFUL)
+
+
+class Baseline:
+    """
+    Earlier scan results, as the HostResult of each host. Hosts and ports absent
+    from the baseline are NOT_SCANNED.
+    """
+
+    def __init__(self, results=None):
+        self.results = results if results is not None else {}
+
+    def __len__(self):
+        return len(self.results)
+
+    def __contains__(self, host):
+        return host in self.results
+
+    def get(self, host):
+        """
+        Returns the baseline of a host.
+
+        :param host: ip address or domain name.
+        :return: HostResult, None if the host is not in the baseline.
+        """
+        return self.results.get(host)
+
+    @classmethod
+    def from_export(cls, path, scan_type=None):
+        """
+        Load a file written by BinaryExporter, see read_binary(). Later records of
+        a port replace earlier ones. A scan exported with all states is needed for
+        closed ports to be known.
+
+        :param path: path of the file.
+        :param scan_type: only load records of this scan type, all if None.
+        :return: Baseline.
+        """
+        from src.export import read_binary
+
+        records = read_binary(path)
+        type_index = -1
+        if scan_type is not None:
+            if scan_type not in records.scan_types:
+                return cls()
+            type_index = records.scan_types.index(scan_type)
+        states = [array('B', bytes(PORTS_COUNT)) for _ in records.hosts]
+        for host, port, state, record_type in zip(records.host_indexes, records.ports,
+                                                  records.states, records.scan_type_indexes):
+            if type_index < 0 or record_type == type_index:
+                states[host][port] = state
+        return cls({host: HostResult(host, host_states)
+                    for host, host_states in zip(records.hosts, states)
+                    if any(host_states)})
+
+
+class DifferentialScan:
+    """
+    Rescan plan of a target set against a baseline. For each host, ports in
+    PRIORITY_STATES in the baseline (open, ambiguous or never scanned) are all
+    probed first, then a random sample_rate fraction of the ports in
+    STABLE_STATES, so every stable port is checked again once in about
+    1 / sample_rate scans. Results are compared with the baseline port by port,
+    which costs one lookup in the compact HostResult, and only changes are
+    reported, see change().
+    """
+
+    def __init__(self, baseline, sample_rate=RESCAN_SAMPLE_RATE, seed=None):
+        self.baseline = baseline
+        self.sample_rate = sample_rate
+        self._random = random.Random(seed)
+
+    def ports_for(self, host, ports):
+        """
+        Returns the ports of a host to probe, in probing order.
+
+        :param host: ip address or domain name.
+        :param ports: PortSet of the scan.
+        :return: array of port numbers, or ports itself for a host not in the baseline.
+        """
+        result = self.baseline.get(host)
+        if result is None:
+            return ports
+        states = result.states
+        priority, stable = array('H'), array('H')
+        for port in ports:
+            if states[port] in STABLE_STATES:
+                stable.append(port)
+            else:
+                priority.append(port)
+        count = min(len(stable), math.ceil(len(stable) * self.sample_rate))
+        priority.extend(sorted(self._random.sample(stable, count)))
+        return priority
+
+    def change(self, host, port, state):
+        """
+        Compare the result of one port with the baseline. A port missing from the
+        baseline is a change only if its state is reported, e.g. a new open port.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :param state: PortState of the port.
+        :return: PortState in the baseline if the port changed, None otherwise.
+        """
+        result = self.baseline.get(host)
+        old = result.states[port] if result is not None else PortState.NOT_SCANNED
+        if old == state or (old == PortState.NOT_SCANNED and state not in REPORTED_STATES):
+            return None
+        return PortState(old)
+
+    def changes(self, result):
+        """
+        Compare a whole HostResult with the baseline, see change(). Runs of scanned
+        ports equal to the baseline are skipped with one bytes comparison each.
+
+        :param result: HostResult of the rescan.
+        :return: list of (port, old PortState, new PortState) tuples.
+        """
+        baseline = self.baseline.get(result.host)
+        old = baseline.states.tobytes() if baseline is not None else bytes(PORTS_COUNT)
+        new = result.states.tobytes()
+        found = []
+        for match in SCANNED_RUN_PATTERN.finditer(new):
+            start, end = match.span()
+            if old[start:end] == new[start:end]:
+                continue
+            for port in range(start, end):
+                previous = self.change(result.host, port, new[port])
+                if previous is not None:
+                    found.append((port, previous, PortState(new[port])))
+        return found
+
+    def carried(self, result):
+        """
+        Returns the baseline states of the ports of a host that were not probed,
+        so that the baseline can be carried forward to the next scan.
+
+        :param result: HostResult of the rescan.
+        :return: list of (port, PortState) pairs.
+        """
+        baseline = self.baseline.get(result.host)
+        if baseline is None:
+            return []
+        new = result.states
+        return [(port, baseline[port]) for port in baseline.ports() if not new[port]]
@@ -0,0 +1,161 @@
+"""Module providing the cached concurrent resolver of domain name targets."""
+
+import collections
+import re
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from config import RESOLVER_WORKERS, DNS_CACHE_SIZE, DNS_CACHE_TTL, DNS_NEGATIVE_TTL
+from src.metrics import METRICS
+from src.utils import GetIpByDomainNameErrorException, IP_PATTERN
+
+
+class Resolver:
+    """
+    Resolves domain names to IPv4 addresses on a pool of threads, so many names
+    are looked up concurrently and the scan never waits on one lookup at a time.
+    Answers are cached for ttl seconds and failures for negative_ttl seconds,
+    the least recently used names being dropped beyond max_entries. A name that
+    is already being looked up is not looked up again, its callers share the future.
+    """
+
+    def __init__(self, max_workers=RESOLVER_WORKERS, max_entries=DNS_CACHE_SIZE,
+                 ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL, metrics=None):
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.metrics = metrics if metrics is not None else METRICS
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @staticmethod
+    def normalize(name):
+        """
+        Returns the cache key of a domain name, names being case-insensitive.
+
+        :param name: domain name.
+        :return: str.
+        """
+        return name.strip().rstrip(".").lower()
+
+    def submit(self, name):
+        """
+        Start resolving a domain name, unless it is cached or already being resolved.
+        Ip addresses are returned as they are.
+
+        :param name: domain name or ip address.
+        :return: future resolved with the ip address, or failed with
+            GetIpByDomainNameErrorException.
+        """
+        if re.match(IP_PATTERN, name) is not None:
+            future = Future()
+            future.set_result(name)
+            return future
+
+        key = self.normalize(name)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                expires_at, future = entry
+                if expires_at > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.metrics.inc("dns_cache_hits")
+                    return future
+                del self._cache[key]
+            future = self._pending.get(key)
+            if future is not None:
+                self.metrics.inc("dns_shared_lookups")
+                return future
+            future = self._pending[key] = Future()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="resolver")
+            executor = self._executor
+        self.metrics.inc("dns_lookups")
+        executor.submit(self._lookup, key, future)
+        return future
+
+    def resolve(self, name):
+        """
+        Returns the ip address of a domain name, waiting for the lookup if needed.
+
+        :param name: domain name or ip address.
+        :return: ip address.
+        """
+        return self.submit(name).result()
+
+    def prefetch(self, names):
+        """
+        Start resolving many domain names at once without waiting for them.
+        Later submit() and resolve() calls get the shared lookups or the cached answers.
+
+        :param names: iterable of domain names.
+        :return: dict of the future of each name.
+        """
+        return {name: self.submit(name) for name in names}
+
+    def resolve_all(self, names):
+        """
+        Resolve many domain names concurrently and wait for all of them.
+
+        :param names: iterable of domain names.
+        :return: dict of the ip address of each name, or of the exception
+            if the name could not be resolved.
+        """
+        results = {}
+        for name, future in self.prefetch(names).items():
+            error = future.exception()
+            results[name] = error if error is not None else future.result()
+        return results
+
+    def clear(self):
+        """Drop every cached answer and failure."""
+        with self._lock:
+            self._cache.clear()
+
+    def shutdown(self):
+        """Stop the lookup threads, waiting for the lookups being made."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _lookup(self, key, future):
+        """
+        Resolve one name on a lookup thread, cache the outcome and resolve its future.
+
+        :param key: normalized domain name.
+        :param future: future shared by the callers.
+        """
+        started = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(key, None, socket.AF_INET, socket.SOCK_STREAM)
+            if not infos:
+                raise socket.gaierror(f"No address for {key}")
+            result, error, ttl = infos[0][4][0], None, self.ttl
+        except Exception as lookup_error:
+            result, error, ttl = None, lookup_error, self.negative_ttl
+        finished = time.monotonic()
+        self.metrics.observe("dns_latency", finished - started)
+
+        with self._lock:
+            del self._pending[key]
+            if ttl > 0:
+                self._cache[key] = (finished + ttl, future)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        if error is not None:
+            self.metrics.inc("dns_failures")
+            wrapped = GetIpByDomainNameErrorException(error)
+            wrapped.__cause__ = error
+            future.set_exception(wrapped)
+        else:
+            future.set_result(result)
+
+
+RESOLVER = Resolver()
@@ -0,0 +1,154 @@
+"""Module providing the compact scan result model."""
+
+import enum
+import re
+from array import array
+
+PORTS_COUNT = 65536
+SCANNED_RUN_PATTERN = re.compile(rb'[^\x00]+')
+
+
+class PortState(enum.IntEnum):
+    """State of a scanned port, stored as one byte per port."""
+
+    NOT_SCANNED = 0
+    OPEN = 1
+    CLOSED = 2
+    FILTERED = 3
+    OPEN_FILTERED = 4
+    UNFILTERED = 5
+    UNKNOWN = 6
+    FILTERED_STATEFUL = 7
+
+    @property
+    def label(self):
+        """Text shown for the state."""
+        return STATE_LABELS[self]
+
+
+STATE_LABELS = {
+    PortState.NOT_SCANNED: "Not scanned",
+    PortState.OPEN: "Open",
+    PortState.CLOSED: "Closed",
+    PortState.FILTERED: "Filtered",
+    PortState.OPEN_FILTERED: "Open|Filtered",
+    PortState.UNFILTERED: "Unfiltered",
+    PortState.UNKNOWN: "Unknown",
+    PortState.FILTERED_STATEFUL: "Filtered (stateful)",
+}
+
+REPORTED_STATES = (PortState.OPEN, PortState.FILTERED, PortState.OPEN_FILTERED,
+                   PortState.FILTERED_STATEFUL)
+
+
+def format_port(port, state):
+    """
+    Format the result of one port for output. Ports in ignored states are not shown.
+
+    :param port: port number.
+    :param state: PortState of the port.
+    :return: string with result of scanning, empty for ignored states.
+    """
+    if state not in REPORTED_STATES:
+        return ""
+    return f"{port:<{10}}\t\t{STATE_LABELS[state]}\n"
+
+
+class HostResult:
+    """
+    Scan result of one host: a vector of PortState codes indexed by port number.
+    """
+
+    __slots__ = ('host', 'states')
+
+    def __init__(self, host, states=None):
+        self.host = host
+        self.states = states if states is not None else array('B', bytes(PORTS_COUNT))
+
+    def __getitem__(self, port):
+        return PortState(self.states[port])
+
+    def __setitem__(self, port, state):
+        self.states[port] = state
+
+    def __eq__(self, other):
+        if not isinstance(other, HostResult):
+            return NotImplemented
+        return self.host == other.host and self.states == other.states
+
+    def ports(self, *states):
+        """
+        Returns ports in the given states.
+
+        :param states: PortState values, all scanned ports if not given.
+        :return: sorted array of port numbers.
+        """
+        data = self.states.tobytes()
+        if not states:
+            found = array('H')
+            for match in SCANNED_RUN_PATTERN.finditer(data):
+                found.extend(range(match.start(), match.end()))
+            return found
+
+        found = []
+        for state in states:
+            index = data.find(state)
+            while index != -1:
+                found.append(index)
+                index = data.find(state, index + 1)
+        return array('H', sorted(found))
+
+    def open_ports(self):
+        """
+        Returns open ports.
+
+        :return: sorted array of port numbers.
+        """
+        return self.ports(PortState.OPEN)
+
+    def count(self, *states):
+        """
+        Returns the number of ports in the given states.
+
+        :param states: PortState values.
+        :return: number of ports.
+        """
+        data = self.states.tobytes()
+        return sum(data.count(state) for state in states)
+
+    def counts(self):
+        """
+        Returns the number of scanned ports by state.
+
+        :return: dict of PortState to number of ports, without states of no ports.
+        """
+        data = self.states.tobytes()
+        counts = {}
+        for state in PortState:
+            if state != PortState.NOT_SCANNED:
+                count = data.count(state)
+                if count:
+                    counts[state] = count
+        return counts
+
+    def merge(self, other):
+        """
+        Merge two scans of the same host. Ports scanned in other take its state,
+        other ports keep the state of this result.
+
+        :param other: HostResult of a later scan.
+        :return: new HostResult.
+        """
+        states = array('B', self.states)
+        data = other.states.tobytes()
+        for match in SCANNED_RUN_PATTERN.finditer(data):
+            states[match.start():match.end()] = array('B', match.group())
+        return HostResult(self.host, states)
+
+    def format(self):
+        """
+        Format the reported ports for output.
+
+        :return: string with result of scanning, empty if all ports are in ignored states.
+        """
+        return "".join(format_port(port, self[port]) for port in self.ports(*REPORTED_STATES))
@@ -0,0 +1,231 @@
+"""Module providing the list of scan results shown in the main window."""
+
+import re
+import threading
+import time
+
+from src.results import PortState, REPORTED_STATES
+from src.targets import ip_to_int
+from src.utils import IP_PATTERN
+import gi
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GLib, GObject
+
+FRAME_BUDGET = 0.01
+FRAME_ROWS = 2000
+HOST_KEY, PORT, STATE = range(3)
+DOMAIN_KEY_BASE = 1 << 32
+ALL_STATES = "All states"
+
+
+class ResultsView:
+    """
+    Sortable and filterable list of (host, port, state) results. Rows are kept
+    in a Gtk.ListStore of three integer columns, so a row costs a few dozen bytes
+    and sorting is done by Gtk.TreeModelSort in C, without rebuilding the store.
+    Hosts are stored as keys ordering ip addresses numerically, domain names
+    after them in order of appearance; names are looked up only for the rows
+    on screen, and so are the services found on open ports, see set_service().
+    Rows can be added from any thread: they are inserted from the GTK
+    main loop in batches of at most FRAME_BUDGET seconds per call, so the window
+    stays responsive however many results arrive.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        self._keys = {}
+        self._names = {}
+        self._services = {}
+        self._host_text = ""
+        self._host_filter = None
+        self._state_filter = None
+
+        self.host_entry = Gtk.SearchEntry(placeholder_text="Filter hosts")
+        self.state_combo = Gtk.ComboBoxText()
+        self.count_label = Gtk.Label(label="", xalign=1.0)
+        self.tree_view = Gtk.TreeView()
+
+        self.state_combo.append_text(ALL_STATES)
+        for state in REPORTED_STATES:
+            self.state_combo.append_text(state.label)
+        self.state_combo.set_active(0)
+        self.host_entry.connect("search-changed", self.on_filter_changed)
+        self.state_combo.connect("changed", self.on_filter_changed)
+
+        for title, column_id, width, render in (("Host", HOST_KEY, 220, self._render_host),
+                                                ("Port", PORT, 90, None),
+                                                ("Status", STATE, 130, self._render_state)):
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer)
+            if render is None:
+                column.add_attribute(renderer, "text", column_id)
+            else:
+                column.set_cell_data_func(renderer, render)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(width)
+            column.set_resizable(True)
+            column.set_sort_column_id(column_id)
+            self.tree_view.append_column(column)
+        renderer = Gtk.CellRendererText()
+        column = Gtk.TreeViewColumn("Service", renderer)
+        column.set_cell_data_func(renderer, self._render_service)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(260)
+        column.set_resizable(True)
+        self.tree_view.append_column(column)
+        self.tree_view.set_fixed_height_mode(True)
+        self.tree_view.set_enable_search(False)
+        self._set_models()
+
+        filter_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        filter_box.pack_start(self.host_entry, True, True, 0)
+        filter_box.pack_start(self.state_combo, False, True, 0)
+        filter_box.pack_start(self.count_label, False, True, 0)
+
+        scroll = Gtk.ScrolledWindow()
+        scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        scroll.add(self.tree_view)
+        self.overlay = Gtk.Overlay()
+        self.overlay.add(scroll)
+
+        self.widget = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.widget.pack_start(filter_box, False, True, 0)
+        self.widget.pack_start(self.overlay, True, True, 0)
+
+    def _set_models(self):
+        """Create an empty store with its filter and sort models and show it."""
+        self.store = Gtk.ListStore(GObject.TYPE_UINT64, GObject.TYPE_UINT, GObject.TYPE_UINT)
+        self.filter = self.store.filter_new()
+        self.filter.set_visible_func(self._visible)
+        self.sorted = Gtk.TreeModelSort(model=self.filter)
+        self.tree_view.set_model(self.sorted)
+        self._update_count()
+
+    def add(self, host, port, state):
+        """
+        Queue one result. Thread-safe.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :param state: PortState of the port.
+        """
+        with self._lock:
+            self._pending.append((host, port, state))
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                GLib.idle_add(self.flush)
+
+    def set_service(self, host, port, service):
+        """
+        Show the service found on a port. Thread-safe.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :param service: text shown in the Service column.
+        """
+        GLib.idle_add(self._show_service, host, port, service)
+
+    def _show_service(self, host, port, service):
+        self._services[(host, port)] = service
+        self.tree_view.queue_draw()
+        return False
+
+    def discard_pending(self):
+        """Drop the results queued but not shown yet. Thread-safe."""
+        with self._lock:
+            self._pending.clear()
+
+    def clear(self):
+        """Remove every row. Must be called from the GTK main loop."""
+        self.discard_pending()
+        self._keys.clear()
+        self._names.clear()
+        self._services.clear()
+        self._set_models()
+
+    def flush(self):
+        """
+        Insert queued results, spending at most FRAME_BUDGET seconds per call.
+
+        :return: True if results are left, to be called again when the main loop is idle.
+        """
+        deadline = time.monotonic() + FRAME_BUDGET
+        columns = [HOST_KEY, PORT, STATE]
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending:
+                    self._flush_scheduled = False
+                    self._update_count()
+                    return False
+                batch = self._pending[:FRAME_ROWS]
+                del self._pending[:FRAME_ROWS]
+            for host, port, state in batch:
+                self.store.insert_with_valuesv(-1, columns, [self._key(host), port, int(state)])
+        self._update_count()
+        return True
+
+    def on_filter_changed(self, *args):
+        """
+        Show only the rows of the hosts containing the text of host_entry and in
+        the state chosen in state_combo. The view is detached while the rows are
+        filtered again, so it is not updated row by row.
+
+        :param args:
+        :return:
+        """
+        self._host_text = self.host_entry.get_text().strip()
+        self._host_filter = None if not self._host_text else {
+            key for key, name in self._names.items() if self._host_text in name}
+        label = self.state_combo.get_active_text()
+        self._state_filter = next(
+            (int(state) for state in REPORTED_STATES if state.label == label), None)
+        self.tree_view.set_model(None)
+        self.filter.refilter()
+        self.tree_view.set_model(self.sorted)
+        self._update_count()
+
+    def _key(self, host):
+        """
+        Returns the sort key of a host, registering new hosts.
+
+        :param host: ip address or domain name.
+        :return: integer key.
+        """
+        key = self._keys.get(host)
+        if key is None:
+            if re.match(IP_PATTERN, host) is not None:
+                key = ip_to_int(host)
+            else:
+                key = DOMAIN_KEY_BASE + len(self._keys)
+            self._keys[host] = key
+            self._names[key] = host
+            if self._host_filter is not None and self._host_text in host:
+                self._host_filter.add(key)
+        return key
+
+    def _visible(self, model, iter_, data):
+        if self._host_filter is None and self._state_filter is None:
+            return True
+        key, state = model.get(iter_, HOST_KEY, STATE)
+        return ((self._host_filter is None or key in self._host_filter) and
+                (self._state_filter is None or state == self._state_filter))
+
+    def _render_host(self, column, cell, model, iter_, data):
+        cell.set_property("text", self._names.get(model.get_value(iter_, HOST_KEY), ""))
+
+    def _render_service(self, column, cell, model, iter_, data):
+        key, port = model.get(iter_, HOST_KEY, PORT)
+        cell.set_property("text", self._services.get((self._names.get(key), port), ""))
+
+    @staticmethod
+    def _render_state(column, cell, model, iter_, data):
+        cell.set_property("text", PortState(model.get_value(iter_, STATE)).label)
+
+    def _update_count(self):
+        total = len(self.store)
+        shown = self.filter.iter_n_children(None) \
+            if self._host_filter is not None or self._state_filter is not None else total
+        self.count_label.set_text(f"{shown} of {total}" if shown != total else f"{total} rows")
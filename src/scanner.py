@@ -1,125 +1,281 @@
 """Module providing scanner functions."""
 
-import socket
+import importlib
+import itertools
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import re
 
-import requests
-import scapy
-import socks
-from scapy.layers.inet import IP, TCP, ICMP
-
-from config import MAX_WORKERS, TIMEOUT, SOCKS_IP, SOCKS_PORT
+from config import MAX_WORKERS, MAX_RETRIES, MAX_PORTS_IN_FLIGHT, COMBINED_SCAN_FLAGS
+from src.connect import ConnectEngine, ProxyPool
+from src.metrics import METRICS
+from src.resolver import RESOLVER
+from src.results import HostResult, PortState
+from src.timing import RttEstimator
 from src.utils import ScanErrorException, GetIpByDomainNameErrorException, IP_PATTERN
 
+CANCEL_POLL_INTERVAL = 0.05
+
+
+def scapy_inet():
+    """
+    Returns the scapy.layers.inet module. Scapy is imported on first use only,
+    as importing it takes longer than most short scans.
+
+    :return: scapy.layers.inet module.
+    """
+    return importlib.import_module("scapy.layers.inet")
+
 
 class Scanner:
-    """Parent class for PortScanner class."""
+    """
+    Parent class for PortScanner class. Scans are recorded in self.metrics.
+    A scan can be stopped from another thread with cancel().
+    """
 
     def __init__(self, host, ports):
         self.host = host
         self.ports = ports
+        self.metrics = METRICS
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop submitting ports and drop the ones not started yet."""
+        self.cancelled.set()
 
     @staticmethod
     def get_ip_by_domain_name(domain_name):
         """
-        Returns the IP address by domain
+        Returns the IP address by domain, see Resolver.
 
         :param domain_name: domain name to get ip address for.
         """
-        try:
-            ip_address = socket.gethostbyname(domain_name)
-            return ip_address
-        except Exception as error:
-            raise GetIpByDomainNameErrorException(error) from error
+        return RESOLVER.resolve(domain_name)
 
-    def scan(self, func):
+    def scan_iter(self, func):
+        """
+        Scanning ports by execute func with ThreadPoolExecutor.
+        Yields the result of each port as soon as it is ready. At most
+        MAX_PORTS_IN_FLIGHT ports are submitted at a time, the next port being taken
+        from self.ports only when a result has been consumed, so memory does not
+        grow with the number of ports.
+
+        :func: function to execute with ThreadPoolExecutor
+        :return: generator of (port, PortState) pairs
+        """
+        func, on_submit = self.metrics.instrument(func, "executor")
+        ports = iter(self.ports)
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        try:
+            while not self.cancelled.is_set():
+                for port in itertools.islice(ports, MAX_PORTS_IN_FLIGHT - len(futures)):
+                    on_submit()
+                    futures[executor.submit(func, self.host, port)] = port
+                if not futures:
+                    return
+                done, _ = wait(futures, CANCEL_POLL_INTERVAL, FIRST_COMPLETED)
+                for future in done:
+                    yield futures.pop(future), future.result()
+            raise ScanErrorException("Scan cancelled")
+        finally:
+            executor.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+
+    def scan(self, func, callback=None):
         """
         Scanning ports by execute func with ThreadPoolExecutor.
 
         :func: function to execute with ThreadPoolExecutor
-        :return: list of strings with result of scanning
+        :callback: if set, called as callback(port, state) for each port as soon as it
+            is scanned.
+        :return: HostResult with result of scanning
         """
         try:
-            start_time = time.time()
-            text_list = []
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                for port in self.ports:
-                    text_list.append(executor.submit(func, self.host, port))
-            end_time = time.time()
-
-            print(f"Программа выполнилась за {end_time - start_time} секунд")
-            return "".join([t.result() for t in text_list])
+            return self.collect_results(self.scan_iter(func), callback)
         except Exception as error_text:
             raise ScanErrorException(error_text) from error_text
 
+    def collect_results(self, results, callback=None):
+        """
+        Consume streamed results of scanning.
+
+        :param results: iterable of (port, PortState) pairs.
+        :param callback: if set, called as callback(port, state) for each pair.
+        :return: HostResult with result of scanning
+        """
+        start_time = time.monotonic()
+        result = HostResult(self.host)
+        for port, state in results:
+            result[port] = state
+            if callback is not None:
+                callback(port, state)
+
+        self.metrics.inc("hosts_scanned")
+        self.metrics.observe("host_duration", time.monotonic() - start_time)
+        return result
+
 
 class PortScanner(Scanner):
     """Class for port scanning."""
 
-    def __init__(self, host, ports, flags):
+    def __init__(self, host, ports, flags, engine=None):
         super().__init__(host, ports)
         self.flags = flags
+        self.engine = engine
 
-    def port_scan(self):
-        """Scanning ports by call scan() function with port_scan_() func as argument."""
+    @property
+    def techniques(self):
+        """Flags of the probes sent to each port, see combine()."""
+        return (self.flags,)
 
-        def port_scan_(host_, port_):
-            """
-            Scanning port. Sends a packet with the flag defined in self.flag.
-            If port is open, then return "Open" string.
-            If port is filtered, then return "Filtered" string.
-            If the port was not accurately determined to be open or closed,
-            returns "Open|Filtered" string.
+    def classify(self, port_, response, flags=None):
+        """
+        Classify the response to a probe sent with the flag defined in self.flag.
+        If port is open, then return PortState.OPEN.
+        If port is filtered, then return PortState.FILTERED.
+        If the port was not accurately determined to be open or closed,
+        returns PortState.OPEN_FILTERED.
+        RST replies give PortState.UNFILTERED for ACK scan and PortState.CLOSED otherwise,
+        any other reply gives PortState.UNKNOWN.
+
+        :param port_: scanned port.
+        :param response: response packet or None if there was no response.
+        :param flags: flags of the probe, self.flags if None.
+        :return: PortState with result of scanning
+        """
+        if flags is None:
+            flags = self.flags
+        if response is None:
+            if flags in ('A', 'S'):
+                return PortState.FILTERED
+            if flags in ('F', ''):
+                return PortState.OPEN_FILTERED
+
+        if response:
+            inet = scapy_inet()
+            TCP, ICMP = inet.TCP, inet.ICMP
+            if response.haslayer(TCP) and flags == "A" and response.getlayer(
+                    TCP).flags == 0x4:
+                return PortState.UNFILTERED
+            if response.haslayer(TCP) and response.getlayer(TCP).flags == 0x14:
+                return PortState.CLOSED
+            if response.haslayer(TCP) and flags == "S" and response.getlayer(
+                    TCP).flags == 0x12:
+                return PortState.OPEN
+            if (response.haslayer(ICMP) and response.getlayer(ICMP).type == 3 and
+                    int(response.getlayer(ICMP).code) in [1, 2, 3, 9, 10, 13]):
+                return PortState.FILTERED
+
+        return PortState.UNKNOWN
+
+    def combine(self, port_, responses):
+        """
+        Classify a port from the responses to its probes, one per technique.
 
-            :return: string with result of scanning
-            """
-            socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, SOCKS_IP, SOCKS_PORT)
-            socket.socket = socks.socksocket
-
-            packet_ = IP(dst=host_) / TCP(dport=port_, flags=self.flags)
-            response = scapy.layers.inet.sr1(packet_, verbose=0, timeout=TIMEOUT)
-
-            if response is None:
-                if self.flags in ('A', 'S'):
-                    return f"{port_:<{10}}\t\t{'Filtered'}\n"
-                if self.flags in ('F', ''):
-                    return f"{port_:<{10}}\t\t{'Open|Filtered'}\n"
-
-            if response:
-                if (response.haslayer(TCP) and (
-                        self.flags == "A" and response.getlayer(TCP).flags == 0x4) or (
-                        response.getlayer(TCP).flags == 0x14)):
-                    return ""
-                if response.haslayer(TCP) and self.flags == "S" and response.getlayer(
-                        TCP).flags == 0x12:
-                    return f"{port_:<{10}}\t\t{'Open'}\n"
-                if (response.haslayer(ICMP) and response.getlayer(ICMP).type == 3 and
-                        int(response.getlayer(ICMP).code) in [1, 2, 3, 9, 10, 13]):
-                    return f"{port_:<{10}}\t\t{'Filtered'}\n"
-
-            return ""
+        :param port_: scanned port.
+        :param responses: dict of flags to response packet or None, see techniques.
+        :return: PortState with result of scanning
+        """
+        return self.classify(port_, responses[self.flags])
 
+    def resolve(self):
+        """
+        Replace self.host with its ip address if it is a domain name.
+
+        :return: ip address of the host.
+        """
         try:
             if re.match(IP_PATTERN, self.host) is None:
                 self.host = self.get_ip_by_domain_name(self.host)
         except GetIpByDomainNameErrorException as error_text:
             raise ScanErrorException(error_text) from error_text
+        return self.host
+
+    def port_scan(self, callback=None):
+        """
+        Scanning ports by call scan() function with port_scan_() func as argument.
+        If self.engine is set, all ports are probed through the shared probe engine instead.
+
+        :param callback: if set, called as callback(port, state) for each port as soon as
+            it is scanned, see Scanner.scan().
+        :return: HostResult with result of scanning
+        """
+
+        rtt_estimator = RttEstimator()
+
+        def port_scan_(host_, port_):
+            """
+            Scanning port. Sends a packet with each flag of self.techniques
+            and classifies the responses with combine().
+
+            :return: PortState with result of scanning
+            """
+            return self.combine(port_, {flags: probe_(host_, port_, flags)
+                                        for flags in self.techniques})
+
+        def probe_(host_, port_, flags):
+            """
+            Sends a packet with the given flags. The packet is retransmitted
+            up to MAX_RETRIES times with a timeout derived from the round-trip time
+            of the host.
+
+            :return: response packet or None if there was no response.
+            """
+            inet = scapy_inet()
+            response = None
+            first_sent_at = time.monotonic()
+            for tries in range(MAX_RETRIES + 1):
+                packet_ = inet.IP(dst=host_) / inet.TCP(dport=port_, flags=flags)
+                sent_at = time.monotonic()
+                self.metrics.inc("probes_sent")
+                if tries:
+                    self.metrics.inc("retransmits")
+                response = inet.sr1(
+                    packet_, verbose=0, timeout=rtt_estimator.timeout(tries))
+                if response is not None:
+                    received_at = time.monotonic()
+                    if tries == 0:
+                        rtt_estimator.update(received_at - sent_at)
+                    self.metrics.inc("replies")
+                    if response.haslayer(inet.ICMP):
+                        icmp_layer = response.getlayer(inet.ICMP)
+                        self.metrics.inc(f"icmp_{icmp_layer.type}_{icmp_layer.code}")
+                    self.metrics.observe("probe_latency", received_at - first_sent_at)
+                    break
+            else:
+                self.metrics.inc("timeouts")
+
+            return response
+
+        self.resolve()
 
         try:
-            return self.scan(port_scan_)
+            if self.engine is not None:
+                return self.engine_scan(callback)
+            return self.scan(port_scan_, callback)
         except Exception as error_text:
             raise ScanErrorException(error_text) from error_text
 
+    def engine_scan(self, callback=None):
+        """
+        Scanning ports by sending all probes at once through self.engine.
+
+        :param callback: see Scanner.scan().
+        :return: HostResult with result of scanning
+        """
+        responses = self.engine.run_iter(self.host, self.ports, self.techniques)
+        return self.collect_results(
+            ((port, self.combine(port, response)) for port, response in responses), callback)
+
 
 class ACKScanner(PortScanner):
     """
     Class for ack scanning. Scan ports using ack packets.
     """
 
-    def __init__(self, host, ports):
-        super().__init__(host, ports, "A")
+    def __init__(self, host, ports, engine=None):
+        super().__init__(host, ports, "A", engine)
 
 
 class FINScanner(PortScanner):
@@ -127,8 +283,8 @@ class FINScanner(PortScanner):
     Class for fin scanning. Scan ports using fin packets.
     """
 
-    def __init__(self, host, ports):
-        super().__init__(host, ports, "F")
+    def __init__(self, host, ports, engine=None):
+        super().__init__(host, ports, "F", engine)
 
 
 class NULLScanner(PortScanner):
@@ -136,8 +292,8 @@ class NULLScanner(PortScanner):
     Class for null scanning. Scan ports using no packets.
     """
 
-    def __init__(self, host, ports):
-        super().__init__(host, ports, "")
+    def __init__(self, host, ports, engine=None):
+        super().__init__(host, ports, "", engine)
 
 
 class SYNScanner(PortScanner):
@@ -145,5 +301,102 @@ class SYNScanner(PortScanner):
     Class for syn scanning. Scan ports using syn packets.
     """
 
-    def __init__(self, host, ports):
-        super().__init__(host, ports, "S")
+    def __init__(self, host, ports, engine=None):
+        super().__init__(host, ports, "S", engine)
+
+
+class CombinedScanner(PortScanner):
+    """
+    Class for combined scanning. Probes every port with several techniques in one
+    pass, SYN, ACK, FIN and NULL packets by default, so the probes of a port share
+    its timeouts and the host is resolved once. The responses are merged into one
+    state by combine(), e.g. a port whose SYN probe is dropped while its ACK probe
+    is reset is FILTERED_STATEFUL.
+    """
+
+    def __init__(self, host, ports, engine=None, techniques=COMBINED_SCAN_FLAGS):
+        super().__init__(host, ports, None, engine)
+        self._techniques = tuple(techniques)
+
+    @property
+    def techniques(self):
+        """Flags of the probes sent to each port, see combine()."""
+        return self._techniques
+
+    def combine(self, port_, responses):
+        """
+        Merge the states given by each technique:
+        an answer to the SYN probe decides between OPEN and CLOSED;
+        a dropped SYN probe gives FILTERED_STATEFUL if the ACK probe is answered
+        with a reset (UNFILTERED), or a FIN or NULL probe with a reset, the filter
+        telling connection requests apart from other segments, and FILTERED
+        otherwise, as a port dropping every probe may be behind a stateless drop
+        rule or ICMP blocking as well;
+        without a SYN state, a reset to FIN or NULL gives CLOSED, no answer
+        OPEN_FILTERED, and the ACK state is used alone otherwise.
+
+        :param port_: scanned port.
+        :param responses: dict of flags to response packet or None, see techniques.
+        :return: PortState with result of scanning
+        """
+        states = {flags: self.classify(port_, response, flags)
+                  for flags, response in responses.items()}
+        syn, ack = states.get("S"), states.get("A")
+        stealth = [states[flags] for flags in ("F", "") if flags in states]
+        if syn in (PortState.OPEN, PortState.CLOSED):
+            return syn
+        if syn == PortState.FILTERED:
+            if ack == PortState.UNFILTERED or PortState.CLOSED in stealth:
+                return PortState.FILTERED_STATEFUL
+            return PortState.FILTERED
+        if PortState.CLOSED in stealth:
+            return PortState.CLOSED
+        if PortState.OPEN_FILTERED in stealth:
+            return PortState.OPEN_FILTERED
+        if ack is not None:
+            return ack
+        return PortState.UNKNOWN
+
+
+class ConnectScanner(Scanner):
+    """
+    Class for connect scanning. Scan ports by opening TCP connections, which needs
+    no raw sockets, so no root privileges. Connections are made through the
+    SOCKS5 proxies of config.py if any, see ConnectEngine.
+    """
+
+    def __init__(self, host, ports, engine=None):
+        super().__init__(host, ports)
+        if not isinstance(engine, ConnectEngine):
+            engine = ConnectEngine(proxies=ProxyPool.from_config())
+        self.engine = engine
+
+    def cancel(self):
+        """Stop the connect engine, see Scanner.cancel()."""
+        super().cancel()
+        self.engine.stop()
+
+    def port_scan(self, callback=None):
+        """
+        Scanning ports through self.engine.
+
+        :param callback: if set, called as callback(port, state) for each port as soon as
+            it is scanned, see Scanner.scan().
+        :return: HostResult with result of scanning
+        """
+        results = []
+
+        def on_port(_, port, state):
+            if callback is not None:
+                callback(port, state)
+
+        def on_host(future, **_):
+            results.append(future)
+
+        if self.cancelled.is_set():
+            raise ScanErrorException("Scan cancelled")
+        try:
+            self.engine.run([self.host], self.ports, on_port, on_host)
+            return results[0].result()
+        except Exception as error_text:
+            raise ScanErrorException(error_text) from error_text
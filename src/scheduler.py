@@ -0,0 +1,380 @@
+"""Module providing the global scan scheduler."""
+
+import collections
+import functools
+import threading
+import time
+from concurrent.futures import Future
+
+from config import MAX_PROBES_IN_FLIGHT, MAX_PROBES_PER_HOST, MAX_ACTIVE_HOSTS
+from src.resolver import RESOLVER
+from src.results import HostResult
+from src.utils import ScanErrorException, ProbeEngineErrorException
+
+
+class HostJob:
+    """Scan of one host tracked by the scheduler."""
+
+    def __init__(self, scanner, callback=None):
+        self.scanner = scanner
+        self.callback = callback
+        self.future = Future()
+        self.ports = iter(scanner.ports)
+        self.next_port = next(self.ports, None)
+        self.in_flight = 0
+        self.pending_ports = 0
+        self.responses = {}
+        self.result = HostResult(scanner.host)
+        self.finished = False
+        self.started_at = None
+
+    @property
+    def exhausted(self):
+        """True when every port of the host has been submitted."""
+        return self.next_port is None
+
+    def take_port(self):
+        """
+        Returns the next port to probe and advances the port iterator.
+
+        :return: port number.
+        """
+        port = self.next_port
+        self.next_port = next(self.ports, None)
+        return port
+
+
+def has_room(in_flight, cost, limit):
+    """
+    Returns True if cost more probes can be sent without going over limit.
+    There is always room when nothing is in flight.
+
+    :param in_flight: number of probes in flight.
+    :param cost: number of probes to send.
+    :param limit: maximum number of probes in flight.
+    """
+    return in_flight == 0 or in_flight + cost <= limit
+
+
+class ScanScheduler:
+    """
+    Scheduler interleaving (host, port) probes of many port scanners through one
+    probe engine. The probes of every technique of a scanner are sent to a port
+    together, see PortScanner.techniques, and the port is classified once all of
+    them are answered or timed out, so a port probed with several techniques takes
+    about as long as with one.
+    The number of probes in flight is bounded both in total and per host, the probes
+    of a port taking room together and freeing it one by one as they are answered
+    or timed out; a host with no probe in flight may always take one port.
+    Hosts of target sets are taken lazily, at most max_hosts at a time.
+    While paused, no probe is issued and no host is started. Once stopped, replies
+    to the probes still in flight are ignored.
+    Host durations and errors are recorded in the metrics of the engine.
+    """
+
+    def __init__(self, engine, max_in_flight=MAX_PROBES_IN_FLIGHT,
+                 max_in_flight_per_host=MAX_PROBES_PER_HOST, max_hosts=MAX_ACTIVE_HOSTS):
+        self.engine = engine
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.max_hosts = max_hosts
+        self._new = collections.deque()
+        self._active = collections.deque()
+        self._waiting = set()
+        self._sources = collections.deque()
+        self._open_jobs = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._paused = False
+
+    @property
+    def paused(self):
+        """True while the scheduler is paused."""
+        return self._paused
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Start the dispatcher thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._dispatch_loop, name="scan-scheduler", daemon=True)
+        self._thread.start()
+        self.engine.metrics.register_gauge("scheduler_in_flight", lambda: self._in_flight)
+        self.engine.metrics.register_gauge("active_hosts", lambda: self._open_jobs)
+
+    def stop(self):
+        """
+        Stop the dispatcher thread and fail every unfinished host, including the
+        hosts whose ports are all submitted and which wait for replies.
+        """
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            jobs = list(self._new) + list(self._active) + list(self._waiting)
+            self._new.clear()
+            self._active.clear()
+            self._waiting.clear()
+            self._sources.clear()
+            self._condition.notify_all()
+        self.engine.metrics.register_gauge("scheduler_in_flight", None)
+        self.engine.metrics.register_gauge("active_hosts", None)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+        for job in jobs:
+            self._finish(job, ScanErrorException("Scan stopped"))
+
+    def pause(self):
+        """Stop issuing probes. Probes in flight are still answered or timed out."""
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        """Issue probes again after pause()."""
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def submit(self, scanner, callback=None):
+        """
+        Schedule all ports of a port scanner.
+
+        :param scanner: PortScanner instance.
+        :param callback: if set, called as callback(port, state) for each port as soon as
+            it is classified.
+        :return: future resolved with the HostResult of the host.
+        """
+        job = HostJob(scanner, callback)
+        with self._condition:
+            if not self._running:
+                raise ScanErrorException("Scheduler is not started")
+            self._new.append(job)
+            self._open_jobs += 1
+            self._condition.notify_all()
+        return job.future
+
+    def submit_targets(self, targets, make_scanner, callback=None, done_callback=None):
+        """
+        Schedule the scans of many hosts. Hosts are taken from targets only when
+        the scheduler has room for them, so target sets are never materialized.
+
+        :param targets: iterable of hosts, e.g. TargetSet.
+        :param make_scanner: function returning the PortScanner of a host.
+        :param callback: if set, called as callback(host, port, state) for each port as
+            soon as it is classified.
+        :param done_callback: if set, called as done_callback(future, host=host) when
+            a host is finished, the future being the one submit() returns.
+        """
+        with self._condition:
+            if not self._running:
+                raise ScanErrorException("Scheduler is not started")
+            self._sources.append((iter(targets), make_scanner, callback, done_callback))
+            self._condition.notify_all()
+
+    def _has_work(self):
+        """
+        Returns True if the dispatcher has something to do. Must be called with the lock held.
+        Unlike _next_job(), it does not change the round-robin order of the hosts.
+        """
+        if self._paused:
+            return False
+        return bool(self._new or (self._sources and self._open_jobs < self.max_hosts) or
+                    any(self._can_probe(job) for job in self._active))
+
+    def _pull_target(self):
+        """
+        Take the next host from the target sources.
+
+        :return: host job or None.
+        """
+        with self._condition:
+            if not self._sources or self._open_jobs >= self.max_hosts:
+                return None
+            targets, make_scanner, callback, done_callback = self._sources[0]
+        host = next(targets, None)
+        if host is None:
+            with self._condition:
+                if self._sources:
+                    self._sources.popleft()
+            return None
+
+        job = HostJob(make_scanner(host),
+                      functools.partial(callback, host) if callback is not None else None)
+        if done_callback is not None:
+            job.future.add_done_callback(functools.partial(done_callback, host=host))
+        with self._condition:
+            self._open_jobs += 1
+        return job
+
+    def _next_job(self):
+        """
+        Pick the next host to send a probe to, round-robin over active hosts.
+
+        :return: host job or None if no probe can be sent now.
+        """
+        for _ in range(len(self._active)):
+            job = self._active[0]
+            self._active.rotate(-1)
+            if self._can_probe(job):
+                return job
+        return None
+
+    def _can_probe(self, job):
+        """
+        Returns True if the probes of one more port of a host fit in the limits.
+
+        :param job: host job.
+        """
+        cost = len(job.scanner.techniques)
+        return has_room(self._in_flight, cost, self.max_in_flight) and \
+            has_room(job.in_flight, cost, self.max_in_flight_per_host)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._condition:
+                while self._running and not self._has_work():
+                    self._condition.wait()
+                if not self._running:
+                    return
+                new_job = self._new.popleft() if self._new else None
+
+            if new_job is None:
+                new_job = self._pull_target()
+            if new_job is not None:
+                self._activate(new_job)
+                continue
+
+            with self._condition:
+                job = self._next_job()
+                if job is None:
+                    continue
+                port = job.take_port()
+                cost = len(job.scanner.techniques)
+                job.in_flight += cost
+                job.pending_ports += 1
+                self._in_flight += cost
+                if job.exhausted:
+                    self._active.remove(job)
+                    self._waiting.add(job)
+
+            submitted = 0
+            try:
+                for flags in job.scanner.techniques:
+                    self.engine.submit(job.scanner.host, port, flags,
+                                       functools.partial(self._on_reply, job))
+                    submitted += 1
+            except ProbeEngineErrorException as error:
+                with self._condition:
+                    job.in_flight -= cost - submitted
+                    self._in_flight -= cost - submitted
+                    if job in self._active:
+                        self._active.remove(job)
+                    self._waiting.discard(job)
+                self._finish(job, ScanErrorException(error))
+
+    def _activate(self, job):
+        """
+        Resolve the host of a new job and make it eligible for probing.
+        A job whose domain name is still being looked up is queued again
+        when the lookup ends, so the dispatcher never waits on the resolver.
+
+        :param job: host job.
+        """
+        if job.started_at is None:
+            job.started_at = time.monotonic()
+        lookup = RESOLVER.submit(job.scanner.host)
+        if not lookup.done():
+            lookup.add_done_callback(lambda _: self._requeue(job))
+            return
+        try:
+            job.scanner.resolve()
+        except ScanErrorException as error:
+            self._finish(job, error)
+            return
+
+        if job.exhausted:
+            self._finish(job)
+            return
+        with self._condition:
+            if self._running:
+                self._active.append(job)
+                self._condition.notify_all()
+                return
+        self._finish(job, ScanErrorException("Scan stopped"))
+
+    def _requeue(self, job):
+        """
+        Queue a job again for activation.
+
+        :param job: host job.
+        """
+        with self._condition:
+            if self._running:
+                self._new.append(job)
+                self._condition.notify_all()
+                return
+        self._finish(job, ScanErrorException("Scan stopped"))
+
+    def _on_reply(self, job, host, port, flags, response):
+        techniques = job.scanner.techniques
+        with self._condition:
+            job.in_flight -= 1
+            self._in_flight -= 1
+            self._condition.notify_all()
+            if not self._running or job.finished:
+                return
+            if len(techniques) == 1:
+                responses = {flags: response}
+            else:
+                responses = job.responses.setdefault(port, {})
+                responses[flags] = response
+                if len(responses) < len(techniques):
+                    return
+                del job.responses[port]
+        state = job.scanner.combine(port, responses)
+        if job.callback is not None and self._running and not job.finished:
+            job.callback(port, state)
+        with self._condition:
+            if job.finished:
+                return
+            job.result[port] = state
+            job.pending_ports -= 1
+            done = job.exhausted and job.pending_ports == 0
+        if done:
+            self._finish(job)
+
+    def _finish(self, job, error=None):
+        """
+        Resolve the future of a job once.
+
+        :param job: host job.
+        :param error: exception to fail the future with, if any.
+        """
+        with self._condition:
+            if job.finished:
+                return
+            job.finished = True
+            self._open_jobs -= 1
+            self._waiting.discard(job)
+            self._condition.notify_all()
+        metrics = self.engine.metrics
+        if job.started_at is not None:
+            metrics.observe("host_duration", time.monotonic() - job.started_at)
+        if error is not None:
+            metrics.inc("host_errors")
+            job.future.set_exception(error)
+        else:
+            metrics.inc("hosts_scanned")
+            job.future.set_result(job.result)
@@ -0,0 +1,346 @@
+"""Module providing service and banner detection on open ports."""
+
+import asyncio
+import collections
+import json
+import re
+import ssl
+import threading
+import time
+from concurrent.futures import Future
+
+from config import SERVICE_CONCURRENCY, SERVICE_HOST_LIMIT, SERVICE_CONNECT_TIMEOUT, \
+    SERVICE_READ_TIMEOUT, SERVICE_CACHE_SIZE, SERVICE_CACHE_TTL
+from src.metrics import METRICS
+from src.resolver import RESOLVER
+
+BANNER_SIZE = 1024
+BANNER_LENGTH = 120
+TLS_PORTS = frozenset((443, 465, 636, 853, 993, 995, 8443))
+HTTP_PROBE = b"GET / HTTP/1.0\r\nHost: %s\r\nUser-Agent: scanner\r\n\r\n"
+SERVICE_PATTERNS = (
+    ("ssh", re.compile(rb"^SSH-\d")),
+    ("http", re.compile(rb"^HTTP/\d\.\d \d{3}")),
+    ("ftp", re.compile(rb"^220[ -][^\r\n]*ftp", re.IGNORECASE)),
+    ("smtp", re.compile(rb"^220[ -][^\r\n]*(smtp|mail)", re.IGNORECASE)),
+    ("pop3", re.compile(rb"^\+OK")),
+    ("imap", re.compile(rb"^\* OK")),
+    ("vnc", re.compile(rb"^RFB \d{3}\.\d{3}")),
+    ("mysql", re.compile(rb"^.\x00\x00\x00\x0a\d", re.DOTALL)),
+    ("redis", re.compile(rb"^(-ERR|-NOAUTH|\+PONG)")),
+    ("telnet", re.compile(rb"^\xff[\xfb-\xfe]")),
+    ("tls", re.compile(rb"^\x15\x03[\x00-\x04]")),
+)
+SERVER_HEADER = re.compile(rb"^Server:[ \t]*([^\r\n]*)", re.MULTILINE | re.IGNORECASE)
+
+
+def identify(data):
+    """
+    Identify a service by the first bytes it sent.
+
+    :param data: bytes received from the service.
+    :return: (service name, banner) pair, the name being "unknown" if no pattern matches.
+    """
+    name = next((name for name, pattern in SERVICE_PATTERNS if pattern.match(data)), "unknown")
+    match = SERVER_HEADER.search(data) if name == "http" else None
+    line = match.group(1) if match else data.split(b"\n", 1)[0]
+    banner = line.decode("latin-1").strip()
+    banner = "".join(char if char.isprintable() else "." for char in banner)
+    return name, banner[:BANNER_LENGTH]
+
+
+class ServiceInfo:
+    """Service found on a port: its name and the banner it sent."""
+
+    __slots__ = ('name', 'banner')
+
+    def __init__(self, name, banner=""):
+        self.name = name
+        self.banner = banner
+
+    def __eq__(self, other):
+        if not isinstance(other, ServiceInfo):
+            return NotImplemented
+        return (self.name, self.banner) == (other.name, other.banner)
+
+    def __repr__(self):
+        return f"ServiceInfo({self.name!r}, {self.banner!r})"
+
+    def __str__(self):
+        return f"{self.name} {self.banner}" if self.banner else self.name
+
+
+class ServiceCache:
+    """
+    Cache of the services found on (host, port) pairs, kept for ttl seconds of
+    wall-clock time, so that it can be saved and loaded again by a later scan.
+    The least recently used entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=SERVICE_CACHE_SIZE, ttl=SERVICE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host, port):
+        """
+        Returns the cached service of a port.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :return: ServiceInfo, None if not cached or expired.
+        """
+        key = (host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            found_at, service = entry
+            if found_at + self.ttl < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return service
+
+    def put(self, host, port, service, found_at=None):
+        """
+        Cache the service of a port.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :param service: ServiceInfo.
+        :param found_at: unix time of the detection, now if None.
+        """
+        with self._lock:
+            self._entries[(host, port)] = (found_at or time.time(), service)
+            self._entries.move_to_end((host, port))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load(self, path):
+        """
+        Add the entries saved by save(), expired ones excepted. A missing file is
+        an empty cache.
+
+        :param path: path of the file.
+        """
+        try:
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        host, port, name, banner, found_at = json.loads(line)
+                    except ValueError:
+                        continue
+                    if found_at + self.ttl >= time.time():
+                        self.put(host, port, ServiceInfo(name, banner), found_at)
+        except FileNotFoundError:
+            pass
+
+    def save(self, path):
+        """
+        Write the entries as JSON lines.
+
+        :param path: path of the file.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(
+                json.dumps([host, port, service.name, service.banner, found_at]) + "\n"
+                for (host, port), (found_at, service) in entries)
+
+
+class ServiceDetector:
+    """
+    Pipeline identifying the services of open ports on an asyncio event loop
+    running in its own thread, so ports can be fed to it while the port scan
+    goes on. Each port gets one connection: the banner a service sends first
+    (SSH, SMTP, FTP...) is read within read_timeout seconds, otherwise an HTTP
+    request is sent and the answer read. Ports in TLS_PORTS are probed through
+    TLS. At most concurrency connections are open at a time, and at most
+    host_limit to one host. Results are kept in cache, so a port scanned again
+    is not probed again while its entry is valid, and a port being probed is
+    not probed twice.
+    """
+
+    def __init__(self, concurrency=SERVICE_CONCURRENCY, host_limit=SERVICE_HOST_LIMIT,
+                 connect_timeout=SERVICE_CONNECT_TIMEOUT, read_timeout=SERVICE_READ_TIMEOUT,
+                 cache=None, metrics=None):
+        self.concurrency = concurrency
+        self.host_limit = host_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cache = cache if cache is not None else ServiceCache()
+        self.metrics = metrics if metrics is not None else METRICS
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._slots = None
+        self._host_slots = {}
+        self._tls_context = ssl.create_default_context()
+        self._tls_context.check_hostname = False
+        self._tls_context.verify_mode = ssl.CERT_NONE
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Start the thread of the event loop."""
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,),
+                                        name="service-detector", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self, wait=True):
+        """
+        Stop the event loop.
+
+        :param wait: True to finish the ports submitted first, False to abandon them.
+        """
+        if self._loop is None:
+            return
+        if wait:
+            self.join()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def join(self):
+        """Wait for the ports submitted so far."""
+        while True:
+            with self._lock:
+                pending = list(self._pending.values())
+            if not pending:
+                return
+            for future in pending:
+                future.exception()
+
+    def submit(self, host, port):
+        """
+        Queue the detection of the service of an open port. Thread-safe.
+
+        :param host: ip address or domain name.
+        :param port: port number.
+        :return: future resolved with the ServiceInfo of the port.
+        """
+        service = self.cache.get(host, port)
+        if service is not None:
+            self.metrics.inc("service_cache_hits")
+            future = Future()
+            future.set_result(service)
+            return future
+        with self._lock:
+            future = self._pending.get((host, port))
+            if future is not None:
+                return future
+            future = self._pending[(host, port)] = asyncio.run_coroutine_threadsafe(
+                self._detect(host, port), self._loop)
+        future.add_done_callback(lambda _: self._done(host, port))
+        return future
+
+    def _done(self, host, port):
+        with self._lock:
+            self._pending.pop((host, port), None)
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+    async def _detect(self, host, port):
+        """
+        Identify the service of a port and cache it, unless the port could not be
+        connected to.
+
+        :return: ServiceInfo, named "unknown" if the service could not be identified.
+        """
+        started = time.monotonic()
+        try:
+            address = await asyncio.wrap_future(RESOLVER.submit(host))
+        except Exception:
+            return ServiceInfo("unknown")
+        host_slots = self._host_slots.get(address)
+        if host_slots is None:
+            host_slots = self._host_slots[address] = [asyncio.Semaphore(self.host_limit), 0]
+        host_slots[1] += 1
+        try:
+            async with host_slots[0], self._slots:
+                self.metrics.inc("service_probes")
+                self.metrics.add_gauge("services_in_flight", 1)
+                try:
+                    service = await self._probe(address, host, port)
+                finally:
+                    self.metrics.add_gauge("services_in_flight", -1)
+        finally:
+            host_slots[1] -= 1
+            if host_slots[1] == 0:
+                del self._host_slots[address]
+        self.metrics.observe("service_latency", time.monotonic() - started)
+        if service is None:
+            return ServiceInfo("unknown")
+        if service.name != "unknown":
+            self.metrics.inc("services_identified")
+        self.cache.put(host, port, service)
+        return service
+
+    async def _probe(self, address, host, port):
+        """
+        Connect to a port, read its banner or send the HTTP probe.
+
+        :return: ServiceInfo, None if the connection failed.
+        """
+        tls = port in TLS_PORTS
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, port, ssl=self._tls_context if tls else None,
+                                        server_hostname=host if tls else None),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        try:
+            data = await self._read(reader)
+            if not data and not reader.at_eof():
+                writer.write(HTTP_PROBE % host.encode("idna"))
+                data = await self._read(reader)
+        except OSError:
+            data = b""
+        finally:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), self.read_timeout)
+            except (OSError, asyncio.TimeoutError):
+                pass
+        if not data:
+            return ServiceInfo("unknown")
+        name, banner = identify(data)
+        return ServiceInfo(f"ssl/{name}" if tls else name, banner)
+
+    async def _read(self, reader):
+        """
+        Read what a service sends within read_timeout seconds.
+
+        :return: bytes, empty if nothing came.
+        """
+        try:
+            return await asyncio.wait_for(reader.read(BANNER_SIZE), self.read_timeout)
+        except asyncio.TimeoutError:
+            return b""
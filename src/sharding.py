@@ -0,0 +1,332 @@
+"""Module providing scans spread over worker processes."""
+
+import multiprocessing
+import struct
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+from config import SCAN_PROCESSES, MAX_RATE, MIN_RATE, TIMEOUT
+from src.ports import PortSet
+from src.results import HostResult, PortState
+from src.utils import ProbeEngineErrorException, ScanErrorException
+
+RECORD = struct.Struct("!IHB")
+HOST_INDEX = struct.Struct("!I")
+RESULTS, HOST_DONE, HOST_FAILED, ENGINE_FAILED = b"R", b"D", b"E", b"F"
+BATCH_SIZE = 4096
+FLUSH_INTERVAL = 0.05
+
+
+def shard(targets, ports, index, count):
+    """
+    Returns the part of the target space (hosts x ports) scanned by one worker.
+    Hosts are dealt round-robin to the workers when there are at least as many
+    hosts as workers, otherwise every worker scans all hosts and ports are dealt
+    round-robin instead, so a few hosts with many ports are spread as well.
+
+    :param targets: TargetSet.
+    :param ports: PortSet.
+    :param index: index of the worker.
+    :param count: number of workers.
+    :return: tuple of the range of host indexes and the PortSet of the worker.
+    """
+    if len(targets) >= count:
+        return range(index, len(targets), count), ports
+    return range(len(targets)), PortSet(
+        port for position, port in enumerate(ports) if position % count == index)
+
+
+def shard_sports(index, count):
+    """
+    Returns the source ports of one worker, a disjoint part of the source ports
+    of the probe engine, so that the kernel filter of each worker only passes the
+    replies to its own probes.
+
+    :param index: index of the worker.
+    :param count: number of workers.
+    :return: tuple of the first source port and the number of source ports.
+    """
+    from src.engine import SPORT_BASE, SPORT_RANGE
+
+    sport_range = SPORT_RANGE // count
+    return SPORT_BASE + index * sport_range, sport_range
+
+
+class ResultChannel:
+    """
+    Sending end of the channel from a worker to the parent. Port results are packed
+    as RECORD (host index, port, state) into batches of up to BATCH_SIZE records,
+    each message starting with a one-byte tag.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._buffer = bytearray(RESULTS)
+        self._lock = threading.Lock()
+
+    def port(self, index, port, state):
+        """
+        Queue the result of one port.
+
+        :param index: index of the host in the target set.
+        :param port: scanned port.
+        :param state: PortState of the port.
+        """
+        with self._lock:
+            self._buffer += RECORD.pack(index, port, state)
+            if len(self._buffer) >= 1 + BATCH_SIZE * RECORD.size:
+                self._flush()
+
+    def send(self, tag, payload=b""):
+        """
+        Send the queued results, then one message.
+
+        :param tag: one-byte message tag.
+        :param payload: message body.
+        """
+        with self._lock:
+            self._flush()
+            self.connection.send_bytes(tag + payload)
+
+    def flush(self):
+        """Send the queued results."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buffer) > 1:
+            self.connection.send_bytes(self._buffer)
+            del self._buffer[1:]
+
+
+def scan_shard(connection, targets, host_indexes, ports, scanner_class, rate, timeout,
+               sports, socket_factory=None, raw_socket_factory=None):
+    """
+    Worker process: scan one shard through its own probe engine and scheduler
+    and stream the results to the parent.
+
+    :param connection: sending end of a pipe to the parent.
+    :param targets: TargetSet.
+    :param host_indexes: indexes of the hosts of the shard.
+    :param ports: PortSet of the shard.
+    :param scanner_class: PortScanner subclass.
+    :param rate: maximum packets per second of this worker.
+    :param timeout: maximum probe timeout.
+    :param sports: (first source port, number of source ports) of the shard, see shard_sports().
+    :param socket_factory: socket factory of the probe engine.
+    :param raw_socket_factory: raw socket factory of the probe engine.
+    """
+    from src.engine import ProbeEngine
+    from src.ratelimit import RateLimiter
+    from src.scheduler import ScanScheduler
+
+    channel = ResultChannel(connection)
+    engine = ProbeEngine(timeout=timeout, rate_limiter=RateLimiter(rate, min(MIN_RATE, rate)),
+                         socket_factory=socket_factory, raw_socket_factory=raw_socket_factory,
+                         targets=targets, sport_base=sports[0], sport_range=sports[1])
+    try:
+        engine.start()
+    except ProbeEngineErrorException as error:
+        channel.send(ENGINE_FAILED, str(error).encode())
+        connection.close()
+        return
+
+    done = threading.Event()
+    remaining = [len(host_indexes)]
+    lock = threading.Lock()
+    if not host_indexes:
+        done.set()
+
+    def on_host(future, host):
+        error = future.exception()
+        if error is None:
+            channel.send(HOST_DONE, HOST_INDEX.pack(host))
+        else:
+            channel.send(HOST_FAILED, HOST_INDEX.pack(host) + str(error).encode())
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    with engine, ScanScheduler(engine) as scheduler:
+        scheduler.submit_targets(
+            host_indexes, lambda index: scanner_class(targets[index], ports, engine),
+            channel.port, on_host)
+        while not done.wait(FLUSH_INTERVAL):
+            channel.flush()
+    channel.flush()
+    connection.close()
+
+
+class ShardedHost:
+    """Host of a sharded scan whose results are being received."""
+
+    __slots__ = ('host', 'result', 'shards_left', 'error')
+
+    def __init__(self, host, shards):
+        self.host = host
+        self.result = HostResult(host)
+        self.shards_left = shards
+        self.error = None
+
+
+class ShardedScan:
+    """
+    Scan of a target set spread over worker processes, so that building and
+    dissecting packets is not limited to one core by the GIL. The target space
+    is split by shard(), every worker runs its own probe engine with an equal part
+    of the rate and of the source ports, and results stream back through pipes as
+    packed binary records.
+    """
+
+    def __init__(self, targets, ports, scanner_class, processes=SCAN_PROCESSES,
+                 rate=MAX_RATE, timeout=TIMEOUT, socket_factory=None, raw_socket_factory=None):
+        self.targets = targets
+        self.ports = ports
+        self.scanner_class = scanner_class
+        self.processes = max(1, processes)
+        self.rate = rate
+        self.timeout = timeout
+        self.socket_factory = socket_factory
+        self.raw_socket_factory = raw_socket_factory
+        self._workers = []
+        self._hosts = {}
+        self._stopped = threading.Event()
+
+    def run(self, callback=None, done_callback=None):
+        """
+        Run the scan and wait for it, calling the callbacks from this thread.
+        ProbeEngineErrorException is raised if no worker could start its probe
+        engine, before any result is reported; the hosts of a worker that could
+        not start it, or that exited before reporting them, are reported with an error.
+
+        :param callback: if set, called as callback(host, port, state) for each port.
+        :param done_callback: if set, called as done_callback(future, host=host) when
+            a host is finished, the future being resolved with its HostResult.
+        """
+        context = multiprocessing.get_context("spawn")
+        connections = {}
+        for index in range(self.processes):
+            host_indexes, ports = shard(self.targets, self.ports, index, self.processes)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=scan_shard, name=f"scan-shard-{index}", daemon=True,
+                args=(sender, self.targets, host_indexes, ports, self.scanner_class,
+                      self.rate / self.processes, self.timeout,
+                      shard_sports(index, self.processes), self.socket_factory,
+                      self.raw_socket_factory))
+            process.start()
+            sender.close()
+            self._workers.append(process)
+            connections[receiver] = process, set(host_indexes)
+
+        shards_per_host = 1 if len(self.targets) >= self.processes else self.processes
+        engine_failures = 0
+        try:
+            while connections and not self._stopped.is_set():
+                for connection in wait(list(connections), FLUSH_INTERVAL):
+                    process, unreported = connections[connection]
+                    try:
+                        message = connection.recv_bytes()
+                    except EOFError:
+                        del connections[connection]
+                        connection.close()
+                        if unreported:
+                            process.join()
+                            error = f"Worker {process.name} exited with code {process.exitcode}"
+                            self._fail_shard(sorted(unreported), error.encode(),
+                                             shards_per_host, done_callback)
+                        continue
+                    if message[:1] == ENGINE_FAILED:
+                        engine_failures += 1
+                        if engine_failures == self.processes:
+                            raise ProbeEngineErrorException(message[1:].decode())
+                        self._fail_shard(sorted(unreported), message[1:],
+                                         shards_per_host, done_callback)
+                        unreported.clear()
+                        continue
+                    index = self._handle(message, shards_per_host, callback, done_callback)
+                    unreported.discard(index)
+        finally:
+            for connection in connections:
+                connection.close()
+            self.stop()
+
+        for index, entry in list(self._hosts.items()):
+            entry.error = entry.error or ScanErrorException("Scan stopped")
+            self._finish(index, done_callback)
+
+    def stop(self):
+        """Stop the worker processes."""
+        self._stopped.set()
+        for process in self._workers:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self._workers = []
+
+    def _host(self, index, shards_per_host):
+        """
+        Returns the host being received at an index of the target set.
+
+        :return: ShardedHost.
+        """
+        entry = self._hosts.get(index)
+        if entry is None:
+            entry = self._hosts[index] = ShardedHost(self.targets[index], shards_per_host)
+        return entry
+
+    def _handle(self, message, shards_per_host, callback, done_callback):
+        """
+        Dispatch one message of a worker.
+
+        :param message: bytes received from the pipe.
+        :return: index of the host the worker is done with, or None for results.
+        """
+        tag, body = message[:1], memoryview(message)[1:]
+        if tag == RESULTS:
+            for index, port, state in RECORD.iter_unpack(body):
+                entry = self._host(index, shards_per_host)
+                state = PortState(state)
+                entry.result[port] = state
+                if callback is not None:
+                    callback(entry.host, port, state)
+            return None
+
+        (index,) = HOST_INDEX.unpack_from(body)
+        entry = self._host(index, shards_per_host)
+        if tag == HOST_FAILED and entry.error is None:
+            entry.error = ScanErrorException(bytes(body[HOST_INDEX.size:]).decode())
+        entry.shards_left -= 1
+        if entry.shards_left == 0:
+            self._finish(index, done_callback)
+        return index
+
+    def _fail_shard(self, host_indexes, error, shards_per_host, done_callback):
+        """
+        Count a worker whose probe engine could not be started, or which exited
+        early, as failed on each of its hosts it did not report.
+
+        :param host_indexes: indexes of the unreported hosts of the worker.
+        :param error: error message of the worker.
+        """
+        for index in host_indexes:
+            self._handle(HOST_FAILED + HOST_INDEX.pack(index) + error, shards_per_host,
+                         None, done_callback)
+
+    def _finish(self, index, done_callback):
+        """
+        Resolve the future of a received host.
+
+        :param index: index of the host in the target set.
+        :param done_callback: see run().
+        """
+        entry = self._hosts.pop(index)
+        future = Future()
+        if entry.error is not None:
+            future.set_exception(entry.error)
+        else:
+            future.set_result(entry.result)
+        if done_callback is not None:
+            done_callback(future, host=entry.host)
@@ -0,0 +1,221 @@
+"""Module providing the scan target set."""
+
+import bisect
+import ipaddress
+import random
+import re
+import socket
+import struct
+
+from src.utils import HostInputErrorException, IP_PATTERN, DOMAIN_PATTERN
+
+
+def int_to_ip(value):
+    """
+    Returns the dotted IPv4 address of an integer.
+
+    :param value: address as integer.
+    :return: address string.
+    """
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+def ip_to_int(address):
+    """
+    Returns the integer of a dotted IPv4 address.
+
+    :param address: address string.
+    :return: address as integer.
+    """
+    return struct.unpack("!I", socket.inet_aton(address))[0]
+
+
+class TargetSet:
+    """
+    Set of scan targets. IPv4 addresses are kept as sorted, non-overlapping
+    integer intervals, so huge ranges and networks take constant memory,
+    and domain names are kept in input order. Addresses are produced lazily.
+    """
+
+    def __init__(self):
+        self.intervals = []
+        self.domains = {}
+        self._offsets = None
+        self._domain_list = None
+        self._addresses_count = 0
+
+    @classmethod
+    def parse(cls, input_string):
+        """
+        Parse a string of hosts separated by commas and/or hyphens .
+        For example, "127.0.0.1, 192.168.0.2-192.168.0.4, localhost" will return a target set of
+        127.0.0.1, 192.168.0.2, 192.168.0.3, 192.168.0.4 and localhost.
+        Ranges and CIDR networks are stored as intervals, so their size does not matter.
+
+        :param input_string: The string to parse.
+        :return: TargetSet.
+        """
+        if re.match(r'^[a-zA-Zа-яА-ЯёЁ0-9.,/\-\s]+$', input_string) is None:
+            raise HostInputErrorException("Host entered incorrectly.")
+
+        targets = cls()
+        input_string = input_string.strip()
+        input_string = input_string.replace(" ", "")
+
+        input_parts = input_string.split(",")
+
+        for part in input_parts:
+            if '-' in part and re.match(IP_PATTERN, part.split('-')[0]):
+                # Range processing
+                start, _, end = part.partition('-')
+                if (re.match(IP_PATTERN, start) is None or
+                        re.match(IP_PATTERN, end) is None):
+                    raise HostInputErrorException(f"Incorrect IP range: {part}")
+
+                start_ip = ip_to_int(start)
+                end_ip = ip_to_int(end)
+
+                if start_ip > end_ip:
+                    raise HostInputErrorException(f"Incorrect IP range: {part}")
+
+                targets.add_range(start_ip, end_ip)
+            elif '/' in part:
+                # CIDR notation processing (subnet mask)
+                try:
+                    targets.add_network(ipaddress.IPv4Network(part, strict=False))
+                except Exception as error:
+                    raise HostInputErrorException(f"Incorrect CIDR notation: {part}") from error
+            else:
+                # Single IP address or domain name processing
+                if re.match(IP_PATTERN, part) is not None:
+                    targets.add_address(part)
+                elif part == 'localhost' or re.match(DOMAIN_PATTERN, part) is not None:
+                    targets.add_domain(part)
+                else:
+                    raise HostInputErrorException(f"Incorrect IP address: {part}")
+
+        return targets
+
+    def __len__(self):
+        return self._addresses_count + len(self.domains)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        for start, end in self.intervals:
+            for value in range(start, end + 1):
+                yield int_to_ip(value)
+        yield from self.domains
+
+    def __contains__(self, host):
+        try:
+            value = ip_to_int(host)
+        except OSError:
+            return host in self.domains
+        index = bisect.bisect_right(self.intervals, (value, float('inf'))) - 1
+        return index >= 0 and self.intervals[index][1] >= value
+
+    def add_range(self, start, end):
+        """
+        Add an inclusive range of addresses, merging it with overlapping
+        and adjacent ranges.
+
+        :param start: first address as integer.
+        :param end: last address as integer.
+        """
+        if start > end:
+            return
+        index = bisect.bisect_left(self.intervals, (start, start))
+        if index > 0 and self.intervals[index - 1][1] >= start - 1:
+            index -= 1
+        last = index
+        while last < len(self.intervals) and self.intervals[last][0] <= end + 1:
+            start = min(start, self.intervals[last][0])
+            end = max(end, self.intervals[last][1])
+            last += 1
+        removed = sum(right - left + 1 for left, right in self.intervals[index:last])
+        self.intervals[index:last] = [(start, end)]
+        self._addresses_count += end - start + 1 - removed
+        self._offsets = None
+
+    def add_address(self, address):
+        """
+        Add one IPv4 address.
+
+        :param address: address string.
+        """
+        value = ip_to_int(address)
+        self.add_range(value, value)
+
+    def add_network(self, network):
+        """
+        Add the host addresses of a network, as ipaddress.IPv4Network.hosts() does.
+
+        :param network: ipaddress.IPv4Network.
+        """
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if network.prefixlen < network.max_prefixlen - 1:
+            first, last = first + 1, last - 1
+        self.add_range(first, last)
+
+    def add_domain(self, domain):
+        """
+        Add a domain name.
+
+        :param domain: domain name.
+        """
+        self.domains[domain] = None
+        self._domain_list = None
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index >= self._addresses_count:
+            if self._domain_list is None:
+                self._domain_list = list(self.domains)
+            return self._domain_list[index - self._addresses_count]
+        if self._offsets is None:
+            offsets, total = [], 0
+            for start, end in self.intervals:
+                offsets.append(total)
+                total += end - start + 1
+            self._offsets = offsets
+        interval = bisect.bisect_right(self._offsets, index) - 1
+        return int_to_ip(self.intervals[interval][0] + index - self._offsets[interval])
+
+    def shuffled(self, seed=None):
+        """
+        Iterate over all targets in a pseudo-random order, so that consecutive
+        probes go to different subnets, see permutation().
+
+        :param seed: seed of the permutation.
+        :return: generator of targets.
+        """
+        for index in permutation(len(self), seed):
+            yield self[index]
+
+
+def permutation(size, seed=None):
+    """
+    Iterate over range(size) in a pseudo-random order. A full-cycle linear
+    congruential generator over the next power of two is walked, skipping
+    indexes out of range, so no memory is needed for the permutation.
+
+    :param size: number of indexes.
+    :param seed: seed of the permutation.
+    :return: generator of indexes.
+    """
+    if size == 0:
+        return
+    rng = random.Random(seed)
+    modulus = 1 << max(2, (size - 1).bit_length())
+    multiplier = rng.randrange(0, modulus, 4) + 1
+    increment = rng.randrange(1, modulus, 2)
+    value = rng.randrange(modulus)
+    for _ in range(modulus):
+        value = (multiplier * value + increment) % modulus
+        if value < size:
+            yield value
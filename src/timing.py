@@ -0,0 +1,58 @@
+"""Module providing adaptive probe timeouts."""
+
+import threading
+
+from config import TIMEOUT, MIN_RTT_TIMEOUT, INITIAL_RTT_TIMEOUT
+
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+CLOCK_GRANULARITY = 0.01
+
+
+class RttEstimator:
+    """
+    Round-trip time estimator of one host. Keeps the smoothed RTT and its variance
+    as TCP does (RFC 6298) and derives the probe timeout from them.
+    """
+
+    __slots__ = ('srtt', 'rttvar', 'min_timeout', 'max_timeout', 'initial_timeout', '_lock')
+
+    def __init__(self, initial_timeout=INITIAL_RTT_TIMEOUT, min_timeout=MIN_RTT_TIMEOUT,
+                 max_timeout=TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+
+    def update(self, rtt):
+        """
+        Add a round-trip time sample. Samples of retransmitted probes must not be
+        added, since it is unknown which transmission was answered.
+
+        :param rtt: measured round-trip time in seconds.
+        """
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+
+    def timeout(self, tries=0):
+        """
+        Returns the timeout of a probe.
+
+        :param tries: number of times the probe has already been retransmitted,
+            the timeout is doubled for each of them.
+        :return: timeout in seconds.
+        """
+        with self._lock:
+            if self.srtt is None:
+                timeout = self.initial_timeout
+            else:
+                timeout = self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar)
+        timeout = max(self.min_timeout, timeout) * 2 ** tries
+        return min(self.max_timeout, timeout)
@@ -24,6 +24,18 @@ class GetIpByDomainNameErrorException(Exception):
     """Class for exceptions when getting ip by domain name fails."""
 
 
+class ProbeEngineErrorException(Exception):
+    """Class for exceptions when the probe engine fails."""
+
+
+class ProxyErrorException(Exception):
+    """Class for exceptions when no SOCKS proxy can be used."""
+
+
+class PortInputErrorException(Exception):
+    """Class for exceptions when port string is not specified properly."""
+
+
 IP_PATTERN = (
     r'^(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.'
     r'(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.'
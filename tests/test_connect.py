@@ -0,0 +1,122 @@
+"""Tests of the connect scan engine through local SOCKS5 proxies."""
+
+import asyncio
+import socket
+import time
+
+import pytest
+
+from benchmarks.simulator import SimulatedResponder, SimulatedSocksProxy
+from src.connect import ConnectEngine, ProxyPool, SocksProxy
+from src.metrics import Metrics
+from src.ports import PortSet
+from src.results import PortState
+from src.targets import TargetSet
+from src.utils import ScanErrorException
+
+EXPECTED_STATES = {"open": PortState.OPEN, "closed": PortState.CLOSED,
+                   "filtered": PortState.FILTERED}
+
+
+@pytest.fixture
+def responder():
+    responder = SimulatedResponder(open_fraction=0.2, closed_fraction=0.5, rtt=0.002,
+                                   jitter=0.001)
+    responder.start()
+    yield responder
+    responder.stop()
+
+
+@pytest.fixture
+def proxy(responder):
+    proxy = SimulatedSocksProxy(responder)
+    proxy.start()
+    yield proxy
+    proxy.stop()
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def scan(pool, hosts="10.0.0.1-10.0.0.3", ports="1-60", metrics=None):
+    """
+    Scan through a pool of proxies.
+
+    :return: dict of (host, port) -> PortState and list of the futures of the hosts.
+    """
+    found, futures = {}, []
+    engine = ConnectEngine(timeout=0.3, concurrency=32, proxies=pool,
+                           metrics=metrics or Metrics())
+    engine.run(TargetSet.parse(hosts), PortSet.parse(ports),
+               lambda host, port, state: found.__setitem__((host, port), state),
+               lambda future, host: futures.append(future))
+    return found, futures
+
+
+def assert_classified(responder, found, hosts="10.0.0.1-10.0.0.3", ports="1-60"):
+    expected = {(host, port): EXPECTED_STATES[responder.port_state(host, port)]
+                for host in TargetSet.parse(hosts) for port in PortSet.parse(ports)}
+    assert set(expected.values()) == set(EXPECTED_STATES.values())
+    assert found == expected
+
+
+def test_ports_are_classified_through_proxy(responder, proxy):
+    found, futures = scan(ProxyPool([SocksProxy(proxy.host, proxy.port)]))
+
+    assert_classified(responder, found)
+    assert len(futures) == 3 and all(future.exception() is None for future in futures)
+
+
+def test_username_password_authentication(responder):
+    proxy = SimulatedSocksProxy(responder, username="scanner", password="secret")
+    proxy.start()
+    try:
+        found, _ = scan(ProxyPool([SocksProxy(proxy.host, proxy.port, "scanner", "secret")]))
+        assert_classified(responder, found)
+
+        found, futures = scan(ProxyPool([SocksProxy(proxy.host, proxy.port, "scanner", "wrong")]))
+        assert not found
+        assert futures and all(isinstance(future.exception(), ScanErrorException)
+                               for future in futures)
+    finally:
+        proxy.stop()
+
+
+def test_spare_session_is_reused(responder, proxy):
+    async def scenario():
+        socks_proxy = SocksProxy(proxy.host, proxy.port, spare=1)
+        pool = ProxyPool([socks_proxy])
+        host = "10.0.0.1"
+        port = next(port for port in range(1, 1000)
+                    if responder.port_state(host, port) == "open")
+        assert await pool.connect(host, port, 1) == PortState.OPEN
+        for _ in range(100):
+            if socks_proxy._idle:
+                break
+            await asyncio.sleep(0.01)
+        sessions = proxy.sessions
+        reader, writer, reused = await socks_proxy.session(1)
+        writer.close()
+        await pool.close()
+        return reused, sessions, proxy.sessions
+
+    reused, before, after = asyncio.run(scenario())
+
+    assert reused
+    assert before == after == 2
+
+
+def test_failover_when_proxy_is_down(responder, proxy):
+    down = SocksProxy("127.0.0.1", unused_port())
+    up = SocksProxy(proxy.host, proxy.port)
+    metrics = Metrics()
+
+    found, futures = scan(ProxyPool([down, up]), metrics=metrics)
+
+    assert_classified(responder, found)
+    assert all(future.exception() is None for future in futures)
+    assert down.down_until > time.monotonic()
+    assert metrics.snapshot()["counters"]["proxy_errors"] >= 1
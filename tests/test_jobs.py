@@ -0,0 +1,122 @@
+"""Tests of scan jobs and their checkpoint files."""
+
+import threading
+
+from benchmarks.simulator import SimulatedResponder
+from src.engine import ProbeEngine
+from src.jobs import FINISHED, PARTIAL, FinishedHosts, ScanJob, read_checkpoint, \
+    read_records, write_header, write_host
+from src.ports import PortSet
+from src.ratelimit import RateLimiter
+from src.results import HostResult, PortState
+from src.scanner import SYNScanner
+from src.targets import TargetSet
+
+
+def make_result(host, states):
+    result = HostResult(host)
+    for port, state in states.items():
+        result[port] = state
+    return result
+
+
+def test_finished_hosts_keep_reported_ports_only():
+    finished = FinishedHosts(20)
+    finished.add(3, make_result("10.0.0.4", {22: PortState.OPEN, 23: PortState.CLOSED,
+                                             80: PortState.FILTERED}))
+    finished.add(17, make_result("10.0.0.18", {25: PortState.CLOSED}))
+    finished.add(3, make_result("10.0.0.4", {}))
+
+    assert len(finished) == 2
+    assert 3 in finished and 17 in finished and 4 not in finished
+    assert list(finished) == [3, 17]
+    assert finished.result(3, "10.0.0.4") == make_result(
+        "10.0.0.4", {22: PortState.OPEN, 80: PortState.FILTERED})
+    assert not finished.result(17, "10.0.0.18").ports()
+
+
+def test_resume_compacts_partial_records(tmp_path):
+    path = tmp_path / "scan.checkpoint"
+    targets, ports = TargetSet.parse("10.0.0.1-10.0.0.2"), PortSet.parse("1-100")
+    with open(path, "wb") as checkpoint:
+        write_header(checkpoint, targets, ports, SYNScanner)
+        for last_port in (10, 20, 30):
+            write_host(checkpoint, PARTIAL, 0, make_result(
+                targets[0], {port: PortState.CLOSED for port in range(1, last_port)}))
+        write_host(checkpoint, FINISHED, 1, make_result(targets[1], {22: PortState.OPEN}))
+        write_host(checkpoint, PARTIAL, 0, make_result(targets[0], {1: PortState.OPEN}))
+        write_host(checkpoint, FINISHED, 0, make_result(targets[0], {80: PortState.OPEN}))
+
+    found = []
+    job = ScanJob.from_checkpoint(str(path), ProbeEngine())
+    job.start(lambda host, port, state: found.append((host, port, state)))
+
+    assert job.done
+    assert sorted(found) == [(targets[0], 80, PortState.OPEN), (targets[1], 22, PortState.OPEN)]
+    with open(path, "rb") as checkpoint:
+        checkpoint.readline()
+        assert [(tag, index) for tag, index, _ in read_records(checkpoint)] == [
+            (FINISHED, 1), (FINISHED, 0)]
+
+
+def test_cancelled_job_resumes_without_missing_ports(tmp_path):
+    path = str(tmp_path / "scan.checkpoint")
+    responder = SimulatedResponder(open_fraction=0.1, closed_fraction=0.5, rtt=0.002,
+                                   jitter=0.001)
+    responder.start()
+    engine = ProbeEngine(timeout=0.2, rate_limiter=RateLimiter(20000, 20000),
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    targets, ports = TargetSet.parse("10.0.0.0/28"), PortSet.parse("1-300")
+    found = {}
+    halfway = threading.Event()
+
+    def on_port(host, port, state):
+        found[(host, port)] = state
+        if len(found) >= len(targets) * len(ports) // 2:
+            halfway.set()
+
+    with engine:
+        job = ScanJob(targets, ports, SYNScanner, engine, path, checkpoint_interval=0.05)
+        job.start(on_port)
+        assert halfway.wait(30)
+        job.cancel()
+        _, _, _, finished, partial = read_checkpoint(path)
+        assert len(finished) < len(targets) and partial
+
+        found.clear()
+        job = ScanJob.from_checkpoint(path, engine, checkpoint_interval=0.05)
+        job.start(on_port)
+        assert job.wait(30)
+    responder.stop()
+
+    for host in targets:
+        for port in ports:
+            expected = responder.port_state(host, port)
+            if expected == "open":
+                assert found.get((host, port)) == PortState.OPEN
+            elif expected == "filtered":
+                assert found.get((host, port)) == PortState.FILTERED
+    _, _, _, finished, partial = read_checkpoint(path)
+    assert len(finished) == len(targets) and not partial
+
+
+def test_cancel_with_probes_in_flight_reports_nothing():
+    responder = SimulatedResponder(open_fraction=1.0, rtt=2.0, jitter=0.0)
+    responder.start()
+    engine = ProbeEngine(timeout=5, rate_limiter=RateLimiter(20000, 20000),
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    found, hosts = [], []
+    engine.start()
+    job = ScanJob(TargetSet.parse("10.0.0.1"), PortSet.parse("1-10"), SYNScanner, engine)
+    job.start(lambda host, port, state: found.append((port, state)),
+              lambda future, host: hosts.append(future))
+    assert not job.wait(0.5)
+
+    job.cancel()
+    engine.stop()
+    responder.stop()
+
+    assert job.done and job.cancelled
+    assert found == [] and hosts == []
@@ -0,0 +1,58 @@
+"""Tests of precompiled probe packets."""
+
+import itertools
+
+import pytest
+from scapy.compat import raw
+from scapy.layers.inet import IP, TCP
+
+from config import COMBINED_SCAN_FLAGS
+from src.engine import Probe, ProbeEngine
+from src.packets import TCP_CHECKSUM, TCP_CHECKSUM_OFFSET, PacketTemplate
+
+HOST = "192.0.2.17"
+SPORTS = (1, 40000, 56383, 65535)
+DPORTS = (1, 22, 443, 65535)
+SEQS = (0, 1, 0x0000FFFF, 0xDEADBEEF, 0xFFFFFFFF)
+
+
+def scapy_packet(flags, sport, dport, seq):
+    return raw(IP(dst=HOST) / TCP(sport=sport, dport=dport, flags=flags, seq=seq,
+                                  ack=seq if 'A' in flags else 0))
+
+
+def template_packet(template, sport, dport, seq):
+    return bytes(template.build(sport, dport, seq, seq if 'A' in template.flags else 0))
+
+
+@pytest.mark.parametrize("flags", COMBINED_SCAN_FLAGS)
+def test_template_matches_scapy(flags):
+    template = PacketTemplate(HOST, flags)
+
+    for sport, dport, seq in itertools.product(SPORTS, DPORTS, SEQS):
+        assert template_packet(template, sport, dport, seq) == \
+            scapy_packet(flags, sport, dport, seq), (sport, dport, seq)
+
+
+@pytest.mark.parametrize("flags", COMBINED_SCAN_FLAGS)
+@pytest.mark.parametrize("sport, dport", [(40000, 80), (65535, 65535)])
+def test_template_matches_scapy_when_sum_folds_to_0xffff(flags, sport, dport):
+    template = PacketTemplate(HOST, flags)
+    (base,) = TCP_CHECKSUM.unpack_from(template_packet(template, sport, dport, 0),
+                                       TCP_CHECKSUM_OFFSET)
+    # The sequence number is added once, or twice with the acknowledgement
+    # number, to a sum of ~base: pick it so the sum is a multiple of 0xFFFF.
+    seq = base * 0x8000 % 0xFFFF if 'A' in flags else base
+
+    packet = template_packet(template, sport, dport, seq)
+
+    assert TCP_CHECKSUM.unpack_from(packet, TCP_CHECKSUM_OFFSET) == (0,)
+    assert packet == scapy_packet(flags, sport, dport, seq)
+
+
+@pytest.mark.parametrize("flags", COMBINED_SCAN_FLAGS)
+def test_engine_builds_raw_like_scapy(flags):
+    engine = ProbeEngine()
+    probe = Probe(HOST, 8080, flags, 41234, engine.cookie(HOST, 8080, 41234), None)
+
+    assert bytes(engine.build_raw(probe)) == raw(engine.build_packet(probe))
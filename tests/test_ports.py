@@ -0,0 +1,45 @@
+"""Tests of the port set type and named port lists."""
+
+import pytest
+
+from src.ports import PortSet, named_ports
+from src.utils import PortInputErrorException, default_ports
+
+
+def test_parse_ports_and_ranges():
+    ports = PortSet.parse("22, 80-82,443,80")
+
+    assert list(ports) == [22, 80, 81, 82, 443]
+    assert len(ports) == 5
+    assert ports.ranges() == [(22, 22), (80, 82), (443, 443)]
+    assert str(ports) == "22,80-82,443"
+
+
+def test_parse_names():
+    assert PortSet.parse("default") == PortSet(default_ports)
+    assert PortSet.parse("DEFAULT,65535") == PortSet(default_ports + [65535])
+    assert len(PortSet.parse("all")) == 65535
+    assert list(PortSet.parse("all"))[:2] == [1, 2]
+
+
+def test_parse_exclusions():
+    assert PortSet.parse("1-100,!50-99,!1") == PortSet([*range(2, 50), 100])
+    assert PortSet.parse("default,8000-8002,!8001,!80") == \
+        (PortSet(default_ports) | PortSet([8000, 8002])) - PortSet([80, 8001])
+    assert PortSet.parse("!1-1023") == PortSet(range(1024, 65536))
+    assert PortSet.parse("all,!default") == named_ports("all") - PortSet(default_ports)
+    assert not PortSet.parse("22,!22")
+
+
+def test_named_ports_are_copies():
+    port = next(port for port in range(1, 65536) if port not in default_ports)
+    ports = named_ports("default")
+    ports.add(port)
+
+    assert port in ports and port not in named_ports("default")
+
+
+@pytest.mark.parametrize("text", ["0", "65536", "10-5", "1-x", "http", "!nope", "-1"])
+def test_parse_rejects_incorrect_ports(text):
+    with pytest.raises(PortInputErrorException):
+        PortSet.parse(text)
@@ -0,0 +1,45 @@
+"""Tests of the compact scan result model."""
+
+from src.results import HostResult, PortState, REPORTED_STATES, format_port
+
+
+def make_result(states):
+    result = HostResult("10.0.0.1")
+    for port, state in states.items():
+        result[port] = state
+    return result
+
+
+def test_merge_takes_scanned_ports_of_later_scan():
+    earlier = make_result({22: PortState.OPEN, 23: PortState.CLOSED, 80: PortState.FILTERED})
+    later = make_result({23: PortState.OPEN, 80: PortState.CLOSED, 65535: PortState.FILTERED})
+
+    merged = earlier.merge(later)
+
+    assert merged == make_result({22: PortState.OPEN, 23: PortState.OPEN,
+                                  80: PortState.CLOSED, 65535: PortState.FILTERED})
+    assert earlier[23] == PortState.CLOSED and later[22] == PortState.NOT_SCANNED
+
+
+def test_ports_and_counts():
+    result = make_result({1: PortState.OPEN, 2: PortState.OPEN, 3: PortState.CLOSED,
+                          1000: PortState.FILTERED, 65535: PortState.OPEN_FILTERED})
+
+    assert list(result.ports()) == [1, 2, 3, 1000, 65535]
+    assert list(result.open_ports()) == [1, 2]
+    assert list(result.ports(*REPORTED_STATES)) == [1, 2, 1000, 65535]
+    assert result.count(PortState.OPEN, PortState.CLOSED) == 3
+    assert result.count(PortState.UNFILTERED) == 0
+    assert result.counts() == {PortState.OPEN: 2, PortState.CLOSED: 1, PortState.FILTERED: 1,
+                               PortState.OPEN_FILTERED: 1}
+
+
+def test_format_shows_reported_states_only():
+    result = make_result({22: PortState.OPEN, 23: PortState.CLOSED,
+                          443: PortState.FILTERED_STATEFUL, 8080: PortState.UNFILTERED})
+
+    assert result.format() == format_port(22, PortState.OPEN) + \
+        format_port(443, PortState.FILTERED_STATEFUL)
+    assert format_port(22, PortState.OPEN) == "22        \t\tOpen\n"
+    assert format_port(23, PortState.CLOSED) == ""
+    assert make_result({}).format() == ""
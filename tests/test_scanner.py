@@ -0,0 +1,138 @@
+"""Tests of the combined scan and of probe windows counted in probes."""
+
+import threading
+
+import pytest
+from scapy.layers.inet import ICMP, IP, TCP
+
+from benchmarks.simulator import SimulatedResponder
+from src.engine import ProbeEngine
+from src.ports import PortSet
+from src.ratelimit import RateLimiter
+from src.results import PortState
+from src.scanner import CombinedScanner, SYNScanner
+from src.scheduler import ScanScheduler, has_room
+
+SYN_ACK = IP() / TCP(flags="SA")
+RESET_ACK = IP() / TCP(flags="RA")
+RESET = IP() / TCP(flags="R")
+PROHIBITED = IP() / ICMP(type=3, code=13)
+
+
+def combine(syn, ack, fin, null):
+    scanner = CombinedScanner("10.0.0.1", PortSet([80]))
+    return scanner.combine(80, {"S": syn, "A": ack, "F": fin, "": null})
+
+
+@pytest.mark.parametrize("responses, state", [
+    ((SYN_ACK, None, None, None), PortState.OPEN),
+    ((RESET_ACK, RESET, RESET_ACK, RESET_ACK), PortState.CLOSED),
+    ((None, None, None, None), PortState.FILTERED),
+    ((PROHIBITED, PROHIBITED, PROHIBITED, PROHIBITED), PortState.FILTERED),
+    ((None, PROHIBITED, None, None), PortState.FILTERED),
+    ((None, RESET, None, None), PortState.FILTERED_STATEFUL),
+    ((PROHIBITED, RESET, PROHIBITED, None), PortState.FILTERED_STATEFUL),
+    ((None, RESET, RESET_ACK, RESET_ACK), PortState.FILTERED_STATEFUL),
+    ((PROHIBITED, None, None, RESET_ACK), PortState.FILTERED_STATEFUL),
+])
+def test_combine(responses, state):
+    assert combine(*responses) == state
+
+
+def test_combine_without_syn():
+    scanner = CombinedScanner("10.0.0.1", PortSet([80]), techniques=("A", "F"))
+
+    assert scanner.combine(80, {"A": None, "F": None}) == PortState.OPEN_FILTERED
+    assert scanner.combine(80, {"A": None, "F": RESET_ACK}) == PortState.CLOSED
+    assert CombinedScanner("10.0.0.1", PortSet([80]), techniques=("A",)).combine(
+        80, {"A": RESET}) == PortState.UNFILTERED
+
+
+class CountingEngine(ProbeEngine):
+    """ProbeEngine keeping the highest number of probes in flight to one host."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = {}
+        self.highest = 0
+        self._count_lock = threading.Lock()
+
+    def submit(self, host, port, flags, callback):
+        with self._count_lock:
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.highest = max(self.highest, self.in_flight[host])
+
+        def on_reply(*args):
+            with self._count_lock:
+                self.in_flight[host] -= 1
+            callback(*args)
+
+        super().submit(host, port, flags, on_reply)
+
+
+@pytest.fixture
+def responder():
+    responder = SimulatedResponder(open_fraction=0.1, closed_fraction=0.5, rtt=0.002,
+                                   jitter=0.001, unreachable=0.2, syn_only=0.5)
+    responder.start()
+    yield responder
+    responder.stop()
+
+
+def make_engine(responder):
+    return CountingEngine(timeout=0.1, max_retries=0, rate_limiter=RateLimiter(50000, 50000),
+                          socket_factory=responder.socket,
+                          raw_socket_factory=responder.raw_socket)
+
+
+def expected_state(responder, host, port):
+    state = responder.port_state(host, port)
+    if state == "open":
+        return PortState.OPEN
+    if state == "closed":
+        return PortState.CLOSED
+    if responder.filters_syn_only(host, port):
+        return PortState.FILTERED_STATEFUL
+    return PortState.FILTERED
+
+
+@pytest.mark.parametrize("per_host", [2, 8, 9])
+def test_scheduler_counts_probes_per_host(responder, per_host):
+    host, ports = "10.0.0.1", PortSet.parse("1-100")
+    with make_engine(responder) as engine, \
+            ScanScheduler(engine, max_in_flight_per_host=per_host) as scheduler:
+        result = scheduler.submit(CombinedScanner(host, ports, engine)).result(60)
+
+    assert all(result[port] == expected_state(responder, host, port) for port in ports)
+    assert max(4, per_host) - 4 < engine.highest <= max(4, per_host)
+
+
+def test_run_iter_window_counts_probes(responder):
+    host, ports = "10.0.0.2", PortSet.parse("1-200")
+    with make_engine(responder) as engine:
+        combined = CombinedScanner(host, ports, engine)
+        responses = dict(engine.run_iter(host, ports, combined.techniques, window=12))
+        highest_combined, engine.highest = engine.highest, 0
+        syn = dict(engine.run_iter(host, ports, "S", window=12))
+
+    assert highest_combined == 12 and engine.highest == 12
+    assert all(combined.combine(port, responses[port]) ==
+               expected_state(responder, host, port) for port in ports)
+    assert all(SYNScanner(host, ports).classify(port, syn[port]) in
+               (PortState.OPEN, PortState.CLOSED, PortState.FILTERED) for port in ports)
+
+
+def test_has_room():
+    assert has_room(0, 4, 2)
+    assert has_room(4, 4, 8) and not has_room(5, 4, 8)
+
+
+def test_scheduler_combines_single_technique(responder):
+    host, ports = "10.0.0.3", PortSet.parse("1-100")
+    with make_engine(responder) as engine, ScanScheduler(engine) as scheduler:
+        result = scheduler.submit(CombinedScanner(host, ports, engine, ("A",))).result(60)
+
+    for port in ports:
+        filtered = responder.port_state(host, port) == "filtered" and \
+            not responder.filters_syn_only(host, port)
+        assert result[port] == (PortState.FILTERED if filtered else PortState.UNFILTERED)
@@ -0,0 +1,47 @@
+"""Tests of the global scan scheduler."""
+
+import time
+
+from benchmarks.simulator import SimulatedResponder
+from src.engine import ProbeEngine
+from src.ports import PortSet
+from src.ratelimit import RateLimiter
+from src.scanner import SYNScanner
+from src.scheduler import HostJob, ScanScheduler
+from src.utils import ScanErrorException
+
+
+def test_has_work_keeps_round_robin_order():
+    scheduler = ScanScheduler(ProbeEngine(), max_in_flight_per_host=1)
+    jobs = [HostJob(SYNScanner(f"10.0.0.{index}", PortSet([80, 443]))) for index in (1, 2, 3)]
+    scheduler._active.extend(jobs)
+    jobs[0].in_flight = 1
+
+    assert scheduler._has_work()
+    assert list(scheduler._active) == jobs
+    assert scheduler._next_job() is jobs[1]
+
+    for job in jobs:
+        job.in_flight = 1
+    assert not scheduler._has_work()
+    assert scheduler._next_job() is None
+
+
+def test_stop_fails_hosts_waiting_for_replies():
+    responder = SimulatedResponder(open_fraction=1.0, rtt=2.0, jitter=0.0)
+    responder.start()
+    engine = ProbeEngine(timeout=5, rate_limiter=RateLimiter(20000, 20000),
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    found = []
+    with engine:
+        scheduler = ScanScheduler(engine)
+        scheduler.start()
+        future = scheduler.submit(SYNScanner("10.0.0.1", PortSet.parse("1-10"), engine),
+                                  lambda port, state: found.append((port, state)))
+        time.sleep(0.5)
+        scheduler.stop()
+    responder.stop()
+
+    assert isinstance(future.exception(1), ScanErrorException)
+    assert found == []
@@ -0,0 +1,111 @@
+"""Tests of service detection against local listeners."""
+
+import time
+
+import pytest
+
+from benchmarks.simulator import LocalServices
+from src.metrics import Metrics
+from src.services import SERVICE_PATTERNS, ServiceCache, ServiceDetector, ServiceInfo, identify
+
+BANNERS = {
+    "ssh": (b"SSH-2.0-OpenSSH_9.6\r\n", "SSH-2.0-OpenSSH_9.6"),
+    "http": (b"HTTP/1.1 404 Not Found\r\nServer: Apache/2.4.58\r\n\r\n", "Apache/2.4.58"),
+    "ftp": (b"220 ProFTPD Server ready.\r\n", "220 ProFTPD Server ready."),
+    "smtp": (b"220-mx.example.com ESMTP\r\n", "220-mx.example.com ESMTP"),
+    "pop3": (b"+OK Dovecot ready.\r\n", "+OK Dovecot ready."),
+    "imap": (b"* OK [CAPABILITY IMAP4rev1] ready\r\n", "* OK [CAPABILITY IMAP4rev1] ready"),
+    "vnc": (b"RFB 003.008\n", "RFB 003.008"),
+    "mysql": (b"J\x00\x00\x00\x0a8.0.36\x00", "J..."),
+    "redis": (b"-NOAUTH Authentication required.\r\n", "-NOAUTH Authentication required."),
+    "telnet": (b"\xff\xfd\x18\xff\xfd\x20", "\xff\xfd.\xff\xfd"),
+    "tls": (b"\x15\x03\x01\x00\x02\x02\x46", "......F"),
+}
+
+
+class GaugeMetrics(Metrics):
+    """Metrics keeping the highest value of each gauge."""
+
+    def __init__(self):
+        super().__init__()
+        self.highest = {}
+
+    def add_gauge(self, name, delta):
+        super().add_gauge(name, delta)
+        with self._lock:
+            self.highest[name] = max(self.highest.get(name, 0), self._gauges[name])
+
+
+@pytest.fixture
+def services():
+    services = LocalServices(20, delay=0.05)
+    services.start()
+    yield services
+    services.stop()
+
+
+@pytest.mark.parametrize("name", [name for name, _ in SERVICE_PATTERNS])
+def test_identify_each_pattern(name):
+    data, banner = BANNERS[name]
+
+    assert identify(data) == (name, banner)
+
+
+def test_identify_unknown():
+    assert identify(b"hello\r\nworld") == ("unknown", "hello")
+
+
+@pytest.mark.parametrize("concurrency, host_limit", [(50, 3), (3, 50)])
+def test_connections_are_capped(services, concurrency, host_limit):
+    metrics = GaugeMetrics()
+    with ServiceDetector(concurrency, host_limit, read_timeout=0.2, metrics=metrics) as detector:
+        futures = {port: detector.submit(services.host, port) for port in services.ports}
+        found = {port: future.result(10).name for port, future in futures.items()}
+
+    assert found == services.expected
+    assert metrics.highest["services_in_flight"] == 3
+
+
+def test_http_probe_after_read_deadline(services):
+    http = next(port for port, name in services.expected.items() if name == "http")
+    silent = next(port for port, name in services.expected.items() if name == "unknown")
+    started = time.monotonic()
+    with ServiceDetector(read_timeout=0.2, metrics=Metrics()) as detector:
+        assert detector.submit(services.host, http).result(10) == ServiceInfo(
+            "http", "nginx/1.24.0")
+        assert time.monotonic() - started >= 0.2
+        assert detector.submit(services.host, silent).result(10) == ServiceInfo("unknown")
+
+
+def test_cache_hit_skips_connection(services):
+    metrics = Metrics()
+    with ServiceDetector(read_timeout=0.2, metrics=metrics) as detector:
+        first = {port: detector.submit(services.host, port).result(10) for port in services.ports}
+        connections = services.connections
+        second = {port: detector.submit(services.host, port).result(10)
+                  for port in services.ports}
+
+    assert first == second
+    assert services.connections == connections == len(services.ports)
+    assert metrics.snapshot()["counters"]["service_cache_hits"] == len(services.ports)
+
+
+def test_cache_round_trip_drops_expired(tmp_path):
+    path = tmp_path / "services.jsonl"
+    cache = ServiceCache(ttl=100)
+    cache.put("10.0.0.1", 22, ServiceInfo("ssh", "SSH-2.0-OpenSSH_9.6"))
+    cache.put("10.0.0.1", 80, ServiceInfo("http", "nginx"), found_at=time.time() - 200)
+    cache.put("10.0.0.2", 25, ServiceInfo("smtp"), found_at=time.time() - 50)
+    cache.save(path)
+
+    loaded = ServiceCache(ttl=100)
+    loaded.load(path)
+
+    assert len(loaded) == 2
+    assert loaded.get("10.0.0.1", 22) == ServiceInfo("ssh", "SSH-2.0-OpenSSH_9.6")
+    assert loaded.get("10.0.0.1", 80) is None
+    assert loaded.get("10.0.0.2", 25) == ServiceInfo("smtp")
+
+    expiring = ServiceCache(ttl=40)
+    expiring.load(path)
+    assert len(expiring) == 1 and expiring.get("10.0.0.2", 25) is None
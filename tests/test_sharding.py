@@ -0,0 +1,131 @@
+"""Tests of scans spread over worker processes."""
+
+import multiprocessing
+import os
+
+import pytest
+
+from benchmarks.simulator import SimulatedNetwork
+from src.engine import SPORT_BASE, SPORT_RANGE, ProbeEngine
+from src.ports import PortSet
+from src.results import PortState
+from src.scanner import SYNScanner
+from src.sharding import ShardedScan, shard_sports
+from src.targets import TargetSet
+from src.utils import ProbeEngineErrorException, ScanErrorException
+
+
+class FailingNetwork(SimulatedNetwork):
+    """SimulatedNetwork whose sockets can not be opened by the workers in failing."""
+
+    def __init__(self, failing, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing = failing
+
+    def __call__(self, iface=None):
+        if multiprocessing.current_process().name in self.failing:
+            raise OSError("Operation not permitted")
+        return super().__call__(iface)
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), failing=self.failing)
+
+    def raw_socket(self, iface=None):
+        if multiprocessing.current_process().name in self.failing:
+            raise OSError("Operation not permitted")
+        return super().raw_socket(iface)
+
+
+class CrashingNetwork(SimulatedNetwork):
+    """SimulatedNetwork killing the worker named crashing after its first probes probes."""
+
+    def __init__(self, crashing, probes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crashing = crashing
+        self.probes = probes
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), crashing=self.crashing, probes=self.probes)
+
+    def raw_socket(self, iface=None):
+        raw_socket = super().raw_socket(iface)
+        if multiprocessing.current_process().name != self.crashing:
+            return raw_socket
+        sendto, sent = raw_socket.sendto, [0]
+
+        def crash(packet, address):
+            sent[0] += 1
+            if sent[0] > self.probes:
+                os._exit(1)
+            return sendto(packet, address)
+
+        raw_socket.sendto = crash
+        return raw_socket
+
+
+def test_workers_get_disjoint_source_ports():
+    sports = [shard_sports(index, 3) for index in range(3)]
+    ranges = [range(base, base + count) for base, count in sports]
+
+    assert ranges[0].start == SPORT_BASE and ranges[-1].stop <= SPORT_BASE + SPORT_RANGE
+    assert all(first.stop == second.start for first, second in zip(ranges, ranges[1:]))
+    engine = ProbeEngine(sport_base=sports[1][0], sport_range=sports[1][1])
+    assert engine.receive_filter() == ProbeEngine(
+        sport_base=ranges[1].start, sport_range=len(ranges[1])).receive_filter()
+    assert engine.receive_filter() != ProbeEngine().receive_filter()
+
+
+def run(network, targets="10.0.0.1-10.0.0.4", ports="1-50"):
+    targets, ports = TargetSet.parse(targets), PortSet.parse(ports)
+    found, hosts = {}, {}
+    ShardedScan(targets, ports, SYNScanner, 2, rate=20000, timeout=0.2, socket_factory=network,
+                raw_socket_factory=network.raw_socket).run(
+        lambda host, port, state: found.__setitem__((host, port), state),
+        lambda future, host: hosts.__setitem__(host, future.exception()))
+    return found, hosts
+
+
+def test_failed_worker_hosts_are_reported_with_an_error():
+    network = FailingNetwork({"scan-shard-1"}, open_fraction=0.2, closed_fraction=0.5,
+                             rtt=0.002, jitter=0.001)
+
+    found, hosts = run(network)
+
+    targets = TargetSet.parse("10.0.0.1-10.0.0.4")
+    scanned = {targets[index] for index in range(0, len(targets), 2)}
+    failed = {targets[index] for index in range(1, len(targets), 2)}
+    assert {host for host, _ in found} == scanned
+    assert len(found) == len(scanned) * 50
+    assert all(hosts[host] is None for host in scanned)
+    assert all(isinstance(hosts[host], ScanErrorException) for host in failed)
+
+
+def test_failed_worker_fails_shared_hosts():
+    network = FailingNetwork({"scan-shard-0"}, open_fraction=0.2, closed_fraction=0.5,
+                             rtt=0.002, jitter=0.001)
+
+    found, hosts = run(network, targets="10.0.0.1")
+
+    assert len(found) == 25 and all(state in PortState for state in found.values())
+    assert isinstance(hosts["10.0.0.1"], ScanErrorException)
+
+
+def test_no_worker_started_raises_before_any_report():
+    network = FailingNetwork({"scan-shard-0", "scan-shard-1"})
+
+    with pytest.raises(ProbeEngineErrorException):
+        run(network)
+
+
+def test_crashed_worker_unreported_hosts_are_reported_with_an_error():
+    network = CrashingNetwork("scan-shard-1", 10, open_fraction=0.2, closed_fraction=0.5,
+                              rtt=0.002, jitter=0.001)
+
+    _, hosts = run(network)
+
+    targets = TargetSet.parse("10.0.0.1-10.0.0.4")
+    assert set(hosts) == set(targets)
+    assert all(hosts[targets[index]] is None for index in range(0, len(targets), 2))
+    for index in range(1, len(targets), 2):
+        assert isinstance(hosts[targets[index]], ScanErrorException)
+        assert "exited with code 1" in str(hosts[targets[index]])
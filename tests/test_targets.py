@@ -0,0 +1,73 @@
+"""Tests of the scan target set."""
+
+import pytest
+
+from src.targets import TargetSet, permutation
+from src.utils import HostInputErrorException
+
+
+def test_parse_merges_ranges_networks_and_addresses():
+    targets = TargetSet.parse("10.0.0.5-10.0.0.9, 10.0.0.0/29, 10.0.0.10, 192.168.1.1, "
+                              "example.com, localhost")
+
+    assert len(targets.intervals) == 2
+    assert len(targets) == 13
+    assert list(targets) == [f"10.0.0.{value}" for value in range(1, 11)] + [
+        "192.168.1.1", "example.com", "localhost"]
+    assert "10.0.0.7" in targets and "10.0.0.11" not in targets and "example.com" in targets
+
+
+def test_parse_network_hosts():
+    assert list(TargetSet.parse("10.1.0.0/30")) == ["10.1.0.1", "10.1.0.2"]
+    assert list(TargetSet.parse("10.1.0.0/31")) == ["10.1.0.0", "10.1.0.1"]
+    assert len(TargetSet.parse("10.0.0.0/8")) == 2 ** 24 - 2
+
+
+@pytest.mark.parametrize("text", ["10.0.0.9-10.0.0.1", "10.0.0.1-example", "10.0.0.0/33",
+                                  "10.0.0.1;", "-"])
+def test_parse_rejects_incorrect_hosts(text):
+    with pytest.raises(HostInputErrorException):
+        TargetSet.parse(text)
+
+
+def test_getitem_across_interval_boundaries():
+    targets = TargetSet.parse("10.0.0.1-10.0.0.3, 10.0.1.0-10.0.1.1, 172.16.0.1, localhost")
+    expected = list(targets)
+
+    assert [targets[index] for index in range(len(targets))] == expected
+    assert targets[2] == "10.0.0.3" and targets[3] == "10.0.1.0"
+    assert targets[5] == "172.16.0.1" and targets[6] == "localhost"
+    assert targets[-1] == "localhost" and targets[-7] == "10.0.0.1"
+    with pytest.raises(IndexError):
+        targets[len(targets)]
+    with pytest.raises(IndexError):
+        targets[-len(targets) - 1]
+
+
+def test_getitem_after_adding_a_range():
+    targets = TargetSet.parse("10.0.0.1, 10.0.0.3")
+    assert targets[1] == "10.0.0.3"
+
+    targets.add_range(targets.intervals[0][0] + 1, targets.intervals[0][0] + 1)
+
+    assert len(targets.intervals) == 1 and targets[1] == "10.0.0.2" and targets[2] == "10.0.0.3"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5, 1000, 1024, 1025, 65536])
+def test_permutation_visits_every_index_once(size):
+    order = list(permutation(size, seed=size))
+
+    assert sorted(order) == list(range(size))
+
+
+def test_permutation_is_seeded():
+    assert list(permutation(1000, seed=1)) == list(permutation(1000, seed=1))
+    assert list(permutation(1000, seed=1)) != list(permutation(1000, seed=2))
+    assert list(permutation(0)) == []
+
+
+def test_shuffled_yields_every_target():
+    targets = TargetSet.parse("10.0.0.0/24, example.com")
+
+    assert sorted(targets.shuffled(seed=3)) == sorted(targets)
+    assert list(targets.shuffled(seed=3)) != list(targets)
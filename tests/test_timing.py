@@ -0,0 +1,135 @@
+"""Tests of adaptive probe timeouts, retransmissions and rate backoff."""
+
+import threading
+import time
+
+import pytest
+
+from benchmarks.simulator import SimulatedResponder
+from src.engine import ProbeEngine
+from src.metrics import Metrics
+from src.ratelimit import RateLimiter
+from src.timing import CLOCK_GRANULARITY, RTT_ALPHA, RTT_BETA, RttEstimator
+
+
+def test_first_sample_sets_srtt_and_half_variance():
+    estimator = RttEstimator(initial_timeout=1, min_timeout=0.001, max_timeout=10)
+    assert estimator.timeout() == 1
+
+    estimator.update(0.2)
+
+    assert estimator.srtt == 0.2 and estimator.rttvar == 0.1
+    assert estimator.timeout() == pytest.approx(0.2 + 4 * 0.1)
+
+
+def test_later_samples_follow_rfc_6298():
+    estimator = RttEstimator(min_timeout=0.001, max_timeout=10)
+    srtt, rttvar = 0.1, 0.05
+    estimator.update(srtt)
+
+    for rtt in (0.3, 0.05, 0.12, 0.12, 0.5):
+        rttvar = (1 - RTT_BETA) * rttvar + RTT_BETA * abs(srtt - rtt)
+        srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+        estimator.update(rtt)
+        assert estimator.srtt == pytest.approx(srtt)
+        assert estimator.rttvar == pytest.approx(rttvar)
+        assert estimator.timeout() == pytest.approx(srtt + max(CLOCK_GRANULARITY, 4 * rttvar))
+
+
+def test_timeout_is_clamped():
+    estimator = RttEstimator(min_timeout=0.1, max_timeout=2)
+    for _ in range(50):
+        estimator.update(0.001)
+
+    assert estimator.rttvar < CLOCK_GRANULARITY / 4
+    assert estimator.timeout() == 0.1
+    estimator.update(5)
+    assert estimator.timeout() == 2
+
+
+def test_backoff_doubles_per_retransmission():
+    estimator = RttEstimator(min_timeout=0.1, max_timeout=1)
+    estimator.update(0.02)
+
+    assert [estimator.timeout(tries) for tries in range(5)] == pytest.approx(
+        [0.1, 0.2, 0.4, 0.8, 1])
+
+
+@pytest.mark.parametrize("max_retries", [0, 1, 3])
+def test_unanswered_probe_is_sent_max_retries_more_times(max_retries):
+    responder = SimulatedResponder(loss=1.0)
+    responder.start()
+    metrics = Metrics()
+    engine = ProbeEngine(timeout=0.05, max_retries=max_retries, metrics=metrics,
+                         rate_limiter=RateLimiter(10000, 10000),
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    responses = []
+    done = threading.Event()
+
+    def on_reply(host, port, flags, response):
+        responses.append(response)
+        if len(responses) == 3:
+            done.set()
+
+    with engine:
+        for port in (22, 80, 443):
+            engine.submit("10.0.0.1", port, "S", on_reply)
+        assert done.wait(10)
+        time.sleep(0.2)
+    responder.stop()
+
+    assert responses == [None, None, None]
+    assert responder.probes == 3 * (1 + max_retries)
+    counters = metrics.snapshot()["counters"]
+    assert counters["probes_sent"] == 3 * (1 + max_retries)
+    assert counters.get("retransmits", 0) == 3 * max_retries
+    assert counters["timeouts"] == 3
+
+
+def test_expiry_waits_for_backed_off_timeouts():
+    responder = SimulatedResponder(loss=1.0)
+    responder.start()
+    engine = ProbeEngine(timeout=0.4, max_retries=2, metrics=Metrics(),
+                         rate_limiter=RateLimiter(10000, 10000),
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    engine.rtt_estimator("10.0.0.1").update(0.01)
+    done = threading.Event()
+
+    with engine:
+        started = time.monotonic()
+        engine.submit("10.0.0.1", 80, "S", lambda *args: done.set())
+        assert done.wait(10)
+        elapsed = time.monotonic() - started
+    responder.stop()
+
+    assert 0.1 + 0.2 + 0.4 <= elapsed < 2
+
+
+@pytest.mark.parametrize("loss, backs_off", [(0.0, False), (0.3, True)])
+def test_rate_backs_off_when_probes_time_out(loss, backs_off):
+    responder = SimulatedResponder(open_fraction=0.0, closed_fraction=1.0, rtt=0.002,
+                                   jitter=0.001, loss=loss)
+    responder.start()
+    limiter = RateLimiter(2000, 100)
+    engine = ProbeEngine(timeout=0.05, max_retries=0, metrics=Metrics(), rate_limiter=limiter,
+                         socket_factory=responder.socket,
+                         raw_socket_factory=responder.raw_socket)
+    ports = range(1, 3001)
+    answered = []
+    done = threading.Event()
+
+    def on_reply(host, port, flags, response):
+        answered.append(response is not None)
+        if len(answered) == len(ports):
+            done.set()
+
+    with engine:
+        for port in ports:
+            engine.submit("10.0.0.1", port, "S", on_reply)
+        assert done.wait(30)
+    responder.stop()
+
+    assert (limiter.rate < 2000) == backs_off
+    assert all(answered) != backs_off